@@ -0,0 +1,524 @@
+"""In-process fake of the GCS JSON API for benchmarks and local runs.
+
+Implements the subset used by the Python services: object listing with
+page tokens and start/end offsets, object GET/PATCH/DELETE, ranged media
+downloads, multipart and resumable uploads, compose and JSON API batch
+requests. Point the clients at it through STORAGE_EMULATOR_HOST:
+
+    server = FakeGCSServer()
+    server.start()
+    os.environ['STORAGE_EMULATOR_HOST'] = server.url
+
+Object content is either stored bytes or synthetic (size + seed, generated
+on demand) so millions of objects or multi-GB files cost little memory.
+"""
+import base64
+import email.parser
+import email.policy
+import hashlib
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import google_crc32c
+
+PATTERN_SIZE = 1 << 20
+
+
+def _pattern(seed):
+    return random.Random(seed).randbytes(PATTERN_SIZE)
+
+
+class SyntheticContent:
+    """Deterministic bytes of a given size generated from a seed."""
+
+    _patterns = {}
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.seed = seed
+
+    def read(self, start, end):
+        pattern = self._patterns.get(self.seed)
+        if pattern is None:
+            pattern = self._patterns[self.seed] = _pattern(self.seed)
+        out = bytearray()
+        pos = start
+        while pos <= end:
+            offset = pos % PATTERN_SIZE
+            take = min(PATTERN_SIZE - offset, end - pos + 1)
+            out += pattern[offset:offset + take]
+            pos += take
+        return bytes(out)
+
+    def checksums(self):
+        md5 = hashlib.md5()
+        crc = google_crc32c.Checksum()
+        for start in range(0, self.size, PATTERN_SIZE):
+            chunk = self.read(start, min(start + PATTERN_SIZE, self.size) - 1)
+            md5.update(chunk)
+            crc.update(chunk)
+        return md5.digest(), crc.digest()
+
+
+class StoredContent:
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.size = len(self.data)
+
+    def read(self, start, end):
+        return self.data[start:end + 1]
+
+    def checksums(self):
+        return hashlib.md5(self.data).digest(), google_crc32c.Checksum(self.data).digest()
+
+
+class FaultInjector:
+    """Fails a fraction of requests with the given HTTP status codes.
+
+    ``rate`` is the probability that a request fails; ``statuses`` are picked
+    from at random. ``latency`` (seconds) is added to every request.
+
+    It can also emulate quota and overload: requests beyond ``max_rps`` in
+    the current second are rejected with a 429, and requests arriving while
+    ``max_concurrent`` are already being served with a 503. Below those,
+    each request in flight adds ``latency_per_request`` seconds to the
+    latency of the others, so latency grows with concurrency.
+    """
+
+    def __init__(self, rate=0.0, statuses=(429, 503), latency=0.0, seed=0, max_rps=0, max_concurrent=0,
+                 latency_per_request=0.0):
+        self.rate = rate
+        self.statuses = statuses
+        self.latency = latency
+        self.max_rps = max_rps
+        self.max_concurrent = max_concurrent
+        self.latency_per_request = latency_per_request
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._second = 0
+        self._second_count = 0
+        self.in_flight = 0
+        self.injected = 0
+        self.throttled = 0
+
+    def admit(self):
+        """Status rejecting a request over the quota or the concurrency
+        limit, or None after counting it in flight; release() it when done."""
+        with self._lock:
+            second = int(time.monotonic())
+            if second != self._second:
+                self._second, self._second_count = second, 0
+            if self.max_rps and self._second_count >= self.max_rps:
+                self.throttled += 1
+                return 429
+            if self.max_concurrent and self.in_flight >= self.max_concurrent:
+                self.throttled += 1
+                return 503
+            self._second_count += 1
+            self.in_flight += 1
+            return None
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def delay(self):
+        """Seconds to hold an admitted request for."""
+        return self.latency + self.latency_per_request * max(0, self.in_flight - 1)
+
+    def pick(self):
+        with self._lock:
+            if self.rate and self._random.random() < self.rate:
+                self.injected += 1
+                return self._random.choice(self.statuses)
+        return None
+
+
+class FakeBucketStore:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.buckets = {}
+        self.generation = int(time.time() * 1e6)
+        self.uploads = {}
+
+    def _next_generation(self):
+        self.generation += 1
+        return self.generation
+
+    def put(self, bucket, name, content, content_type='application/octet-stream', metadata=None,
+            composite=False):
+        md5, crc = content.checksums()
+        with self.lock:
+            now = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+            resource = {
+                'kind': 'storage#object',
+                'id': f'{bucket}/{name}',
+                'name': name,
+                'bucket': bucket,
+                'generation': str(self._next_generation()),
+                'metageneration': '1',
+                'contentType': content_type,
+                'size': str(content.size),
+                'crc32c': base64.b64encode(crc).decode(),
+                'timeCreated': now,
+                'updated': now,
+                'storageClass': 'STANDARD',
+            }
+            if not composite:
+                resource['md5Hash'] = base64.b64encode(md5).decode()
+            else:
+                resource['componentCount'] = 2
+            if metadata:
+                resource['metadata'] = dict(metadata)
+            self.buckets.setdefault(bucket, {})[name] = (resource, content)
+            return resource
+
+    def get(self, bucket, name):
+        with self.lock:
+            return self.buckets.get(bucket, {}).get(name)
+
+    def delete(self, bucket, name):
+        with self.lock:
+            return self.buckets.get(bucket, {}).pop(name, None) is not None
+
+    def patch(self, bucket, name, body):
+        with self.lock:
+            entry = self.get(bucket, name)
+            if entry is None:
+                return None
+            resource = entry[0]
+            for key, value in body.items():
+                if key == 'metadata':
+                    merged = dict(resource.get('metadata') or {})
+                    for meta_key, meta_value in (value or {}).items():
+                        if meta_value is None:
+                            merged.pop(meta_key, None)
+                        else:
+                            merged[meta_key] = meta_value
+                    if merged:
+                        resource['metadata'] = merged
+                    else:
+                        resource.pop('metadata', None)
+                elif key in ('contentType', 'cacheControl', 'contentDisposition', 'contentEncoding'):
+                    resource[key] = value
+            resource['metageneration'] = str(int(resource['metageneration']) + 1)
+            resource['updated'] = time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+            return resource
+
+    def list(self, bucket, prefix='', start_offset='', end_offset='', page_token='', max_results=1000,
+             delimiter=None):
+        with self.lock:
+            names = sorted(n for n in self.buckets.get(bucket, {}) if n.startswith(prefix or ''))
+        start = page_token or start_offset or ''
+        if page_token:
+            names = [n for n in names if n > start]
+        elif start:
+            names = [n for n in names if n >= start]
+        if end_offset:
+            names = [n for n in names if n < end_offset]
+        prefixes = set()
+        items = []
+        next_token = None
+        for position, n in enumerate(names):
+            if len(items) + len(prefixes) >= max_results:
+                next_token = names[position - 1]
+                break
+            if delimiter:
+                rest = n[len(prefix or ''):]
+                if delimiter in rest:
+                    prefixes.add((prefix or '') + rest.split(delimiter)[0] + delimiter)
+                    continue
+            items.append(self.buckets[bucket][n][0])
+        result = {'kind': 'storage#objects', 'items': items}
+        if prefixes:
+            result['prefixes'] = sorted(prefixes)
+        if next_token is not None:
+            result['nextPageToken'] = next_token
+        return result
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeGCS/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def _count(self):
+        with self.server.stats_lock:
+            self.server.request_count += 1
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, body=b'', content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._send(status, {'error': {'code': status, 'message': message, 'errors': [{'message': message}]}})
+
+    def _dispatch(self):
+        if self.path == '/_fake/stats':
+            # Not counted and never faulted, so benchmarks can poll it
+            return self._send(200, self.server.stats())
+        self._count()
+        faults = self.server.faults
+        body = self._read_body()
+        status = faults.admit()
+        if status is not None:
+            return self._error(status, 'rate limit exceeded' if status == 429 else 'backend overloaded')
+        try:
+            delay = faults.delay()
+            if delay:
+                time.sleep(delay)
+            status = faults.pick()
+            if status is not None:
+                return self._error(status, 'injected fault')
+
+            parsed = urllib.parse.urlsplit(self.path)
+            query = dict(urllib.parse.parse_qsl(parsed.query, keep_blank_values=True))
+            parts = [urllib.parse.unquote(p) for p in parsed.path.split('/')]
+            status, payload, content_type, headers = self.server.route(
+                self.command, parts, query, self.headers, body)
+        finally:
+            faults.release()
+        self._send(status, payload, content_type, headers)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = do_HEAD = _dispatch
+
+
+class FakeGCSServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, host='127.0.0.1', port=0, page_size=1000, faults=None):
+        super().__init__((host, port), _Handler)
+        self.store = FakeBucketStore()
+        self.page_size = page_size
+        self.faults = faults or FaultInjector()
+        self.stats_lock = threading.Lock()
+        self.request_count = 0
+        self._thread = None
+
+    def stats(self):
+        with self.stats_lock:
+            return {'request_count': self.request_count, 'faults_injected': self.faults.injected,
+                    'requests_throttled': self.faults.throttled}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    # Helpers for seeding data
+
+    def add_object(self, bucket, name, data, **kwargs):
+        return self.store.put(bucket, name, StoredContent(data), **kwargs)
+
+    def add_synthetic_object(self, bucket, name, size, seed=0, **kwargs):
+        return self.store.put(bucket, name, SyntheticContent(size, seed), **kwargs)
+
+    # Routing
+
+    def route(self, method, parts, query, headers, body):
+        # parts: ['', 'storage', 'v1', 'b', bucket, 'o', name...]
+        if parts[1:3] == ['batch', 'storage'] and method == 'POST':
+            return self._batch(headers, body)
+        if parts[1] == 'download' and parts[2:4] == ['storage', 'v1']:
+            return self._media(method, parts[5], '/'.join(parts[7:]), headers, query)
+        if parts[1] == 'upload' and parts[2:4] == ['storage', 'v1']:
+            return self._upload(method, parts[5], query, headers, body)
+        if parts[1:3] != ['storage', 'v1'] or len(parts) < 6 or parts[3] != 'b':
+            return 404, {'error': {'code': 404, 'message': 'not found'}}, 'application/json', None
+        bucket = parts[4]
+        if len(parts) == 6 and parts[5] == 'o' and method == 'GET':
+            result = self.store.list(
+                bucket,
+                prefix=query.get('prefix', ''),
+                start_offset=query.get('startOffset', ''),
+                end_offset=query.get('endOffset', ''),
+                page_token=query.get('pageToken', ''),
+                max_results=int(query.get('maxResults') or self.page_size),
+                delimiter=query.get('delimiter'),
+            )
+            return 200, result, 'application/json', None
+        name = '/'.join(parts[6:])
+        if name.endswith('/compose') and method == 'POST':
+            return self._compose(bucket, name[:-len('/compose')], body)
+        if query.get('alt') == 'media':
+            return self._media(method, bucket, name, headers, query)
+        if method == 'GET':
+            entry = self.store.get(bucket, name)
+            if entry is None:
+                return 404, {'error': {'code': 404, 'message': 'No such object'}}, 'application/json', None
+            return 200, entry[0], 'application/json', None
+        if method in ('PATCH', 'PUT'):
+            resource = self.store.patch(bucket, name, json.loads(body or b'{}'))
+            if resource is None:
+                return 404, {'error': {'code': 404, 'message': 'No such object'}}, 'application/json', None
+            return 200, resource, 'application/json', None
+        if method == 'DELETE':
+            if not self.store.delete(bucket, name):
+                return 404, {'error': {'code': 404, 'message': 'No such object'}}, 'application/json', None
+            return 204, b'', 'application/json', None
+        return 405, {'error': {'code': 405, 'message': 'method not allowed'}}, 'application/json', None
+
+    def _media(self, method, bucket, name, headers, query):
+        entry = self.store.get(bucket, name)
+        if entry is None:
+            return 404, {'error': {'code': 404, 'message': 'No such object'}}, 'application/json', None
+        resource, content = entry
+        generation = query.get('generation')
+        if generation and generation != resource['generation']:
+            return 404, {'error': {'code': 404, 'message': 'No such generation'}}, 'application/json', None
+        start, end, status = 0, content.size - 1, 200
+        range_header = headers.get('Range')
+        if range_header and range_header.startswith('bytes='):
+            first, _, last = range_header[6:].partition('-')
+            start = int(first) if first else 0
+            end = min(int(last), content.size - 1) if last else content.size - 1
+            status = 206
+        extra = {
+            'x-goog-generation': resource['generation'],
+            'x-goog-hash': f"crc32c={resource['crc32c']}" + (
+                f",md5={resource['md5Hash']}" if 'md5Hash' in resource else ''),
+            'x-goog-stored-content-length': resource['size'],
+        }
+        if status == 206:
+            extra['Content-Range'] = f'bytes {start}-{end}/{content.size}'
+        data = content.read(start, end) if content.size else b''
+        return status, data, resource.get('contentType', 'application/octet-stream'), extra
+
+    def _upload(self, method, bucket, query, headers, body):
+        upload_type = query.get('uploadType')
+        if upload_type == 'media':
+            resource = self.store.put(bucket, query['name'], StoredContent(body),
+                                      headers.get('Content-Type', 'application/octet-stream'))
+            return 200, resource, 'application/json', None
+        if upload_type == 'multipart':
+            message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                b'Content-Type: ' + headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+            meta_part, data_part = list(message.iter_parts())
+            meta = json.loads(meta_part.get_content())
+            resource = self.store.put(bucket, meta.get('name') or query.get('name'),
+                                      StoredContent(data_part.get_payload(decode=True)),
+                                      meta.get('contentType') or data_part.get_content_type(),
+                                      meta.get('metadata'))
+            return 200, resource, 'application/json', None
+        if upload_type == 'resumable':
+            upload_id = query.get('upload_id')
+            if method == 'POST' and not upload_id:
+                meta = json.loads(body or b'{}')
+                upload_id = f'{time.monotonic_ns()}'
+                self.store.uploads[upload_id] = {
+                    'bucket': bucket, 'name': meta.get('name') or query.get('name'),
+                    'contentType': meta.get('contentType', 'application/octet-stream'),
+                    'metadata': meta.get('metadata'), 'data': bytearray()}
+                location = f'{self.url}/upload/storage/v1/b/{bucket}/o?uploadType=resumable&upload_id={upload_id}'
+                return 200, b'', 'application/json', {'Location': location}
+            upload = self.store.uploads.get(upload_id)
+            if upload is None:
+                return 404, {'error': {'code': 404, 'message': 'No such upload'}}, 'application/json', None
+            upload['data'] += body
+            content_range = headers.get('Content-Range', '')
+            total = content_range.rpartition('/')[2]
+            if total != '*':
+                del self.store.uploads[upload_id]
+                resource = self.store.put(upload['bucket'], upload['name'], StoredContent(upload['data']),
+                                          upload['contentType'], upload['metadata'])
+                return 200, resource, 'application/json', None
+            return 308, b'', 'application/json', {'Range': f"bytes=0-{len(upload['data']) - 1}"}
+        return 400, {'error': {'code': 400, 'message': 'bad uploadType'}}, 'application/json', None
+
+    def _compose(self, bucket, name, body):
+        request = json.loads(body)
+        data = bytearray()
+        for source in request['sourceObjects']:
+            entry = self.store.get(bucket, source['name'])
+            if entry is None:
+                return 404, {'error': {'code': 404, 'message': 'No such object'}}, 'application/json', None
+            content = entry[1]
+            data += content.read(0, content.size - 1) if content.size else b''
+        destination = request.get('destination') or {}
+        resource = self.store.put(bucket, name, StoredContent(data),
+                                  destination.get('contentType', 'application/octet-stream'),
+                                  destination.get('metadata'), composite=True)
+        return 200, resource, 'application/json', None
+
+    def _batch(self, headers, body):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            b'Content-Type: ' + headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+        boundary = 'batch_fake_gcs'
+        out = bytearray()
+        for part in message.iter_parts():
+            content_id = part.get('Content-ID', '')
+            raw = part.get_payload(decode=True).replace(b'\r\n', b'\n')
+            request_line, _, rest = raw.lstrip(b'\n').partition(b'\n')
+            header_blob, _, sub_body = rest.partition(b'\n\n')
+            sub_method, sub_path, _ = request_line.decode().split(' ', 2)
+            sub_headers = {}
+            for line in header_blob.decode().split('\n'):
+                if ':' in line:
+                    key, value = line.split(':', 1)
+                    sub_headers[key.strip()] = value.strip()
+            faulted = self.faults.pick()
+            if faulted is not None:
+                status, payload = faulted, {'error': {'code': faulted, 'message': 'injected fault'}}
+            else:
+                parsed = urllib.parse.urlsplit(sub_path)
+                query = dict(urllib.parse.parse_qsl(parsed.query))
+                path_parts = [urllib.parse.unquote(p) for p in parsed.path.split('/')]
+                status, payload, _, _ = self.route(sub_method, path_parts, query, sub_headers, sub_body)
+            payload_bytes = json.dumps(payload).encode() if isinstance(payload, (dict, list)) else payload
+            response_id = content_id.replace('<', '<response-', 1) if content_id else ''
+            out += (f'--{boundary}\r\nContent-Type: application/http\r\n'
+                    f'Content-ID: {response_id}\r\n\r\n'
+                    f'HTTP/1.1 {status} OK\r\nContent-Type: application/json; charset=UTF-8\r\n'
+                    f'Content-Length: {len(payload_bytes)}\r\n\r\n').encode()
+            out += payload_bytes + b'\r\n'
+        out += f'--{boundary}--\r\n'.encode()
+        return 200, bytes(out), f'multipart/mixed; boundary={boundary}', None
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a standalone fake GCS server.')
+    parser.add_argument('--port', type=int, default=9023)
+    parser.add_argument('--fault-rate', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every request')
+    parser.add_argument('--max-rps', type=int, default=0, help='requests per second before 429s')
+    parser.add_argument('--max-concurrent', type=int, default=0, help='requests in flight before 503s')
+    args = parser.parse_args()
+    server = FakeGCSServer(port=args.port, faults=FaultInjector(rate=args.fault_rate, latency=args.latency,
+                                                               max_rps=args.max_rps,
+                                                               max_concurrent=args.max_concurrent))
+    print(f'Fake GCS listening on {server.url} (export STORAGE_EMULATOR_HOST={server.url})')
+    server.serve_forever()
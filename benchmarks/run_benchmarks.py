@@ -0,0 +1,357 @@
+"""End-to-end benchmarks of both services against the fake GCS.
+
+Each operation runs in a fresh process against its own fake GCS server
+(fake_gcs.py, in another process) seeded with synthetic objects:
+
+    hash/process_all/<engine>  gcs-hash-processor hashing every object of a
+                               bucket (process_all_files on each engine)
+    hash/find_identical/cold   GET /find-identical-files on an instance
+                               without an index (listing + index build)
+    hash/find_identical/warm   the same request answered from the index
+    ssim/similarity_report     gcs-ssim-comparison's
+                               generate_similarity_report over synthetic
+                               TIFFs of the given shapes
+
+Every result has the wall time, throughput, peak RSS (including worker
+processes) and the per-stage latency the service's own /metrics
+histograms recorded. Results are written as JSON to --output (by default
+benchmarks/results/<time>.json) together with the commit and machine they
+come from; --baseline compares them with an earlier file and flags
+operations that got slower or bigger by more than --tolerance.
+
+    python benchmarks/run_benchmarks.py --hash-objects 2000 --tiffs 24 --tiff-shapes 256x256,512x512
+    python benchmarks/run_benchmarks.py --baseline benchmarks/results/<earlier>.json --fail-on-regression
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime, timezone
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+SERVICES = {'hash': os.path.join(ROOT, 'gcs-hash-processor'), 'ssim': os.path.join(ROOT, 'gcs-ssim-comparison')}
+BUCKET = 'bench-bucket'
+SCHEMA_VERSION = 1
+# Compared with --baseline; all of them are better when lower
+COMPARED_METRICS = ('seconds', 'peak_rss_mb')
+
+
+def parse_shape(text):
+    """'512x512' or '512x512x3' -> (512, 512) or (512, 512, 3)."""
+    return tuple(int(part) for part in text.lower().split('x'))
+
+
+def seed_hash_objects(server, params, hashed):
+    """``hash_objects`` objects of ``hash_size`` bytes in 50 prefixes, a
+    ``duplicate_ratio`` of which repeat the content of another one. With
+    ``hashed`` they already carry a file_hash, as after a process-all run."""
+    distinct = max(1, round(params['hash_objects'] * (1 - params['duplicate_ratio'])))
+    for i in range(params['hash_objects']):
+        seed = i % distinct
+        metadata = {'file_hash': f'{seed:032x}', 'processed': 'true'} if hashed else None
+        server.add_synthetic_object(BUCKET, f'plate{i % 50:02d}/image{i:07d}.bin', params['hash_size'],
+                                    seed=seed, metadata=metadata)
+
+
+def seed_tiffs(server, params):
+    """``tiffs`` TIFFs spread over ``tiff_shapes``; a ``near_duplicate_ratio``
+    of them are noisy copies of another image of the same shape."""
+    import numpy as np
+    import tifffile
+
+    rng = np.random.default_rng(0)
+    dtype = np.dtype(params['tiff_dtype'])
+    high = np.iinfo(dtype).max if dtype.kind in 'ui' else 1.0
+    shapes = [parse_shape(shape) for shape in params['tiff_shapes'].split(',')]
+    originals = {}
+    for i in range(params['tiffs']):
+        shape = shapes[i % len(shapes)]
+        if shape in originals and rng.random() < params['near_duplicate_ratio']:
+            noise = rng.normal(0, high * 0.01, shape)
+            image = np.clip(originals[shape] + noise, 0, high).astype(dtype)
+        else:
+            # Smooth structure rather than white noise, so SSIM has something to match
+            y, x = np.mgrid[:shape[0], :shape[1]]
+            phase = rng.random(2) * 6.28
+            base = (np.sin(x / (7 + i % 5) + phase[0]) + np.cos(y / (11 + i % 3) + phase[1]) + 2) / 4
+            if len(shape) == 3:
+                base = np.repeat(base[:, :, None], shape[2], axis=2)
+            image = (base * high).astype(dtype)
+            originals[shape] = image
+        buffer = io.BytesIO()
+        tifffile.imwrite(buffer, image)
+        server.add_object(BUCKET, f'plate{i % 8}/image{i:05d}.tif', buffer.getvalue(), content_type='image/tiff')
+
+
+def serve(suite, params, hashed, queue):
+    sys.path.insert(0, HERE)
+    from fake_gcs import FakeGCSServer
+
+    server = FakeGCSServer()
+    if suite == 'hash':
+        seed_hash_objects(server, params, hashed)
+    else:
+        seed_tiffs(server, params)
+    queue.put(server.url)
+    server.serve_forever()
+
+
+def server_stats(url):
+    with urllib.request.urlopen(f'{url}/_fake/stats') as response:
+        return json.load(response)
+
+
+def peak_rss_mb():
+    """Peak RSS of this process and of the largest of its finished children."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / 1024, 1)
+
+
+def stage_summary(metrics):
+    """Per-stage calls, mean and approximate p50/p95 latency (the upper bound
+    of the histogram bucket they fall in), items and bytes, from the
+    service's metrics module."""
+    stages = {}
+    for metric in metrics.STAGE_SECONDS.collect():
+        buckets = {}
+        for sample in metric.samples:
+            stage = stages.setdefault(sample.labels['stage'], {})
+            if sample.name.endswith('_count'):
+                stage['calls'] = int(sample.value)
+            elif sample.name.endswith('_sum'):
+                stage['seconds'] = round(sample.value, 4)
+            elif sample.name.endswith('_bucket'):
+                buckets.setdefault(sample.labels['stage'], []).append((float(sample.labels['le']), sample.value))
+        for name, bounds in buckets.items():
+            stage = stages[name]
+            calls = stage.get('calls') or 0
+            stage['mean_ms'] = round(1000 * stage['seconds'] / calls, 3) if calls else None
+            for label, quantile in (('p50_ms', 0.5), ('p95_ms', 0.95)):
+                bound = next((le for le, count in sorted(bounds) if calls and count >= quantile * calls), None)
+                stage[label] = None if bound is None or bound == float('inf') else round(1000 * bound, 3)
+    for counter, key in ((metrics.STAGE_ITEMS, 'items'), (metrics.STAGE_BYTES, 'bytes')):
+        for metric in counter.collect():
+            for sample in metric.samples:
+                if sample.name.endswith('_total') and sample.labels['stage'] in stages:
+                    stages[sample.labels['stage']][key] = int(sample.value)
+    return stages
+
+
+def quiet_service(suite):
+    os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'bench')
+    os.environ['ITEM_LOG_SAMPLE'] = '0'
+    if suite == 'hash':
+        os.environ['HASH_INDEX_PATH'] = os.path.join(tempfile.mkdtemp(), 'index.sqlite3')
+        # The service logs with print
+        sys.stdout = open(os.devnull, 'w')
+    else:
+        os.environ['LOG_LEVEL'] = 'WARNING'
+        # Needed by --ssim-workers > 1; local disks are not memory-backed
+        os.environ['IMAGE_CACHE_SPILL_DIR'] = tempfile.mkdtemp()
+    sys.path.insert(0, SERVICES[suite])
+
+
+def run_operation(operation, url, params, queue):
+    suite, name, variant = operation.split('/')
+    os.environ['STORAGE_EMULATOR_HOST'] = url
+    quiet_service(suite)
+    import main
+    import metrics
+
+    baseline_rss = peak_rss_mb()
+    requests_before = server_stats(url)['request_count']
+    result = {'operation': operation}
+    started = time.perf_counter()
+    if name == 'process_all':
+        if variant == 'async':
+            import asyncio
+            state = asyncio.run(main.process_all_files_async(BUCKET, params['hash_mode'], 'bench'))
+        else:
+            state = main.process_all_files(BUCKET, params['num_threads'], params['hash_mode'], 'bench')
+        elapsed = time.perf_counter() - started
+        objects = state['files_processed']
+        result['throughput'] = {
+            'objects': objects,
+            'failed': state['files_failed'],
+            'objects_per_sec': round(objects / elapsed, 1),
+            'mb_per_sec': round(objects * params['hash_size'] / elapsed / 2 ** 20, 2),
+        }
+    elif name == 'find_identical':
+        client = main.app.test_client()
+        if variant == 'warm':
+            client.get(f'/find-identical-files?bucket={BUCKET}')
+            for collector in (metrics.STAGE_SECONDS, metrics.STAGE_ITEMS, metrics.STAGE_BYTES):
+                collector.clear()
+            requests_before = server_stats(url)['request_count']
+            started = time.perf_counter()
+        response = client.get(f'/find-identical-files?bucket={BUCKET}')
+        body = response.get_data()
+        elapsed = time.perf_counter() - started
+        result['throughput'] = {
+            'objects': params['hash_objects'],
+            'objects_per_sec': round(params['hash_objects'] / elapsed, 1),
+            'response_bytes': len(body),
+            'counts': response.get_json().get('counts'),
+        }
+    else:
+        from report_writer import ReportWriter
+        writer = ReportWriter(main.storage_client.bucket(BUCKET), 'bench-report.ndjson')
+        summary = main.generate_similarity_report(BUCKET, writer, params['similarity_threshold'],
+                                                  params['prefilter'], workers=params['ssim_workers'])
+        writer.finish(summary)
+        elapsed = time.perf_counter() - started
+        pairs = summary['pairs']
+        compared = pairs.get('compared', pairs.get('total', 0))
+        result['throughput'] = {
+            'images': params['tiffs'],
+            'pairs': pairs,
+            'images_per_sec': round(params['tiffs'] / elapsed, 2),
+            'pairs_per_sec': round(compared / elapsed, 1) if compared else None,
+        }
+    result.update({
+        'seconds': round(elapsed, 3),
+        'requests': server_stats(url)['request_count'] - requests_before,
+        'peak_rss_mb': peak_rss_mb(),
+        'rss_growth_mb': round(peak_rss_mb() - baseline_rss, 1),
+        'stages': stage_summary(metrics),
+    })
+    queue.put(result)
+
+
+def run_isolated(operation, params, repeat):
+    """Run an operation ``repeat`` times, each in a fresh process against a
+    freshly seeded server; keeps the fastest run."""
+    ctx = multiprocessing.get_context('spawn')
+    suite = operation.split('/')[0]
+    hashed = operation.startswith('hash/find_identical')
+    runs = []
+    for _ in range(repeat):
+        url_queue = ctx.Queue()
+        server = ctx.Process(target=serve, args=(suite, params, hashed, url_queue), daemon=True)
+        server.start()
+        url = url_queue.get()
+        try:
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run_operation, args=(operation, url, params, queue))
+            proc.start()
+            proc.join()
+            if proc.exitcode != 0:
+                raise SystemExit(f'{operation} exited with code {proc.exitcode}')
+            runs.append(queue.get())
+        finally:
+            server.terminate()
+    best = min(runs, key=lambda run: run['seconds'])
+    best['runs_seconds'] = [run['seconds'] for run in runs]
+    return best
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Rows of (operation, metric, before, after, change) and the ones that
+    got worse by more than ``tolerance``."""
+    before = {result['operation']: result for result in baseline['results']}
+    rows, regressions = [], []
+    for result in results:
+        previous = before.get(result['operation'])
+        if previous is None:
+            continue
+        for metric in COMPARED_METRICS:
+            old, new = previous.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            row = (result['operation'], metric, old, new, change)
+            rows.append(row)
+            if change > tolerance:
+                regressions.append(row)
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--suites', default='hash,ssim')
+    parser.add_argument('--engines', default='async,threads', help='engines of hash/process_all')
+    parser.add_argument('--hash-objects', type=int, default=2000)
+    parser.add_argument('--hash-size', type=int, default=64 * 1024, help='bytes per object')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.2)
+    parser.add_argument('--hash-mode', default='download', choices=('download', 'server', 'server_crc32c'))
+    parser.add_argument('--num-threads', type=int, default=32, help='maximum of the threads engine')
+    parser.add_argument('--tiffs', type=int, default=24)
+    parser.add_argument('--tiff-shapes', default='256x256,512x512', help='comma-separated HxW or HxWxC; the service compares channels as a third spatial axis')
+    parser.add_argument('--tiff-dtype', default='uint16')
+    parser.add_argument('--near-duplicate-ratio', type=float, default=0.3)
+    parser.add_argument('--similarity-threshold', type=float, default=0.9)
+    parser.add_argument('--no-prefilter', dest='prefilter', action='store_false')
+    parser.add_argument('--ssim-workers', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per operation; the fastest is kept')
+    parser.add_argument('--output', help='results file (default benchmarks/results/<time>.json)')
+    parser.add_argument('--baseline', help='earlier results file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='relative slowdown or growth flagged')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args()
+
+    params = {key: getattr(args, key) for key in (
+        'hash_objects', 'hash_size', 'duplicate_ratio', 'hash_mode', 'num_threads', 'tiffs', 'tiff_shapes',
+        'tiff_dtype', 'near_duplicate_ratio', 'similarity_threshold', 'prefilter', 'ssim_workers')}
+    operations = []
+    suites = args.suites.split(',')
+    if 'hash' in suites:
+        operations += [f'hash/process_all/{engine}' for engine in args.engines.split(',')]
+        operations += ['hash/find_identical/cold', 'hash/find_identical/warm']
+    if 'ssim' in suites:
+        operations.append('ssim/similarity_report/full')
+
+    results = []
+    for operation in operations:
+        result = run_isolated(operation, params, args.repeat)
+        results.append(result)
+        print(f"{operation:<32} {result['seconds']:>9}s  peak RSS {result['peak_rss_mb']:>8} MiB  "
+              f"{result['requests']:>7} requests  {json.dumps(result['throughput'])}")
+
+    report = {
+        'schema': SCHEMA_VERSION,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'git_commit': git_commit(),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(),
+                    'cpu_count': os.cpu_count()},
+        'params': params,
+        'results': results,
+    }
+    output = args.output or os.path.join(HERE, 'results', datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ.json'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'results written to {output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print('warning: the baseline was run with different parameters')
+        rows, regressions = compare(results, baseline, args.tolerance)
+        for operation, metric, old, new, change in rows:
+            flag = '  REGRESSION' if change > args.tolerance else ''
+            print(f'{operation:<32} {metric:<12} {old:>10} -> {new:<10} {change:+.1%}{flag}')
+        if regressions and args.fail_on_regression:
+            raise SystemExit(f'{len(regressions)} regressions over {args.tolerance:.0%}')
+
+
+if __name__ == '__main__':
+    main()
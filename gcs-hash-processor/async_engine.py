@@ -0,0 +1,268 @@
+import asyncio
+import hashlib
+import json
+import os
+import urllib.parse
+import uuid
+
+import aiohttp
+import google.auth
+import google.auth.transport.requests
+
+import metrics
+from scheduler import AsyncBulkScheduler, backoff, is_retryable
+
+SCOPES = ['https://www.googleapis.com/auth/devstorage.read_write']
+
+
+class StorageError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f'{status}: {message}')
+        self.status = status
+
+
+def _quote(name):
+    return urllib.parse.quote(name, safe='')
+
+
+class AsyncStorage:
+    """Minimal asyncio client for the GCS JSON API calls bulk jobs make.
+
+    All requests share one aiohttp connection pool and go through
+    ``scheduler`` (a scheduler.AsyncBulkScheduler), which adapts how many
+    are in flight, caps their rate and retries them.
+    ``download_concurrency`` bounds how many objects are downloaded at the
+    same time, which together with the chunk size bounds memory. Honours
+    STORAGE_EMULATOR_HOST like google-cloud-storage does, in which case no
+    credentials are used.
+    """
+
+    def __init__(self, scheduler=None, download_concurrency=32):
+        self.scheduler = scheduler or AsyncBulkScheduler()
+        self.base_url = os.environ.get('STORAGE_EMULATOR_HOST', 'https://storage.googleapis.com').rstrip('/')
+        if '://' not in self.base_url:
+            self.base_url = f'http://{self.base_url}'
+        self.request_count = 0
+        self._downloads = asyncio.Semaphore(download_concurrency)
+        self._credentials = None
+        self._credentials_lock = asyncio.Lock()
+        self._session = None
+
+    async def __aenter__(self):
+        limit = self.scheduler.maximum
+        connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit)
+        self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=300))
+        if 'STORAGE_EMULATOR_HOST' not in os.environ:
+            self._credentials, _ = google.auth.default(scopes=SCOPES)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self._session.close()
+
+    async def _auth_headers(self):
+        if self._credentials is None:
+            return {}
+        async with self._credentials_lock:
+            if not self._credentials.valid:
+                await asyncio.to_thread(self._credentials.refresh, google.auth.transport.requests.Request())
+        return {'Authorization': f'Bearer {self._credentials.token}'}
+
+    async def request(self, method, path, params=None, json_body=None, data=None, headers=None, raw=False,
+                      kind='request', size=0):
+        """Send one request through the scheduler as a request of type
+        ``kind`` moving about ``size`` bytes."""
+        url = path if path.startswith('http') else f'{self.base_url}{path}'
+
+        async def send():
+            request_headers = {**(headers or {}), **(await self._auth_headers())}
+            self.request_count += 1
+            try:
+                async with self._session.request(method, url, params=params, json=json_body, data=data,
+                                                 headers=request_headers) as response:
+                    body = await response.read()
+                    if response.status < 300:
+                        if raw:
+                            return response.headers, body
+                        return json.loads(body) if body else None
+                    raise StorageError(response.status, body[:200].decode(errors='replace'))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                raise StorageError(0, str(exc) or type(exc).__name__) from exc
+
+        return await self.scheduler.call(kind, send, size)
+
+    async def list_pages(self, bucket, page_token=None, prefix=None, start_offset=None, end_offset=None):
+        """Yield (items, next_page_token) for each page of the bucket listing."""
+        params = {'projection': 'full'}
+        for key, value in (('prefix', prefix), ('startOffset', start_offset), ('endOffset', end_offset)):
+            if value:
+                params[key] = value
+        while True:
+            if page_token:
+                params['pageToken'] = page_token
+            with metrics.stage('list') as span:
+                page = await self.request('GET', f'/storage/v1/b/{bucket}/o', params=params, kind='list')
+                span.items = len(page.get('items', []))
+            page_token = page.get('nextPageToken')
+            yield page.get('items', []), page_token
+            if not page_token:
+                return
+
+    async def download_range(self, bucket, name, start, end, generation=None):
+        params = {'alt': 'media'}
+        if generation:
+            params['generation'] = generation
+        with metrics.stage('download') as span:
+            _, body = await self.request('GET', f'/download/storage/v1/b/{bucket}/o/{_quote(name)}', params=params,
+                                         headers={'Range': f'bytes={start}-{end}'}, raw=True,
+                                         kind='download', size=end - start + 1)
+            span.nbytes = len(body)
+        return body
+
+    async def hash_object(self, bucket, resource, algorithms, chunk_size, chunker=None):
+        """Hash an object with ranged reads, fetching the next chunk while the
+        current one is hashed off the event loop. Holds at most two chunks.
+
+        The content is also fed to ``chunker`` (a chunking.Chunker), if any.
+        """
+        size = int(resource['size'])
+        generation = resource.get('generation')
+        hashers = [hashlib.new(name) for name in algorithms]
+
+        def update(chunk):
+            with metrics.stage('hash', nbytes=len(chunk)):
+                for hasher in hashers:
+                    hasher.update(chunk)
+            if chunker is not None:
+                with metrics.stage('chunk', nbytes=len(chunk)):
+                    chunker.update(chunk)
+
+        async with self._downloads:
+            ranges = [(start, min(start + chunk_size, size) - 1) for start in range(0, size, chunk_size)]
+            pending = None
+            for position, (start, end) in enumerate(ranges):
+                if pending is None:
+                    pending = asyncio.ensure_future(self.download_range(bucket, resource['name'], start, end, generation))
+                chunk = await pending
+                pending = None
+                if position + 1 < len(ranges):
+                    next_start, next_end = ranges[position + 1]
+                    pending = asyncio.ensure_future(
+                        self.download_range(bucket, resource['name'], next_start, next_end, generation))
+                await asyncio.to_thread(update, chunk)
+        if chunker is not None:
+            chunker.finish()
+        return {name: hasher.hexdigest() for name, hasher in zip(algorithms, hashers)}
+
+    async def batch_patch(self, bucket, items):
+        """Patch the custom metadata of up to 100 objects in one batch request.
+
+        ``items`` are (name, metadata, generation) tuples. Returns one
+        (status, resource_or_error) pair per item, in order.
+        """
+        boundary = f'batch_{uuid.uuid4().hex}'
+        parts = []
+        for position, (name, metadata, generation) in enumerate(items):
+            query = f'?ifGenerationMatch={generation}' if generation else ''
+            body = json.dumps({'metadata': metadata})
+            parts.append(
+                f'--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <item{position}>\r\n\r\n'
+                f'PATCH /storage/v1/b/{bucket}/o/{_quote(name)}{query} HTTP/1.1\r\n'
+                f'Content-Type: application/json; charset=UTF-8\r\nContent-Length: {len(body)}\r\n\r\n'
+                f'{body}\r\n')
+        payload = ''.join(parts) + f'--{boundary}--\r\n'
+        with metrics.stage('patch', items=len(items)):
+            headers, body = await self.request(
+                'POST', '/batch/storage/v1', data=payload.encode(),
+                headers={'Content-Type': f'multipart/mixed; boundary={boundary}'}, raw=True, kind='patch')
+
+        # Split on the boundary directly; email.parser costs more CPU than the
+        # rest of the batch handling put together.
+        response_boundary = headers['Content-Type'].split('boundary=', 1)[1].strip('"').encode()
+        results = [(0, 'missing from batch response')] * len(items)
+        for position, part in enumerate(body.split(b'--' + response_boundary)[1:-1]):
+            part = part.replace(b'\r\n', b'\n')
+            part_headers, _, response = part.lstrip(b'\n').partition(b'\n\n')
+            content_id = part_headers.partition(b'Content-ID:')[2].split(b'\n', 1)[0]
+            if b'item' in content_id:
+                position = int(content_id.rsplit(b'item', 1)[1].strip().rstrip(b'>'))
+            status_line, _, rest = response.lstrip(b'\n').partition(b'\n')
+            _, _, response_body = rest.partition(b'\n\n')
+            status = int(status_line.split()[1])
+            try:
+                results[position] = (status, json.loads(response_body))
+            except ValueError:
+                results[position] = (status, response_body.decode(errors='replace'))
+        return results
+
+
+class AsyncBatchPatcher:
+    """Queues metadata patches and sends them as concurrent batch requests.
+
+    Items that fail with a retryable status inside a batch are queued again,
+    after a jittered backoff, up to ``max_attempts`` times, and count as
+    congestion for the storage's scheduler even though the batch request
+    itself succeeded. ``on_patched`` receives the updated resource of every
+    successful patch.
+    """
+
+    def __init__(self, storage, bucket, batch_size=100, max_attempts=5, on_patched=None):
+        self.storage = storage
+        self.bucket = bucket
+        self.batch_size = min(batch_size, 100)
+        self.max_attempts = max_attempts
+        self.on_patched = on_patched
+        self._pending = []
+        self._tasks = set()
+        self._patched = 0
+        self._failed = []
+
+    def add(self, name, metadata, generation=None, attempt=1):
+        self._pending.append((name, metadata, generation, attempt))
+        if len(self._pending) >= self.batch_size:
+            self._submit()
+
+    def _submit(self):
+        if self._pending:
+            items, self._pending = self._pending, []
+            self._tasks.add(asyncio.ensure_future(self._send(items)))
+            metrics.QUEUE_DEPTH.labels('patch_batches').set(len(self._tasks))
+
+    async def _send(self, items):
+        try:
+            results = await self.storage.batch_patch(self.bucket, [item[:3] for item in items])
+            throttled = sum(status in (429, 503) for status, _ in results)
+            if throttled:
+                self.storage.scheduler.congested(throttled)
+        except StorageError as exc:
+            results = [(exc.status, str(exc))] * len(items)
+        retry = []
+        for (name, metadata, generation, attempt), (status, resource) in zip(items, results):
+            if 200 <= status < 300:
+                self._patched += 1
+                if self.on_patched is not None:
+                    self.on_patched(resource)
+            elif is_retryable(status) and attempt < self.max_attempts:
+                retry.append((name, metadata, generation, attempt + 1))
+            else:
+                print(f'{name} metadata patch failed: {status} {resource}')
+                self._failed.append(name)
+        if retry:
+            await asyncio.sleep(backoff(retry[0][3]))
+            for item in retry:
+                self.add(*item)
+            self._submit()
+
+    async def flush(self):
+        """Send everything queued, including retries, and wait for it.
+
+        Returns (patched, failed_names) since the previous flush.
+        """
+        self._submit()
+        while self._tasks:
+            tasks, self._tasks = self._tasks, set()
+            await asyncio.gather(*tasks)
+            self._submit()
+        metrics.QUEUE_DEPTH.labels('patch_batches').set(0)
+        patched, failed = self._patched, self._failed
+        self._patched, self._failed = 0, []
+        return patched, failed
@@ -0,0 +1,116 @@
+"""Benchmark find_duplicates against the previous dict-of-lists grouping.
+
+Rows are generated lazily, as an index cursor would yield them, so peak RSS
+reflects the grouping itself. Each run happens in a fresh process.
+
+    python benchmarks/bench_duplicates.py --sizes 100000,1000000,10000000
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def synthetic_rows(count, duplicate_ratio=0.01, seed=0):
+    """Yield (name, size, file_hash) rows where roughly duplicate_ratio of
+    the files reuse the content or the basename of an earlier file."""
+    step = max(int(1 / duplicate_ratio), 1) if duplicate_ratio else 0
+    for i in range(count):
+        content = i
+        basename = i
+        if step and i % step == 1:
+            content = i - 1
+        if step and i % step == 2:
+            basename = i - 2
+        if step and i % step == 3:
+            content = basename = i - 3
+        digest = hashlib.md5(f'{seed}:{content}'.encode()).hexdigest()
+        yield f'run{i % 997}/plate{i % 31}/image{basename}.tif', 1000 + content % 5000, digest
+
+
+def legacy_find_identical_files(rows):
+    files = [{'name': name, 'size': str(size), 'hash': file_hash} for name, size, file_hash in rows]
+    file_groups = defaultdict(list)
+    for file in files:
+        file_groups[(file['hash'], file['size'])].append(file)
+    results = defaultdict(list)
+    for files_in_group in file_groups.values():
+        if len(files_in_group) > 1:
+            name_groups = defaultdict(list)
+            for file in files_in_group:
+                name_groups[os.path.basename(file['name'])].append(file)
+            for group in name_groups.values():
+                if len(group) > 1:
+                    results['identical_content_and_name'].append(group)
+            if len(name_groups) > 1:
+                results['identical_content_different_name'].append(files_in_group)
+    name_groups = defaultdict(list)
+    for file in files:
+        name_groups[os.path.basename(file['name'])].append(file)
+    for group in name_groups.values():
+        if len(group) > 1 and len(set((file['hash'], file['size']) for file in group)) > 1:
+            results['identical_name_different_content'].append(group)
+    return results
+
+
+def run(engine, count, duplicate_ratio, queue):
+    from duplicates import find_duplicates
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    if engine == 'legacy':
+        results = legacy_find_identical_files(synthetic_rows(count, duplicate_ratio))
+    else:
+        results = find_duplicates(synthetic_rows(count, duplicate_ratio))
+    elapsed = time.perf_counter() - started
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({
+        'engine': engine,
+        'rows': count,
+        'seconds': round(elapsed, 2),
+        'rows_per_sec': int(count / elapsed),
+        'rss_growth_mb': round((peak_rss - baseline_rss) / 1024, 1),
+        'groups': {key: len(results[key]) for key in
+                   ('identical_content_and_name', 'identical_content_different_name',
+                    'identical_name_different_content')},
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='100000,1000000,10000000')
+    parser.add_argument('--legacy-max', type=int, default=1000000,
+                        help='skip the legacy engine above this many rows')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.01)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for count in (int(size) for size in args.sizes.split(',')):
+        for engine in ('legacy', 'columnar'):
+            if engine == 'legacy' and count > args.legacy_max:
+                continue
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run, args=(engine, count, args.duplicate_ratio, queue))
+            proc.start()
+            results.append(queue.get())
+            proc.join()
+            if not args.json:
+                r = results[-1]
+                print(f"{r['rows']:>10} rows  {r['engine']:<9} {r['seconds']:>8}s  {r['rows_per_sec']:>9} rows/s  "
+                      f"+{r['rss_growth_mb']} MiB  groups {r['groups']}")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""Benchmark the async and thread-pool engines of the bucket-wide jobs.
+
+A fake GCS server (benchmarks/fake_gcs.py at the repository root) runs in
+its own process with synthetic objects and optional per-request latency.
+Each engine then runs process-all and remove-all against it in a fresh
+process. Reports wall time, objects/s, requests/s as seen by the server and
+CPU seconds spent per object by the service process.
+
+    python benchmarks/bench_engines.py --objects 5000 --latency 0.02
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(HERE)), 'benchmarks'))
+
+BUCKET = 'bench-bucket'
+
+
+def serve(objects, size, latency, queue):
+    from fake_gcs import FakeGCSServer, FaultInjector
+
+    server = FakeGCSServer(faults=FaultInjector(latency=latency))
+    for i in range(objects):
+        server.add_synthetic_object(BUCKET, f'plate{i % 50}/image{i}.tif', size, seed=i % 16)
+    queue.put(server.url)
+    server.serve_forever()
+
+
+def server_requests(url):
+    with urllib.request.urlopen(f'{url}/_fake/stats') as response:
+        return json.load(response)['request_count']
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(engine, url, hash_mode, num_threads, queue):
+    os.environ['STORAGE_EMULATOR_HOST'] = url
+    os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'bench')
+    os.environ['HASH_INDEX_PATH'] = os.path.join(tempfile.mkdtemp(), 'index.sqlite3')
+    # The per-file log lines would dominate the comparison
+    sys.stdout = open(os.devnull, 'w')
+    import main
+
+    results = []
+    for job in ('process-all', 'remove-all'):
+        requests_before = server_requests(url)
+        cpu_before = cpu_seconds()
+        started = time.perf_counter()
+        if job == 'process-all':
+            if engine == 'async':
+                state = main.run_process_all_job(BUCKET, hash_mode, f'bench-{engine}', engine)
+            else:
+                state = main.process_all_files(BUCKET, num_threads, hash_mode, f'bench-{engine}')
+            objects = state['files_processed']
+            failed = state['files_failed']
+        elif engine == 'async':
+            import asyncio
+            _, objects, failed, _ = asyncio.run(main.remove_all_file_hash_metadata_async(BUCKET))
+            failed = len(failed)
+        else:
+            _, objects, failed, _ = main.remove_all_file_hash_metadata_threads(BUCKET, num_threads)
+            failed = len(failed)
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds() - cpu_before
+        requests = server_requests(url) - requests_before
+        results.append({
+            'engine': engine,
+            'job': job,
+            'objects': objects,
+            'failed': failed,
+            'seconds': round(elapsed, 2),
+            'objects_per_sec': round(objects / elapsed, 1),
+            'requests': requests,
+            'requests_per_sec': round(requests / elapsed, 1),
+            'cpu_ms_per_object': round(1000 * cpu / objects, 3) if objects else None,
+        })
+    queue.put(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--objects', type=int, default=5000)
+    parser.add_argument('--size', type=int, default=64 * 1024, help='bytes per object')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds the fake adds to every request')
+    parser.add_argument('--hash-mode', default='download', choices=('download', 'server', 'server_crc32c'))
+    parser.add_argument('--num-threads', type=int, default=10, help='workers of the threads engine')
+    parser.add_argument('--engines', default='threads,async')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for engine in args.engines.split(','):
+        # A fresh server per engine, so both start from unhashed objects
+        url_queue = ctx.Queue()
+        server = ctx.Process(target=serve, args=(args.objects, args.size, args.latency, url_queue), daemon=True)
+        server.start()
+        url = url_queue.get()
+
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run, args=(engine, url, args.hash_mode, args.num_threads, queue))
+        proc.start()
+        results.extend(queue.get())
+        proc.join()
+        server.terminate()
+
+        if not args.json:
+            for r in results[-2:]:
+                print(f"{r['engine']:<8} {r['job']:<12} {r['objects']:>7} objects  {r['seconds']:>7}s  "
+                      f"{r['objects_per_sec']:>8} obj/s  {r['requests_per_sec']:>8} req/s  "
+                      f"{r['cpu_ms_per_object']} ms CPU/object  ({r['failed']} failed)")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""Compare the legacy /tmp hashing path with the streaming ranged-read path,
+and the cost of content-defined chunking in the same pass.
+
+Each run happens in a fresh process so that peak RSS is measured per mode.
+The blob is synthetic: its bytes are generated on demand, so the benchmark
+process itself never holds the whole object. Peak RSS does not include
+/tmp, but on Cloud Run /tmp is memory-backed, so the legacy path's
+`tmp_bytes_written` counts against the container memory limit as well.
+
+    python benchmarks/bench_hashing.py --size-mb 1024 --chunk-mb 8
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+PATTERN = random.Random(0).randbytes(1024 * 1024)
+
+
+class SyntheticBlob:
+    """Minimal stand-in for storage.Blob serving deterministic bytes."""
+
+    def __init__(self, size):
+        self.name = 'synthetic.bin'
+        self.size = size
+
+    def _read(self, start, end):
+        out = bytearray()
+        pos = start
+        while pos <= end:
+            offset = pos % len(PATTERN)
+            take = min(len(PATTERN) - offset, end - pos + 1)
+            out += PATTERN[offset:offset + take]
+            pos += take
+        return bytes(out)
+
+    def reload(self):
+        pass
+
+    def download_as_bytes(self, start=None, end=None, checksum=None):
+        return self._read(start or 0, self.size - 1 if end is None else end)
+
+    def download_to_filename(self, filename):
+        with open(filename, 'wb') as f:
+            for start in range(0, self.size, len(PATTERN)):
+                f.write(self._read(start, min(start + len(PATTERN), self.size) - 1))
+
+
+def legacy_calculate_file_hash(blob):
+    hash_md5 = hashlib.md5()
+    temp_file = f'/tmp/{uuid.uuid4().hex}'
+    try:
+        blob.download_to_filename(temp_file)
+        with open(temp_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(4096), b""):
+                hash_md5.update(chunk)
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+    return hash_md5.hexdigest()
+
+
+def run_mode(mode, size, chunk_size, algorithms, queue):
+    from main import calculate_file_hashes, new_chunker
+
+    blob = SyntheticBlob(size)
+    chunker = new_chunker() if mode == 'chunking' else None
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    if mode == 'legacy':
+        digests = {'md5': legacy_calculate_file_hash(blob)}
+    else:
+        digests = calculate_file_hashes(blob, algorithms, chunk_size, chunker)
+    elapsed = time.perf_counter() - started
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({
+        'mode': mode,
+        'algorithms': list(digests),
+        'seconds': round(elapsed, 3),
+        'mb_per_sec': round(size / elapsed / 2**20, 1),
+        'peak_rss_mb': round(peak_rss / 1024, 1),
+        'rss_growth_mb': round((peak_rss - baseline_rss) / 1024, 1),
+        'tmp_bytes_written': size if mode == 'legacy' else 0,
+        'md5': digests['md5'],
+        # The synthetic object repeats every MiB, so most chunks repeat too
+        'chunks': chunker.count if chunker else None,
+        'unique_chunks': len(chunker.chunks) if chunker else None,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=512)
+    parser.add_argument('--chunk-mb', type=int, default=8)
+    parser.add_argument('--algorithms', default='md5,sha256,blake2b')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    size = args.size_mb * 2**20
+    chunk_size = args.chunk_mb * 2**20
+    extra = tuple(args.algorithms.split(','))
+    runs = [('legacy', ('md5',)), ('streaming', ('md5',)), ('streaming', extra), ('chunking', ('md5',))]
+
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for mode, algorithms in runs:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=run_mode, args=(mode, size, chunk_size, algorithms, queue))
+        proc.start()
+        results.append(queue.get())
+        proc.join()
+
+    if len({r['md5'] for r in results}) != 1:
+        raise SystemExit('digest mismatch between modes')
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'object size: {args.size_mb} MiB, chunk size: {args.chunk_mb} MiB')
+    for r in results:
+        print(f"{r['mode']:<10} {','.join(r['algorithms']):<20} {r['mb_per_sec']:>8} MiB/s  "
+              f"peak RSS {r['peak_rss_mb']:>7} MiB (+{r['rss_growth_mb']})  /tmp writes {r['tmp_bytes_written'] // 2**20} MiB")
+
+
+if __name__ == '__main__':
+    main()
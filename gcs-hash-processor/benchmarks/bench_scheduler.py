@@ -0,0 +1,150 @@
+"""Benchmark the bulk scheduler against a fake GCS that enforces a quota.
+
+The fake (benchmarks/fake_gcs.py at the repository root) answers 429 to
+requests beyond --max-rps per second and 503 to requests arriving while
+--max-concurrent are in flight, and each request in flight slows the
+others down. Each engine runs process-all and remove-all under three
+scheduler settings, each in a fresh process against a fresh server:
+
+    fixed     - concurrency pinned at the maximum, as before the scheduler
+    adaptive  - AIMD on latency and errors
+    capped    - AIMD plus BULK_MAX_RPS at 90% of the quota
+
+Reports objects/s, the 429s and 503s the server sent, retries, objects
+that failed for good and how the concurrency limit moved.
+
+    python benchmarks/bench_scheduler.py --objects 2000 --max-rps 400 --max-concurrent 24
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(HERE)), 'benchmarks'))
+
+BUCKET = 'bench-bucket'
+SCENARIOS = ('fixed', 'adaptive', 'capped')
+
+
+def serve(objects, size, faults, queue):
+    from fake_gcs import FakeGCSServer, FaultInjector
+
+    server = FakeGCSServer(faults=FaultInjector(**faults))
+    for i in range(objects):
+        server.add_synthetic_object(BUCKET, f'plate{i % 50}/image{i}.tif', size, seed=i % 16)
+    queue.put(server.url)
+    server.serve_forever()
+
+
+def server_stats(url):
+    with urllib.request.urlopen(f'{url}/_fake/stats') as response:
+        return json.load(response)
+
+
+def run(scenario, engine, url, max_rps, num_threads, queue):
+    os.environ['STORAGE_EMULATOR_HOST'] = url
+    os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'bench')
+    os.environ['HASH_INDEX_PATH'] = os.path.join(tempfile.mkdtemp(), 'index.sqlite3')
+    if scenario == 'capped':
+        os.environ['BULK_MAX_RPS'] = str(0.9 * max_rps)
+    # The per-file log lines would dominate the comparison
+    sys.stdout = open(os.devnull, 'w')
+    import asyncio
+    import main
+
+    if scenario == 'fixed':
+        def pinned(maximum, scheduler_class=main.BulkScheduler):
+            # A minimum equal to the maximum keeps the limit where it starts
+            return scheduler_class(maximum, maximum, maximum, 0, 0, main.BULK_MAX_ATTEMPTS)
+        main.new_scheduler = pinned
+
+    results = []
+    for job in ('process-all', 'remove-all'):
+        before = server_stats(url)
+        started = time.perf_counter()
+        if job == 'process-all':
+            if engine == 'async':
+                state = asyncio.run(main.process_all_files_async(BUCKET, 'download', f'bench-{scenario}'))
+            else:
+                state = main.process_all_files(BUCKET, num_threads, 'download', f'bench-{scenario}')
+            objects, failed, throughput = state['files_processed'], state['files_failed'], state['throughput']
+        else:
+            if engine == 'async':
+                _, objects, failed, throughput = asyncio.run(main.remove_all_file_hash_metadata_async(BUCKET))
+            else:
+                _, objects, failed, throughput = main.remove_all_file_hash_metadata_threads(BUCKET, num_threads)
+            failed = len(failed)
+        elapsed = time.perf_counter() - started
+        after = server_stats(url)
+        concurrency = throughput['concurrency']
+        results.append({
+            'scenario': scenario,
+            'engine': engine,
+            'job': job,
+            'objects': objects,
+            'failed': failed,
+            'seconds': round(elapsed, 2),
+            'objects_per_sec': round(objects / elapsed, 1),
+            'requests_per_sec': round((after['request_count'] - before['request_count']) / elapsed, 1),
+            'server_throttled': after['requests_throttled'] - before['requests_throttled'],
+            'retries': throughput['retries'],
+            'limit': concurrency['limit'],
+            'lowest_limit': concurrency['lowest'],
+            'highest_limit': concurrency['highest'],
+        })
+    queue.put(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--objects', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=16 * 1024, help='bytes per object')
+    parser.add_argument('--max-rps', type=int, default=400, help='quota of the fake, in requests per second')
+    parser.add_argument('--max-concurrent', type=int, default=24, help='requests the fake serves at once')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds the fake adds to every request')
+    parser.add_argument('--latency-per-request', type=float, default=0.002,
+                        help='seconds each request in flight adds to the others')
+    parser.add_argument('--num-threads', type=int, default=64, help='maximum of the threads engine')
+    parser.add_argument('--engines', default='async,threads')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    faults = {'latency': args.latency, 'latency_per_request': args.latency_per_request,
+              'max_rps': args.max_rps, 'max_concurrent': args.max_concurrent}
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for engine in args.engines.split(','):
+        for scenario in args.scenarios.split(','):
+            url_queue = ctx.Queue()
+            server = ctx.Process(target=serve, args=(args.objects, args.size, faults, url_queue), daemon=True)
+            server.start()
+            url = url_queue.get()
+
+            queue = ctx.Queue()
+            proc = ctx.Process(target=run, args=(scenario, engine, url, args.max_rps, args.num_threads, queue))
+            proc.start()
+            results.extend(queue.get())
+            proc.join()
+            server.terminate()
+
+            if not args.json:
+                for r in results[-2:]:
+                    print(f"{r['engine']:<8} {r['scenario']:<9} {r['job']:<12} {r['objects']:>6} objects  "
+                          f"{r['seconds']:>7}s  {r['objects_per_sec']:>7} obj/s  {r['requests_per_sec']:>7} req/s  "
+                          f"{r['server_throttled']:>6} throttled  {r['retries']:>6} retries  "
+                          f"{r['failed']:>4} failed  limit {r['lowest_limit']}-{r['highest_limit']} "
+                          f"(ends at {r['limit']})")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
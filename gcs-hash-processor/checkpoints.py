@@ -0,0 +1,35 @@
+import json
+from datetime import datetime, timezone
+
+# Job state lives next to the data, like the file browser's
+# .bucket.dashboard-settings.json, so it survives instance recycling.
+STATE_PREFIX = '.gcs-hash-processor/'
+
+
+def is_state_object(name):
+    return name.startswith(STATE_PREFIX)
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class CheckpointStore:
+    """Persists batch job checkpoints as small JSON objects in a bucket."""
+
+    def __init__(self, client, bucket_name):
+        self.bucket = client.bucket(bucket_name)
+
+    def _blob(self, job_id):
+        return self.bucket.blob(f'{STATE_PREFIX}jobs/{job_id}.json')
+
+    def load(self, job_id):
+        blob = self._blob(job_id)
+        if not blob.exists():
+            return None
+        return json.loads(blob.download_as_bytes())
+
+    def save(self, state):
+        state['updated_at'] = now_iso()
+        self._blob(state['job_id']).upload_from_string(
+            json.dumps(state), content_type='application/json')
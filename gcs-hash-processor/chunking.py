@@ -0,0 +1,207 @@
+import hashlib
+import itertools
+from collections import defaultdict
+
+import numpy as np
+
+# Gear table of the rolling hash. It is derived from a fixed digest rather
+# than a random seed because chunk fingerprints are stored and compared
+# across runs and instances.
+GEAR = np.frombuffer(b''.join(hashlib.sha256(bytes([value])).digest()[:8] for value in range(256)), dtype='<u8')
+
+# Bytes whose rolling hash is computed at once; small enough for the
+# arrays to stay in cache, which is several times faster than larger blocks
+SCAN_BLOCK = 64 * 1024
+# A gear hash only depends on the last 64 bytes
+WINDOW = 64
+
+
+def _gear_hashes(data, scratch):
+    """Rolling gear hash after each byte of ``data`` (a uint8 array).
+
+    Equal to FastCDC's ``fp = (fp << 1) + GEAR[byte]`` started at the first
+    byte, computed by doubling the window six times instead of looping over
+    bytes: the hash over 2m bytes is the hash over the last m bytes plus the
+    one over the m before them shifted left by m. ``scratch`` is a uint64
+    array at least as long as ``data``.
+    """
+    hashes = GEAR[data]
+    n = len(hashes)
+    for shift in (1, 2, 4, 8, 16, 32):
+        if shift >= n:
+            break
+        np.left_shift(hashes[:-shift], np.uint64(shift), out=scratch[:n - shift])
+        np.add(hashes[shift:], scratch[:n - shift], out=hashes[shift:])
+    return hashes
+
+
+def _mask_limit(bits):
+    # FastCDC tests the top ``bits`` bits, which depend on the whole window
+    # (the low bits only on the last few bytes); all of them are zero
+    # exactly when the hash is below this
+    return np.uint64(1 << (64 - bits))
+
+
+class Chunker:
+    """FastCDC-style content-defined chunking of a byte stream.
+
+    Data is fed with update() in pieces of any size, in a single pass, and
+    split where the rolling hash matches a mask, so an insertion or a
+    changed header only changes the chunks around it. Normalized chunking
+    uses a harder mask before ``avg_size`` and an easier one after it; chunks
+    are between ``min_size`` and ``max_size`` bytes.
+
+    Each chunk is fingerprinted with a 16-byte BLAKE2b digest. ``chunks``
+    maps fingerprints to [length, occurrences], so memory is bounded by the
+    piece being fed, one chunk of carry-over and the distinct fingerprints,
+    not by the object.
+    """
+
+    def __init__(self, avg_size=64 * 1024, min_size=None, max_size=None):
+        bits = avg_size.bit_length() - 1
+        if avg_size != 1 << bits or bits < 8:
+            raise ValueError('avg_size must be a power of two of at least 256')
+        self.avg_size = avg_size
+        self.min_size = min_size or avg_size // 4
+        self.max_size = max_size or avg_size * 8
+        if not WINDOW <= self.min_size <= avg_size <= self.max_size:
+            raise ValueError('chunk sizes must satisfy 64 <= min_size <= avg_size <= max_size')
+        self._limit_hard = _mask_limit(bits + 2)
+        self._limit_easy = _mask_limit(bits - 2)
+        self._scratch = np.empty(SCAN_BLOCK + WINDOW, dtype=np.uint64)
+        self._tail = b''
+        self.chunks = {}
+        self.count = 0
+        self.size = 0
+
+    @property
+    def params(self):
+        """Identifies the chunk boundaries; fingerprints are only comparable
+        between objects chunked with the same params."""
+        return f'fastcdc-{self.min_size}-{self.avg_size}-{self.max_size}'
+
+    def update(self, data):
+        buffer = self._tail + bytes(data) if self._tail else bytes(data)
+        self._tail = buffer[self._split(buffer, final=False):]
+
+    def finish(self):
+        """Emit the last chunk; returns the chunker."""
+        if self._tail:
+            self._split(self._tail, final=True)
+            self._tail = b''
+        return self
+
+    def _candidates(self, buffer):
+        """Positions in ``buffer`` (which starts at a chunk boundary) after
+        which the rolling hash matches the hard and the easy mask."""
+        data = np.frombuffer(buffer, dtype=np.uint8)
+        hard, easy = [], []
+        for start in range(0, len(data), SCAN_BLOCK):
+            # The bytes before the block give the first hashes their window
+            context = min(start, WINDOW - 1)
+            hashes = _gear_hashes(data[start - context:start + SCAN_BLOCK], self._scratch)[context:]
+            # Every hash matching the hard mask matches the easy one
+            matches = np.flatnonzero(hashes < self._limit_easy)
+            easy.append(matches + start)
+            hard.append(matches[hashes[matches] < self._limit_hard] + start)
+        return (np.concatenate(hard) if hard else np.empty(0, np.int64),
+                np.concatenate(easy) if easy else np.empty(0, np.int64))
+
+    def _cut(self, candidates, start, end, final):
+        """End of the chunk starting at ``start``, or None when it depends on
+        bytes after ``end`` that have not arrived yet.
+
+        Candidates are only considered from ``min_size`` bytes into the
+        chunk, where the hash window lies entirely within it, so hashes
+        computed across a previous boundary are the same as FastCDC's.
+        """
+        hard, easy = candidates
+        bounds = ((hard, start + self.min_size - 1, start + self.avg_size - 1),
+                  (easy, start + self.avg_size - 1, start + self.max_size - 1))
+        for positions, low, high in bounds:
+            index = np.searchsorted(positions, low)
+            if index < len(positions) and positions[index] < high:
+                return int(positions[index]) + 1
+            if end < high:
+                return end if final else None
+        return start + self.max_size
+
+    def _split(self, buffer, final):
+        """Emit the chunks ``buffer`` determines; returns the bytes consumed."""
+        candidates = self._candidates(buffer)
+        view = memoryview(buffer)
+        start = 0
+        while start < len(buffer):
+            end = self._cut(candidates, start, len(buffer), final)
+            if end is None:
+                break
+            self._add(view[start:end])
+            start = end
+        return start
+
+    def _add(self, chunk):
+        fingerprint = hashlib.blake2b(chunk, digest_size=16).digest()
+        entry = self.chunks.get(fingerprint)
+        if entry is None:
+            self.chunks[fingerprint] = [len(chunk), 1]
+        else:
+            entry[1] += 1
+        self.count += 1
+        self.size += len(chunk)
+
+
+def shared_chunk_pairs(rows, min_ratio=0.5, max_fanout=100):
+    """Pairs of objects that share chunks, from the chunk index.
+
+    ``rows`` are (fingerprint, name, length, count) ordered by fingerprint,
+    as HashIndex.iter_chunks yields them. A pair's ``shared_bytes`` are the
+    bytes of chunks both objects contain, and its ``shared_ratio`` the part
+    of the smaller object they cover, so a file that only gained appended
+    frames or a new header scores close to 1 against its original. Pairs
+    below ``min_ratio`` are left out.
+
+    Chunks held by more than ``max_fanout`` objects (zero-filled blocks,
+    common headers) are not paired, which would be quadratic in their
+    holders; they still count towards ``reclaimable_bytes``: the bytes a
+    store keeping each distinct chunk once would save over the chunked
+    objects.
+    """
+    sizes = defaultdict(int)
+    shared = defaultdict(int)
+    counts = {'chunks': 0, 'unique_chunks': 0, 'chunked_bytes': 0, 'unique_bytes': 0,
+              'chunks_over_fanout': 0}
+    for _, group in itertools.groupby(rows, key=lambda row: row[0]):
+        group = list(group)
+        length = group[0][2]
+        holders = [(name, count) for _, name, _, count in group]
+        occurrences = sum(count for _, count in holders)
+        for name, count in holders:
+            sizes[name] += length * count
+        counts['chunks'] += occurrences
+        counts['unique_chunks'] += 1
+        counts['chunked_bytes'] += length * occurrences
+        counts['unique_bytes'] += length
+        if len(holders) > max_fanout:
+            counts['chunks_over_fanout'] += 1
+            continue
+        for (name1, count1), (name2, count2) in itertools.combinations(sorted(holders), 2):
+            shared[name1, name2] += length * min(count1, count2)
+
+    pairs = []
+    for (name1, name2), shared_bytes in shared.items():
+        ratio = shared_bytes / min(sizes[name1], sizes[name2])
+        if ratio >= min_ratio:
+            pairs.append({
+                'file1': name1,
+                'file2': name2,
+                'size1': sizes[name1],
+                'size2': sizes[name2],
+                'shared_bytes': shared_bytes,
+                'shared_ratio': round(ratio, 4)
+            })
+    pairs.sort(key=lambda pair: (-pair['shared_bytes'], pair['file1'], pair['file2']))
+
+    counts['chunked_files'] = len(sizes)
+    counts['similar_pairs'] = len(pairs)
+    counts['reclaimable_bytes'] = counts['chunked_bytes'] - counts['unique_bytes']
+    return {'pairs': pairs, 'counts': counts}
@@ -1,3 +1,10 @@
 #curl -X GET "https://gcs-hash-processor-46efresdxq-uc.a.run.app/find-identical-files?bucket=bacteria-collection-data"
 
 curl -X GET "https://gcs-hash-processor-46efresdxq-uc.a.run.app/compare-files-md5"
+
+# The 20 content duplicates wasting the most bytes under a prefix, then the next page
+#curl -X GET "https://gcs-hash-processor-46efresdxq-uc.a.run.app/find-identical-files?bucket=bacteria-collection-data&category=identical_content_different_name&sort=reclaimable&prefix=plate01/&min_size=1048576&limit=20"
+#curl -X GET "https://gcs-hash-processor-46efresdxq-uc.a.run.app/find-identical-files?bucket=bacteria-collection-data&category=identical_content_different_name&sort=reclaimable&prefix=plate01/&min_size=1048576&limit=20&cursor=<next_cursor>"
+
+# Revalidate a previous result; 304 while the bucket's index has not changed
+#curl -X GET -H 'If-None-Match: "<etag>"' "https://gcs-hash-processor-46efresdxq-uc.a.run.app/compare-files-md5?bucket=bacteria-collection-data"
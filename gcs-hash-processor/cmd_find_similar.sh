@@ -0,0 +1,4 @@
+# Chunk every large file (a separate job id, since the default one may have completed already)
+curl -X POST "https://gcs-hash-processor-46efresdxq-uc.a.run.app/process-bucket?bucket=bacteria-collection-data&chunking=true&job_id=process-all-chunking"
+
+curl -X GET "https://gcs-hash-processor-46efresdxq-uc.a.run.app/find-similar-files?bucket=bacteria-collection-data&min_ratio=0.5"
@@ -1 +1,5 @@
-curl -X GET https://gcs-hash-processor-46efresdxq-uc.a.run.app/process-bucket
+curl -X POST "https://gcs-hash-processor-46efresdxq-uc.a.run.app/process-bucket?bucket=bacteria-collection-data"
+curl -X GET "https://gcs-hash-processor-46efresdxq-uc.a.run.app/jobs/process-all?bucket=bacteria-collection-data"
+# Split the bucket into 16 ranges, one Pub/Sub message each (SHARD_TOPIC), and follow the merged progress
+curl -X POST "https://gcs-hash-processor-46efresdxq-uc.a.run.app/process-bucket?bucket=bacteria-collection-data&shards=16&job_id=process-all-sharded"
+curl -X GET "https://gcs-hash-processor-46efresdxq-uc.a.run.app/jobs/process-all-sharded?bucket=bacteria-collection-data"
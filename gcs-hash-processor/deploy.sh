@@ -16,6 +16,7 @@ gcloud run deploy gcs-hash-processor \
   --memory 4Gi \
   --concurrency 80 \
   --timeout 3600 \
+  --no-cpu-throttling \
   --allow-unauthenticated
 
 #gcloud pubsub topics create gcs-file-updates
@@ -23,6 +24,10 @@ gcloud run deploy gcs-hash-processor \
 #gcloud run services update gcs-hash-processor \
 #  --set-env-vars PUBSUB_TOPIC=projects/hypherdata-cloud-prod/topics/gcs-file-updates \
 #  --region us-central1
+# Sharded process-all jobs publish their shards to a topic pushed to /pubsub
+#gcloud run services update gcs-hash-processor \
+#  --set-env-vars SHARD_TOPIC=projects/hypherdata-cloud-prod/topics/gcs-file-updates \
+#  --region us-central1
 #gcloud run services add-iam-policy-binding gcs-hash-processor \
 #  --member=serviceAccount:service-623119481046@gcp-sa-pubsub.iam.gserviceaccount.com \
 #  --role=roles/run.invoker \
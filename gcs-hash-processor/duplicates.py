@@ -0,0 +1,181 @@
+import hashlib
+from array import array
+
+import numpy as np
+
+CATEGORIES = (
+    'identical_content_and_name',
+    'identical_content_different_name',
+    'identical_name_different_content',
+)
+
+
+def _hash_key(file_hash):
+    """16-byte sort key for a file hash; md5 hex digests are stored as-is."""
+    if len(file_hash) == 32:
+        try:
+            return bytes.fromhex(file_hash), False
+        except ValueError:
+            pass
+    return hashlib.blake2b(file_hash.encode(), digest_size=16).digest(), True
+
+
+class FileColumns:
+    """Rows of (name, size, file_hash) stored as compact columns.
+
+    Names live in one byte arena addressed by offsets, hashes as 16-byte keys
+    and basenames as 64-bit keys, so 10M rows cost a few hundred bytes each
+    instead of a dict and list per file. Basename keys can collide, so
+    arrays() also returns a tiebreak that tells colliding basenames apart.
+    """
+
+    def __init__(self):
+        self._names = bytearray()
+        self._name_offsets = array('q', [0])
+        self._sizes = array('q')
+        self._hash_keys = bytearray()
+        self._basename_keys = array('q')
+        self._basename_starts = array('q')
+        # Hashes that are not plain md5 hex digests, by row, to report them verbatim
+        self._raw_hashes = {}
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def append(self, name, size, file_hash):
+        encoded = name.encode()
+        self._names += encoded
+        self._name_offsets.append(len(self._names))
+        self._sizes.append(size if size is not None else -1)
+        key, raw = _hash_key(file_hash)
+        if raw:
+            self._raw_hashes[len(self._sizes) - 1] = file_hash
+        self._hash_keys += key
+        basename = name.rpartition('/')[2]
+        self._basename_starts.append(len(self._names) - len(basename.encode()))
+        # Keys are only compared within this process, so the builtin 64-bit
+        # string hash will do; collisions are resolved in arrays()
+        self._basename_keys.append(hash(basename))
+
+    def name(self, row):
+        return self._names[self._name_offsets[row]:self._name_offsets[row + 1]].decode()
+
+    def file(self, row):
+        size = self._sizes[row]
+        return {
+            'name': self.name(row),
+            'size': str(size) if size >= 0 else 'unknown',
+            'hash': self._raw_hashes.get(row) or self._hash_keys[16 * row:16 * row + 16].hex()
+        }
+
+    def _basename(self, row):
+        return self._names[self._basename_starts[row]:self._name_offsets[row + 1]]
+
+    def _basename_tiebreaks(self, keys):
+        """Second basename key, nonzero for basenames whose key collides with
+        another's: within each run of equal keys, basenames are compared byte
+        for byte against the run's first one."""
+        tiebreaks = np.zeros(len(keys), dtype=np.int64)
+        order = np.argsort(keys, kind='stable')
+        starts, ends = _runs(keys[order])
+        shared = ends - starts > 1
+        for start, end in zip(starts[shared].tolist(), ends[shared].tolist()):
+            rows = order[start:end].tolist()
+            first = self._basename(rows[0])
+            others = {}
+            for row in rows[1:]:
+                basename = self._basename(row)
+                if basename != first:
+                    tiebreaks[row] = others.setdefault(bytes(basename), len(others) + 1)
+        return tiebreaks
+
+    def arrays(self):
+        """Return (hash_hi, hash_lo, size, basename_key, basename_tiebreak)
+        as NumPy arrays."""
+        hashes = np.frombuffer(self._hash_keys, dtype='>u8').reshape(-1, 2)
+        basename_keys = np.frombuffer(self._basename_keys, dtype=np.int64)
+        return (
+            hashes[:, 0],
+            hashes[:, 1],
+            np.frombuffer(self._sizes, dtype=np.int64),
+            basename_keys,
+            self._basename_tiebreaks(basename_keys),
+        )
+
+
+def _runs(*sorted_keys):
+    """Return (starts, ends) of runs of equal keys in already sorted arrays."""
+    n = len(sorted_keys[0])
+    change = np.zeros(n, dtype=bool)
+    if n:
+        change[0] = True
+    for key in sorted_keys:
+        change[1:] |= key[1:] != key[:-1]
+    starts = np.flatnonzero(change)
+    ends = np.append(starts[1:], n)
+    return starts, ends
+
+
+def _runs_per_group(group_starts, run_starts):
+    """Number of runs that begin inside each group (both sorted start offsets)."""
+    return np.diff(np.append(np.searchsorted(run_starts, group_starts), len(run_starts)))
+
+
+def find_duplicates(rows):
+    """Group (name, size, file_hash) rows into the three duplicate categories.
+
+    Makes a single pass over ``rows`` (a listing or an index cursor) into
+    FileColumns, then finds all groups by sorting the columns instead of
+    hashing each file into per-key lists:
+
+    - identical_content_and_name: same hash and size and the same basename,
+      one group per basename, counting every copy after the first;
+    - identical_content_different_name: same hash and size under more than
+      one basename, one group per content, counting every extra basename;
+    - identical_name_different_content: same basename with more than one
+      distinct (hash, size), counting every file after the first.
+    """
+    columns = FileColumns()
+    for name, size, file_hash in rows:
+        columns.append(name, size, file_hash)
+
+    results = {category: [] for category in CATEGORIES}
+    counts = {category: 0 for category in CATEGORIES}
+
+    def add(category, order, starts, ends, count):
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            results[category].append([columns.file(row) for row in order[start:end].tolist()])
+        counts[category] += int(count)
+
+    hash_hi, hash_lo, sizes, basenames, tiebreaks = columns.arrays()
+
+    # Sorted by content, then basename: content groups are runs of
+    # (hash, size) and basename groups inside them are runs of all five keys.
+    order = np.lexsort((tiebreaks, basenames, sizes, hash_lo, hash_hi))
+    content = (hash_hi[order], hash_lo[order], sizes[order])
+    content_starts, content_ends = _runs(*content)
+    named_starts, named_ends = _runs(*content, basenames[order], tiebreaks[order])
+
+    lengths = named_ends - named_starts
+    same = lengths > 1
+    add('identical_content_and_name', order, named_starts[same], named_ends[same], (lengths[same] - 1).sum())
+
+    basenames_per_content = _runs_per_group(content_starts, named_starts)
+    different = basenames_per_content > 1
+    add('identical_content_different_name', order, content_starts[different], content_ends[different],
+        (basenames_per_content[different] - 1).sum())
+    del order, content, content_starts, content_ends, named_starts, named_ends
+
+    # Sorted by basename, then content: basename groups with more than one
+    # distinct content run.
+    order = np.lexsort((sizes, hash_lo, hash_hi, tiebreaks, basenames))
+    sorted_basenames = (basenames[order], tiebreaks[order])
+    name_starts, name_ends = _runs(*sorted_basenames)
+    content_starts, _ = _runs(*sorted_basenames, hash_hi[order], hash_lo[order], sizes[order])
+    conflicting = _runs_per_group(name_starts, content_starts) > 1
+    add('identical_name_different_content', order, name_starts[conflicting], name_ends[conflicting],
+        (name_ends[conflicting] - name_starts[conflicting] - 1).sum())
+
+    counts['total_duplicate_count'] = sum(counts[category] for category in CATEGORIES)
+    results['counts'] = counts
+    return results
@@ -0,0 +1,317 @@
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS objects (
+    bucket       TEXT    NOT NULL,
+    name         TEXT    NOT NULL,
+    generation   INTEGER NOT NULL,
+    size         INTEGER,
+    md5_hash     TEXT,
+    file_hash    TEXT,
+    hash_source  TEXT,
+    content_type TEXT,
+    updated      TEXT,
+    PRIMARY KEY (bucket, name)
+);
+CREATE INDEX IF NOT EXISTS objects_by_md5 ON objects (bucket, md5_hash);
+CREATE INDEX IF NOT EXISTS objects_by_file_hash ON objects (bucket, file_hash, size);
+CREATE TABLE IF NOT EXISTS buckets (
+    bucket     TEXT PRIMARY KEY,
+    indexed_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bucket_generations (
+    bucket     TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chunked_objects (
+    bucket       TEXT    NOT NULL,
+    name         TEXT    NOT NULL,
+    generation   INTEGER NOT NULL,
+    chunk_params TEXT    NOT NULL,
+    chunk_count  INTEGER NOT NULL,
+    PRIMARY KEY (bucket, name)
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    bucket      TEXT    NOT NULL,
+    name        TEXT    NOT NULL,
+    fingerprint BLOB    NOT NULL,
+    length      INTEGER NOT NULL,
+    count       INTEGER NOT NULL,
+    PRIMARY KEY (bucket, name, fingerprint)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS chunks_by_fingerprint ON chunks (bucket, fingerprint);
+"""
+
+COLUMNS = ('bucket', 'name', 'generation', 'size', 'md5_hash', 'file_hash', 'hash_source', 'content_type', 'updated')
+
+# Notifications can arrive out of order, so a row is only replaced by the
+# same or a newer generation of the object.
+UPSERT = f"""
+INSERT INTO objects ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})
+ON CONFLICT (bucket, name) DO UPDATE SET
+    {', '.join(f'{column} = excluded.{column}' for column in COLUMNS[2:])}
+WHERE excluded.generation >= objects.generation
+"""
+
+# Every write to a bucket's objects bumps its listing generation, so results
+# derived from the index can be cached until the generation moves on.
+BUMP_GENERATION = """
+INSERT INTO bucket_generations (bucket, generation) VALUES (?, 1)
+ON CONFLICT (bucket) DO UPDATE SET generation = generation + 1
+"""
+
+# A rebuild streams the listing into this per-connection temporary table,
+# which does not hold the index's write lock, and then swaps it in
+STAGING_SCHEMA = f"""
+CREATE TEMP TABLE IF NOT EXISTS staged_objects (
+    {', '.join(COLUMNS)},
+    PRIMARY KEY (bucket, name)
+)
+"""
+STAGE = f"INSERT OR REPLACE INTO staged_objects ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+# UPSERT of a bucket's staged listing into `objects`
+UNSTAGE = f"""
+INSERT INTO objects ({', '.join(COLUMNS)})
+SELECT {', '.join(COLUMNS)} FROM staged_objects WHERE bucket = ?
+ON CONFLICT (bucket, name) DO UPDATE SET
+    {', '.join(f'{column} = excluded.{column}' for column in COLUMNS[2:])}
+WHERE excluded.generation >= objects.generation
+"""
+
+REBUILD_BATCH_SIZE = 5000
+# A rebuild keeps unlisted rows whose object generation, the object's
+# creation time in microseconds, is at most this much older than the
+# rebuild's start, allowing for clock skew between this host and GCS
+REBUILD_CLOCK_SKEW_SECONDS = 60
+
+
+def object_row(bucket_name, resource):
+    """Flatten a GCS object resource (listing item, blob._properties or
+    notification payload) into an `objects` row."""
+    metadata = resource.get('metadata') or {}
+    size = resource.get('size')
+    return (
+        bucket_name,
+        resource['name'],
+        int(resource.get('generation') or 0),
+        int(size) if size is not None else None,
+        resource.get('md5Hash'),
+        metadata.get('file_hash'),
+        metadata.get('hash_source'),
+        resource.get('contentType'),
+        resource.get('updated'),
+    )
+
+
+class HashIndex:
+    """Local SQLite index of bucket objects and their computed hashes.
+
+    One connection is kept per thread, mirroring the thread-local storage
+    clients in main.py. WAL mode lets request threads read while a reindex
+    or the Pub/Sub handler writes.
+
+    Chunk fingerprints of objects that went through content-defined
+    chunking are kept apart from `objects`, keyed by the generation they
+    were computed from, so a reindex keeps them and an overwritten object's
+    chunks are ignored until it is chunked again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _connection(self):
+        if not hasattr(self._local, 'connection'):
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return self._local.connection
+
+    def is_indexed(self, bucket_name):
+        row = self._connection().execute(
+            'SELECT 1 FROM buckets WHERE bucket = ?', (bucket_name,)).fetchone()
+        return row is not None
+
+    def age(self, bucket_name):
+        """Seconds since the bucket was last rebuilt from a listing, None if
+        it never was."""
+        row = self._connection().execute(
+            'SELECT indexed_at FROM buckets WHERE bucket = ?', (bucket_name,)).fetchone()
+        if row is None:
+            return None
+        return (datetime.now(timezone.utc) - datetime.fromisoformat(row[0])).total_seconds()
+
+    def listing_generation(self, bucket_name):
+        """Token that changes whenever the bucket's indexed objects may
+        have: when it was last rebuilt and the writes since. Other
+        instances hold their own index, so their tokens never match ours."""
+        row = self._connection().execute(
+            """
+            SELECT b.indexed_at, COALESCE(g.generation, 0) FROM buckets b
+            LEFT JOIN bucket_generations g ON g.bucket = b.bucket
+            WHERE b.bucket = ?
+            """,
+            (bucket_name,)).fetchone()
+        return f'{row[0]}/{row[1]}' if row is not None else None
+
+    def upsert(self, bucket_name, resource):
+        with self._connection() as connection:
+            connection.execute(UPSERT, object_row(bucket_name, resource))
+            connection.execute(BUMP_GENERATION, (bucket_name,))
+
+    def upsert_many(self, bucket_name, resources):
+        rows = [object_row(bucket_name, resource) for resource in resources]
+        if not rows:
+            return
+        with self._connection() as connection:
+            connection.executemany(UPSERT, rows)
+            connection.execute(BUMP_GENERATION, (bucket_name,))
+
+    def delete(self, bucket_name, name, generation=None):
+        """Drop an object, unless the index already holds a newer generation."""
+        with self._connection() as connection:
+            if generation is None:
+                connection.execute('DELETE FROM objects WHERE bucket = ? AND name = ?', (bucket_name, name))
+            else:
+                connection.execute(
+                    'DELETE FROM objects WHERE bucket = ? AND name = ? AND generation <= ?',
+                    (bucket_name, name, int(generation)))
+            connection.execute(BUMP_GENERATION, (bucket_name,))
+            chunked = connection.execute(
+                'SELECT generation FROM chunked_objects WHERE bucket = ? AND name = ?', (bucket_name, name)).fetchone()
+            if chunked is not None and (generation is None or chunked[0] <= int(generation)):
+                self._delete_chunks(connection, bucket_name, name)
+
+    def rebuild(self, bucket_name, resources):
+        """Replace everything known about a bucket with the given listing.
+
+        The listing is staged in a temporary table while it streams in, so
+        notifications keep being written to the index meanwhile, and is
+        swapped in with one short transaction: objects missing from the
+        listing are dropped and the listed ones upserted, keeping rows a
+        notification already moved to a newer generation. Objects created
+        while the listing ran may be missing from it, so rows a notification
+        wrote for them (with a generation newer than the rebuild's start)
+        are kept too. Readers see the previous state until the swap.
+        Returns the number of indexed objects.
+        """
+        started = int((datetime.now(timezone.utc).timestamp() - REBUILD_CLOCK_SKEW_SECONDS) * 1_000_000)
+        count = 0
+        connection = self._connection()
+        connection.execute(STAGING_SCHEMA)
+        with connection:
+            connection.execute('DELETE FROM staged_objects WHERE bucket = ?', (bucket_name,))
+        batch = []
+        for resource in resources:
+            batch.append(object_row(bucket_name, resource))
+            if len(batch) >= REBUILD_BATCH_SIZE:
+                with connection:
+                    connection.executemany(STAGE, batch)
+                count += len(batch)
+                batch = []
+        with connection:
+            connection.executemany(STAGE, batch)
+        count += len(batch)
+        try:
+            with connection:
+                connection.execute(
+                    'DELETE FROM objects WHERE bucket = ? AND generation < ? AND name NOT IN '
+                    '(SELECT name FROM staged_objects WHERE bucket = ?)', (bucket_name, started, bucket_name))
+                connection.execute(UNSTAGE, (bucket_name,))
+                connection.execute(
+                    'INSERT OR REPLACE INTO buckets (bucket, indexed_at) VALUES (?, ?)',
+                    (bucket_name, datetime.now(timezone.utc).isoformat()))
+                connection.execute(BUMP_GENERATION, (bucket_name,))
+        finally:
+            with connection:
+                connection.execute('DELETE FROM staged_objects WHERE bucket = ?', (bucket_name,))
+        return count
+
+    def iter_names(self, bucket_name):
+        """Yield the bucket's object names in listing order."""
+        rows = self._connection().execute('SELECT name FROM objects WHERE bucket = ? ORDER BY name', (bucket_name,))
+        return (name for name, in rows)
+
+    def stats(self, bucket_name):
+        total, with_hash = self._connection().execute(
+            'SELECT COUNT(*), COUNT(file_hash) FROM objects WHERE bucket = ?', (bucket_name,)).fetchone()
+        return {'total_files': total, 'files_with_hash': with_hash}
+
+    def iter_hashed(self, bucket_name):
+        """Yield (name, size, file_hash) for every object with a computed hash."""
+        return self._connection().execute(
+            'SELECT name, size, file_hash FROM objects WHERE bucket = ? AND file_hash IS NOT NULL',
+            (bucket_name,))
+
+    def iter_md5_duplicates(self, bucket_name):
+        """Yield rows of objects whose server-side md5 is shared with another
+        object, ordered so that each md5 group is contiguous."""
+        return self._connection().execute(
+            """
+            SELECT md5_hash, name, size, updated, content_type FROM objects
+            WHERE bucket = ? AND md5_hash IN (
+                SELECT md5_hash FROM objects WHERE bucket = ? AND md5_hash IS NOT NULL
+                GROUP BY md5_hash HAVING COUNT(*) > 1)
+            ORDER BY md5_hash, name
+            """,
+            (bucket_name, bucket_name))
+
+    def md5_counts(self, bucket_name):
+        """Return (total objects, objects with a unique md5)."""
+        return self._connection().execute(
+            """
+            SELECT (SELECT COUNT(*) FROM objects WHERE bucket = ?),
+                   (SELECT COUNT(*) FROM (
+                        SELECT md5_hash FROM objects WHERE bucket = ? AND md5_hash IS NOT NULL
+                        GROUP BY md5_hash HAVING COUNT(*) = 1))
+            """,
+            (bucket_name, bucket_name)).fetchone()
+
+    def is_chunked(self, bucket_name, name, generation, chunk_params):
+        """Whether this generation of the object was chunked with these params."""
+        row = self._connection().execute(
+            'SELECT 1 FROM chunked_objects WHERE bucket = ? AND name = ? AND generation = ? AND chunk_params = ?',
+            (bucket_name, name, int(generation or 0), chunk_params)).fetchone()
+        return row is not None
+
+    def store_chunks(self, bucket_name, resource, chunker):
+        """Replace the chunk fingerprints recorded for an object with those of
+        a finished Chunker, unless a newer generation was already chunked."""
+        name, generation = resource['name'], int(resource.get('generation') or 0)
+        with self._connection() as connection:
+            row = connection.execute(
+                'SELECT generation FROM chunked_objects WHERE bucket = ? AND name = ?', (bucket_name, name)).fetchone()
+            if row is not None and row[0] > generation:
+                return
+            self._delete_chunks(connection, bucket_name, name)
+            connection.executemany(
+                'INSERT INTO chunks (bucket, name, fingerprint, length, count) VALUES (?, ?, ?, ?, ?)',
+                ((bucket_name, name, fingerprint, length, count)
+                 for fingerprint, (length, count) in chunker.chunks.items()))
+            connection.execute(
+                'INSERT INTO chunked_objects (bucket, name, generation, chunk_params, chunk_count) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (bucket_name, name, generation, chunker.params, chunker.count))
+
+    @staticmethod
+    def _delete_chunks(connection, bucket_name, name):
+        connection.execute('DELETE FROM chunks WHERE bucket = ? AND name = ?', (bucket_name, name))
+        connection.execute('DELETE FROM chunked_objects WHERE bucket = ? AND name = ?', (bucket_name, name))
+
+    def iter_chunks(self, bucket_name, chunk_params):
+        """Yield (fingerprint, name, length, count) for the chunks of every
+        object chunked with ``chunk_params`` at the generation the index
+        currently holds, ordered by fingerprint."""
+        return self._connection().execute(
+            """
+            SELECT k.fingerprint, k.name, k.length, k.count FROM chunks k
+            JOIN chunked_objects c ON c.bucket = k.bucket AND c.name = k.name
+            JOIN objects o ON o.bucket = c.bucket AND o.name = c.name AND o.generation = c.generation
+            WHERE k.bucket = ? AND c.chunk_params = ?
+            ORDER BY k.fingerprint
+            """,
+            (bucket_name, chunk_params))
@@ -1,14 +1,27 @@
 import os
+import asyncio
+import copy
 import hashlib
 import json
 import threading
+import time
 import uuid
 import base64
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from google.cloud import storage
-from flask import Flask, request, jsonify
-from collections import defaultdict
-from datetime import datetime
+from flask import Flask, Response, request, jsonify
+from datetime import datetime, timezone
+from hash_index import HashIndex
+from duplicates import CATEGORIES, find_duplicates
+from chunking import Chunker, shared_chunk_pairs
+from checkpoints import CheckpointStore, is_state_object, now_iso
+from metadata_writer import MAX_BATCH_SIZE, MetadataBatchWriter
+from report_cache import SORT_ORDERS, Report, ReportCache, decode_cursor, etag, iter_json
+from async_engine import AsyncBatchPatcher, AsyncStorage
+from scheduler import AsyncBulkScheduler, BulkScheduler
+from sharding import (SHARD_MODES, LocalShardQueue, PubSubPublisher, merge_shard_states, sample_names, shard_ranges,
+                      split_points)
+import metrics
 
 app = Flask(__name__)
 
@@ -17,100 +30,824 @@ thread_local = threading.local()
 
 BUCKET_NAME = "bacteria-collection-data"
 
+# Size of each ranged read while hashing; bounds the memory used per worker.
+HASH_CHUNK_SIZE = int(os.environ.get('HASH_CHUNK_SIZE', 8 * 1024 * 1024))
+# Digests computed in the same pass. The first one is stored as `file_hash`,
+# any others as `file_hash_<algorithm>`.
+HASH_ALGORITHMS = tuple(
+    name.strip() for name in os.environ.get('HASH_ALGORITHMS', 'md5').split(',') if name.strip()
+)
+# How file hashes are obtained:
+#   download      - always stream the object and hash it locally
+#   server        - reuse the md5 GCS already stores for the object and only
+#                   download objects that have none (e.g. composite uploads)
+#   server_crc32c - like `server`, but objects without an md5 fall back to
+#                   their crc32c instead of being downloaded
+# The server-side shortcuts only apply while md5 is the primary algorithm.
+HASH_MODES = ('download', 'server', 'server_crc32c')
+HASH_MODE = os.environ.get('HASH_MODE', 'download')
+# Local SQLite index answering the stats/duplicate endpoints without listing
+# the bucket. It is per instance; /reindex rebuilds it from a listing.
+HASH_INDEX_PATH = os.environ.get('HASH_INDEX_PATH', '/tmp/gcs-hash-index.sqlite3')
+# Each bucket notification reaches a single instance, so the indexes of the
+# others fall behind. An index older than HASH_INDEX_MAX_AGE seconds is
+# rebuilt in the background while requests keep being answered from it
+# (0 never refreshes it); until then it may miss recent changes.
+HASH_INDEX_MAX_AGE = int(os.environ.get('HASH_INDEX_MAX_AGE', 3600))
+
+hash_index = HashIndex(HASH_INDEX_PATH)
+# /find-identical-files and /compare-files-md5 build their report once per
+# listing generation of the bucket in the index, and answer later requests,
+# pages and If-None-Match revalidations from it. Reports of the last
+# REPORT_CACHE_ENTRIES (endpoint, bucket) pairs are kept.
+REPORT_CACHE_ENTRIES = int(os.environ.get('REPORT_CACHE_ENTRIES', 8))
+
+report_cache = ReportCache(REPORT_CACHE_ENTRIES)
+
+# Content-defined chunking: process-all (and single-file notifications)
+# also split objects of at least CDC_MIN_FILE_SIZE bytes into FastCDC chunks
+# of CDC_AVG_CHUNK_SIZE bytes on average (a power of two) while hashing them,
+# and record the chunk fingerprints in the index for /find-similar-files.
+# Objects that already have a file_hash are downloaded again to be chunked.
+CHUNKING = os.environ.get('CHUNKING', 'false').lower() == 'true'
+CDC_AVG_CHUNK_SIZE = int(os.environ.get('CDC_AVG_CHUNK_SIZE', 64 * 1024))
+CDC_MIN_FILE_SIZE = int(os.environ.get('CDC_MIN_FILE_SIZE', 1024 * 1024))
+# Chunks held by more files than this (zero-filled blocks, shared headers)
+# are not used to pair files
+CDC_MAX_CHUNK_FANOUT = int(os.environ.get('CDC_MAX_CHUNK_FANOUT', 100))
+
+# Batch jobs keep at most this many files queued on the executor at once.
+MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', 100))
+# Seconds between checkpoints while a listing page is being processed; also
+# serves as the heartbeat other instances use to tell a live job from a dead one.
+CHECKPOINT_INTERVAL = int(os.environ.get('CHECKPOINT_INTERVAL', 30))
+JOB_LEASE_SECONDS = 4 * CHECKPOINT_INTERVAL
+DEFAULT_JOB_ID = 'process-all'
+# Metadata patches sent per GCS batch request (at most 100)
+PATCH_BATCH_SIZE = int(os.environ.get('PATCH_BATCH_SIZE', MAX_BATCH_SIZE))
+# Custom metadata keys removed by /remove-all-file-hash-metadata, besides
+# the extra file_hash_<algorithm> digests
+HASH_METADATA_KEYS = ('file_hash', 'processed', 'md5_hash', 'hash_source')
+INSTANCE_ID = uuid.uuid4().hex
+# I/O engine for the bucket-wide jobs (process-all and remove-all):
+#   async   - one event loop sharing a single connection pool, with up to
+#             ASYNC_CONCURRENCY requests and ASYNC_DOWNLOAD_CONCURRENCY
+#             object downloads in flight
+#   threads - a pool of BULK_THREADS threads (or the num_threads requested)
+#             with one storage client per thread
+BULK_ENGINES = ('async', 'threads')
+BULK_ENGINE = os.environ.get('BULK_ENGINE', 'async')
+ASYNC_CONCURRENCY = int(os.environ.get('ASYNC_CONCURRENCY', 256))
+ASYNC_DOWNLOAD_CONCURRENCY = int(os.environ.get('ASYNC_DOWNLOAD_CONCURRENCY', 32))
+BULK_THREADS = int(os.environ.get('BULK_THREADS', 32))
+# Requests of a bulk run go through one scheduler (see scheduler.py): the
+# number in flight starts at BULK_INITIAL_CONCURRENCY and adapts between 1
+# and the engine's maximum above, backing off when 429s, 5xx responses or a
+# latency over BULK_LATENCY_TOLERANCE times the usual one show up. Requests
+# are held to BULK_MAX_RPS per second (0 for no cap) and tried up to
+# BULK_MAX_ATTEMPTS times.
+BULK_INITIAL_CONCURRENCY = int(os.environ.get('BULK_INITIAL_CONCURRENCY', 8))
+BULK_MAX_RPS = float(os.environ.get('BULK_MAX_RPS', 0))
+BULK_LATENCY_TOLERANCE = float(os.environ.get('BULK_LATENCY_TOLERANCE', 3.0))
+BULK_MAX_ATTEMPTS = int(os.environ.get('BULK_MAX_ATTEMPTS', 5))
+# A sharded process-all job (shards > 1) splits the bucket's keyspace into
+# lexicographic ranges and publishes one message per range to SHARD_TOPIC,
+# whose push subscription delivers them to /pubsub on whichever instances
+# Pub/Sub picks. Without a topic, the shards run on this instance,
+# SHARD_LOCAL_WORKERS at a time.
+SHARD_TOPIC = os.environ.get('SHARD_TOPIC')
+SHARD_LOCAL_WORKERS = int(os.environ.get('SHARD_LOCAL_WORKERS', 2))
+MAX_SHARDS = int(os.environ.get('MAX_SHARDS', 256))
+# Keys of a Pub/Sub process_all message that make it one shard of a job
+SHARD_KEYS = ('start_offset', 'end_offset', 'parent_job')
+
+# Held while a bucket's index is being rebuilt, keyed by bucket
+index_locks = {}
+index_locks_lock = threading.Lock()
+
+# Background batch jobs started on this instance, keyed by (bucket, job_id)
+running_jobs = {}
+running_jobs_lock = threading.Lock()
+
 def get_storage_client():
     if not hasattr(thread_local, "client"):
         thread_local.client = storage.Client()
     return thread_local.client
 
 
-def calculate_file_hash(blob):
-    hash_md5 = hashlib.md5()
-    temp_file = f'/tmp/{uuid.uuid4().hex}'
-    try:
-        blob.download_to_filename(temp_file)
-        with open(temp_file, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-    finally:
-        if os.path.exists(temp_file):
-            os.remove(temp_file)
-    return hash_md5.hexdigest()
+def calculate_file_hashes(blob, algorithms=None, chunk_size=None, chunker=None, scheduler=None):
+    """Stream the blob through one hasher per algorithm in a single pass.
+
+    The object is read with ranged downloads of at most ``chunk_size`` bytes,
+    so memory per worker stays bounded by the chunk size instead of the
+    object size and nothing is staged on /tmp (which is RAM on Cloud Run).
+    The same pass feeds ``chunker`` (a chunking.Chunker), if any. Downloads
+    go through ``scheduler`` (a scheduler.BulkScheduler), if any, instead of
+    the client's retry policy.
+    """
+    algorithms = HASH_ALGORITHMS if algorithms is None else algorithms
+    chunk_size = chunk_size or HASH_CHUNK_SIZE
+    hashers = {name: hashlib.new(name) for name in algorithms}
+
+    if blob.size is None:
+        blob.reload()
+
+    start = 0
+    while start < blob.size:
+        end = min(start + chunk_size, blob.size) - 1
+        with metrics.stage('download') as span:
+            if scheduler is None:
+                chunk = blob.download_as_bytes(start=start, end=end, checksum=None)
+            else:
+                chunk = scheduler.call(
+                    'download', lambda: blob.download_as_bytes(start=start, end=end, checksum=None, retry=None),
+                    end - start + 1)
+            span.nbytes = len(chunk)
+        with metrics.stage('hash', nbytes=len(chunk)):
+            for hasher in hashers.values():
+                hasher.update(chunk)
+        if chunker is not None:
+            with metrics.stage('chunk', nbytes=len(chunk)):
+                chunker.update(chunk)
+        start = end + 1
+
+    if chunker is not None:
+        chunker.finish()
+    return {name: hasher.hexdigest() for name, hasher in hashers.items()}
+
+
+def calculate_file_hash(blob, chunk_size=None):
+    return calculate_file_hashes(blob, ('md5',), chunk_size)['md5']
+
+
+def server_side_hashes(blob, hash_mode=None):
+    """Return (hashes, hash_source) from the checksums GCS already stores for
+    the blob, or None when hash_mode requires the content to be downloaded.
+
+    hash_source is 'gcs_md5' or 'gcs_crc32c'.
+    """
+    hash_mode = hash_mode or HASH_MODE
+    if hash_mode != 'download' and HASH_ALGORITHMS[0] == 'md5':
+        if blob.md5_hash:
+            return {'md5': base64.b64decode(blob.md5_hash).hex()}, 'gcs_md5'
+        if hash_mode == 'server_crc32c' and blob.crc32c:
+            # Prefixed so a crc32c can never be grouped with an md5 digest
+            return {'md5': f'crc32c:{base64.b64decode(blob.crc32c).hex()}'}, 'gcs_crc32c'
+    return None
 
 
-def process_file(bucket_name, blob_name):
-    client = get_storage_client()
-    bucket = client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
+def resolve_file_hashes(blob, hash_mode=None, scheduler=None):
+    """Return (hashes, hash_source) for the blob according to hash_mode.
 
-    # Check if file already has a hash
-    if blob.metadata and 'file_hash' in blob.metadata:
-        print(f'Skipping file: {blob.name} (already processed)')
-        return None, blob.name
+    hash_source is 'gcs_md5' or 'gcs_crc32c' when the digest was taken from
+    the object's server-side checksums and 'download' when it was computed
+    from the object content.
+    """
+    return server_side_hashes(blob, hash_mode) or (calculate_file_hashes(blob, scheduler=scheduler), 'download')
+
+
+def new_chunker():
+    return Chunker(CDC_AVG_CHUNK_SIZE)
 
-    print(f'Processing file: {blob.name}')
-    file_hash = calculate_file_hash(blob)
 
-    # Update blob metadata
+def needs_chunking(bucket_name, resource, chunking=None):
+    """Whether chunking is on and the object is large enough and was not
+    chunked yet at its current generation."""
+    chunking = CHUNKING if chunking is None else chunking
+    size = resource.get('size')
+    if not chunking or size is None or int(size) < CDC_MIN_FILE_SIZE:
+        return False
+    return not hash_index.is_chunked(bucket_name, resource['name'], resource.get('generation'),
+                                     new_chunker().params)
+
+
+def is_true(value):
+    """Flag passed as a JSON boolean or a query string."""
+    return value is True or str(value).lower() == 'true'
+
+
+def build_hash_metadata(blob, bucket_name, hashes, hash_source):
     metadata = {
-        'file_hash': file_hash,
+        'file_hash': hashes[HASH_ALGORITHMS[0]],
         'name': blob.name,
         'bucket': bucket_name,
         'size': str(blob.size) if blob.size is not None else 'unknown',
         'content_type': blob.content_type if blob.content_type is not None else 'unknown',
         'updated': blob.updated.isoformat() if blob.updated is not None else datetime.now().isoformat(),
         'md5_hash': blob.md5_hash if blob.md5_hash is not None else 'unknown',
+        'hash_source': hash_source,
         'processed': 'true'
     }
+    for name in HASH_ALGORITHMS[1:]:
+        if name in hashes:
+            metadata[f'file_hash_{name}'] = hashes[name]
+    return metadata
+
+
+def hash_file(bucket_name, blob_name, hash_mode=None, properties=None, chunking=None, scheduler=None):
+    """Hash a single object and build its file_hash metadata without writing it.
+
+    ``properties`` is the object resource when the caller already has it (from
+    a listing or a Pub/Sub notification); otherwise it is fetched with a GET.
+    When needs_chunking() holds for the object under ``chunking`` (CHUNKING
+    by default), it is also chunked in the same pass and its chunks are
+    stored in the index, even if it was already hashed; the content is then
+    always downloaded, whatever the hash mode. Downloads go through
+    ``scheduler``, if any (see calculate_file_hashes).
+    Returns (blob, metadata, hash_source). metadata is None when the object
+    was skipped, and blob is None as well when it no longer exists.
+    """
+    client = get_storage_client()
+    bucket = client.bucket(bucket_name)
+    if properties is None:
+        blob = bucket.get_blob(blob_name)
+        if blob is None:
+            metrics.log_item(f'Skipping file: {blob_name} (not found)')
+            return None, None, None
+    else:
+        blob = bucket.blob(blob_name)
+        blob._set_properties(dict(properties))
+
+    chunker = new_chunker() if needs_chunking(bucket_name, blob._properties, chunking) else None
+
+    # Check if file already has a hash
+    if blob.metadata and 'file_hash' in blob.metadata:
+        if chunker is not None:
+            metrics.log_item(f'Chunking file: {blob.name}')
+            calculate_file_hashes(blob, (), chunker=chunker, scheduler=scheduler)
+            hash_index.store_chunks(bucket_name, blob._properties, chunker)
+        metrics.log_item(f'Skipping file: {blob.name} (already processed)')
+        hash_index.upsert(bucket_name, blob._properties)
+        return blob, None, blob.metadata.get('hash_source')
+
+    metrics.log_item(f'Processing file: {blob.name}')
+    if chunker is not None:
+        hashes, hash_source = calculate_file_hashes(blob, chunker=chunker, scheduler=scheduler), 'download'
+        hash_index.store_chunks(bucket_name, blob._properties, chunker)
+    else:
+        hashes, hash_source = resolve_file_hashes(blob, hash_mode, scheduler)
+    metadata = build_hash_metadata(blob, bucket_name, hashes, hash_source)
+
+    return blob, metadata, hash_source
+
+
+def process_file(bucket_name, blob_name, hash_mode=None, properties=None, chunking=None):
+    """Hash a single object and store the result in its custom metadata.
+
+    Returns (file_hash, blob_name, hash_source), with file_hash None when the
+    object was skipped.
+    """
+    blob, metadata, hash_source = hash_file(bucket_name, blob_name, hash_mode, properties, chunking)
+    if metadata is None:
+        return None, blob_name, hash_source
+
     blob.metadata = metadata
-    blob.patch()
+    with metrics.stage('patch'):
+        blob.patch()
+    hash_index.upsert(bucket_name, blob._properties)
 
-    return file_hash, blob.name
+    return metadata['file_hash'], blob.name, hash_source
 
 
-def process_all_files(bucket_name, num_threads=10):
-    client = get_storage_client()
-    bucket = client.bucket(bucket_name)
-    blobs = list(bucket.list_blobs())
+def hash_metadata_removal(metadata):
+    """Metadata patch deleting the keys process_file adds; None if there are none."""
+    keys = [key for key in (metadata or {}) if key in HASH_METADATA_KEYS or key.startswith('file_hash_')]
+    return {key: None for key in keys} or None
 
-    # Filter out blobs that already have a hash
-    blobs_to_process = [blob for blob in blobs if not (blob.metadata and 'file_hash' in blob.metadata)]
 
-    total_files = len(blobs_to_process)
-    print(f"Starting processing of {total_files} files out of {len(blobs)} total files")
+def metadata_writer(bucket_name, max_workers=4, scheduler=None):
+    """Batched metadata writer that keeps the hash index in step with its patches."""
+    return MetadataBatchWriter(
+        bucket_name,
+        get_storage_client,
+        batch_size=PATCH_BATCH_SIZE,
+        max_workers=max_workers,
+        on_patched=lambda properties: hash_index.upsert(bucket_name, properties),
+        scheduler=scheduler
+    )
 
-    results = []
-    processed_count = 0
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        future_to_blob = {executor.submit(process_file, bucket_name, blob.name): blob for blob in blobs_to_process}
 
-        for future in as_completed(future_to_blob):
-            blob = future_to_blob[future]
-            try:
-                file_hash, file_name = future.result()
-                processed_count += 1
-                if file_hash is not None:
-                    results.append((file_hash, file_name))
-                print(f"Processed {processed_count}/{total_files} FileName:{file_name} with Hash: {file_hash}")
-            except Exception as exc:
-                print(f'{blob.name} generated an exception: {exc}')
+def new_scheduler(maximum, scheduler_class=BulkScheduler):
+    """Scheduler for the requests of one bulk run, allowing at most
+    ``maximum`` in flight."""
+    return scheduler_class(min(BULK_INITIAL_CONCURRENCY, maximum), 1, maximum, BULK_MAX_RPS,
+                           BULK_LATENCY_TOLERANCE, BULK_MAX_ATTEMPTS)
+
 
-    return results, processed_count, total_files
+def new_job_state(job_id, bucket_name, hash_mode, engine, chunking=False, shard=None):
+    return {
+        'job_id': job_id,
+        'bucket': bucket_name,
+        'hash_mode': hash_mode,
+        'engine': engine,
+        'chunking': chunking,
+        # Range of names covered, [start_offset, end_offset), and the job it
+        # is a shard of; None when the job covers the whole bucket
+        'start_offset': (shard or {}).get('start_offset'),
+        'end_offset': (shard or {}).get('end_offset'),
+        'parent_job': (shard or {}).get('parent_job'),
+        'status': 'running',
+        'instance': INSTANCE_ID,
+        # Token of the listing page being processed (None is the first page)
+        # and the names already handled on it
+        'page_token': None,
+        'completed_names': [],
+        'pages_completed': 0,
+        'files_listed': 0,
+        'files_processed': 0,
+        'files_skipped': 0,
+        'files_failed': 0,
+        'files_chunked': 0,
+        'failed_names': [],
+        'hash_sources': {},
+        # Scheduler report (scheduler.py) of the current run, which starts
+        # over when the job is resumed
+        'throughput': None,
+        'started_at': now_iso(),
+        'updated_at': None,
+        'finished_at': None,
+        'error': None
+    }
 
 
-def remove_file_hash_metadata(bucket_name, blob_name):
+def load_job(checkpoints, job_id, bucket_name, hash_mode, engine, chunking=None, shard=None):
+    """Resume the checkpointed job, or start a new one if there is none or
+    the previous run completed. A resumed job keeps its name range."""
+    state = checkpoints.load(job_id)
+    if state is None or state['status'] == 'completed':
+        state = new_job_state(job_id, bucket_name, hash_mode or HASH_MODE, engine,
+                              CHUNKING if chunking is None else chunking, shard)
+        print(f"Starting job {job_id} for bucket {bucket_name}")
+    else:
+        print(f"Resuming job {job_id} for bucket {bucket_name} at page {state['pages_completed'] + 1}")
+        state.update(status='running', instance=INSTANCE_ID, engine=engine, error=None)
+        # Checkpoints written before chunking existed
+        state.setdefault('chunking', False)
+        state.setdefault('files_chunked', 0)
+        for key in SHARD_KEYS:
+            state.setdefault(key, None)
+        state['throughput'] = None
+    checkpoints.save(state)
+    return state
+
+
+def record_failure(state, name):
+    state['files_failed'] += 1
+    if len(state['failed_names']) < 100:
+        state['failed_names'].append(name)
+
+
+def process_all_files(bucket_name, num_threads=None, hash_mode=None, job_id=DEFAULT_JOB_ID, chunking=None,
+                      shard=None):
+    """Hash every object in the bucket as a resumable batch job.
+
+    The listing is walked page by page with at most MAX_IN_FLIGHT files
+    queued on the executor, and the resulting metadata is written back in
+    batches of PATCH_BATCH_SIZE. The job state is checkpointed to the bucket after
+    every page and every CHECKPOINT_INTERVAL seconds within one, so a job cut
+    short by a timeout or a recycled instance resumes from the last page it
+    was working on and skips the names it already finished there.
+    With ``chunking``, objects are chunked as well (see hash_file). A
+    ``shard`` ({'start_offset', 'end_offset', 'parent_job'}) limits the job
+    to a range of names (see start_sharded_job).
+    Downloads and patches share one scheduler allowing up to ``num_threads``
+    (BULK_THREADS by default) requests in flight.
+    Returns the final job state.
+    """
     client = get_storage_client()
     bucket = client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
+    checkpoints = CheckpointStore(client, bucket_name)
+    num_threads = num_threads or BULK_THREADS
+    scheduler = new_scheduler(num_threads)
+    writer = metadata_writer(bucket_name, scheduler=scheduler)
+
+    state = load_job(checkpoints, job_id, bucket_name, hash_mode, 'threads', chunking, shard)
+    last_checkpoint = time.monotonic()
+
+    def checkpoint():
+        # Names only count as completed once their metadata is written
+        nonlocal last_checkpoint
+        patched, failed = writer.flush()
+        state['files_processed'] += patched
+        for name in failed:
+            record_failure(state, name)
+        state['throughput'] = scheduler.report()
+        checkpoints.save(state)
+        last_checkpoint = time.monotonic()
+
+    def record(future, name, chunk):
+        try:
+            blob, metadata, hash_source = future.result()
+            if chunk:
+                state['files_chunked'] += 1
+            if metadata is not None:
+                writer.add(blob.name, metadata, blob.generation)
+                state['hash_sources'][hash_source] = state['hash_sources'].get(hash_source, 0) + 1
+                metrics.log_item(f"Hashed FileName:{blob.name} with Hash: {metadata['file_hash']} ({hash_source})")
+            else:
+                state['files_skipped'] += 1
+        except Exception as exc:
+            record_failure(state, name)
+            print(f'{name} generated an exception: {exc}')
+        state['completed_names'].append(name)
+
+    def drain(in_flight, limit):
+        while len(in_flight) > limit:
+            done, _ = wait(in_flight, timeout=CHECKPOINT_INTERVAL, return_when=FIRST_COMPLETED)
+            for future in done:
+                record(future, *in_flight.pop(future))
+            if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                checkpoint()
+        metrics.QUEUE_DEPTH.labels('hash').set(len(in_flight))
 
-    metadata = blob.metadata
-    del metadata['file_hash']
-    del metadata['processed']
-    del metadata['md5_hash']
-    blob.metadata = metadata
-    blob.patch()
+    try:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            iterator = bucket.list_blobs(page_token=state['page_token'], start_offset=state['start_offset'],
+                                         end_offset=state['end_offset'])
+            for page in metrics.timed(iterator.pages, 'list', lambda page: page.num_items):
+                completed = set(state['completed_names'])
+                in_flight = {}
+                for blob in page:
+                    if blob.name in completed or is_state_object(blob.name):
+                        continue
+                    chunk = needs_chunking(bucket_name, blob._properties, state['chunking'])
+                    # Filter out blobs that already have a hash
+                    if blob.metadata and 'file_hash' in blob.metadata and not chunk:
+                        state['files_skipped'] += 1
+                        state['completed_names'].append(blob.name)
+                        continue
+                    drain(in_flight, MAX_IN_FLIGHT - 1)
+                    # The listing already carries each object's properties, so
+                    # workers do not need to GET them again before hashing.
+                    future = executor.submit(hash_file, bucket_name, blob.name, state['hash_mode'], blob._properties,
+                                             state['chunking'], scheduler)
+                    in_flight[future] = blob.name, chunk
+                drain(in_flight, 0)
+
+                state['page_token'] = iterator.next_page_token
+                state['completed_names'] = []
+                state['pages_completed'] += 1
+                state['files_listed'] += page.num_items
+                checkpoint()
+                print(f"Job {job_id}: finished page {state['pages_completed']}, {state['files_listed']} files listed")
+
+        state['status'] = 'completed'
+        state['finished_at'] = now_iso()
+    except Exception as exc:
+        state['status'] = 'failed'
+        state['error'] = str(exc)
+        print(f'Job {job_id} failed: {exc}')
+    finally:
+        checkpoint()
+        writer.close()
+    print(f"Job {job_id}: {json.dumps(state['throughput'])}")
+
+    return state
+
+
+def detached_blob(bucket_name, resource):
+    """Blob carrying a listed object resource, for the helpers that read blob
+    properties; it is never used to make requests."""
+    blob = storage.Blob(resource['name'], storage.Bucket(None, bucket_name))
+    blob._set_properties(dict(resource))
+    return blob
+
+
+async def process_all_files_async(bucket_name, hash_mode=None, job_id=DEFAULT_JOB_ID, chunking=None, shard=None):
+    """process_all_files on the async engine.
+
+    Same job state, checkpoints and resume behaviour, but listing, ranged
+    downloads and batch patches all go through one AsyncStorage, so the
+    number of files in flight is bounded by ASYNC_CONCURRENCY instead of a
+    thread count, and requests by the storage's scheduler. Hashing runs on the default executor so the event loop
+    keeps issuing requests while digests are computed.
+    """
+    checkpoints = CheckpointStore(get_storage_client(), bucket_name)
+    state = await asyncio.to_thread(load_job, checkpoints, job_id, bucket_name, hash_mode, 'async', chunking, shard)
+    algorithms = HASH_ALGORITHMS
+    patched_resources = []
+    last_checkpoint = time.monotonic()
+
+    scheduler = new_scheduler(ASYNC_CONCURRENCY, AsyncBulkScheduler)
+    async with AsyncStorage(scheduler, ASYNC_DOWNLOAD_CONCURRENCY) as gcs:
+        patcher = AsyncBatchPatcher(gcs, bucket_name, PATCH_BATCH_SIZE, on_patched=patched_resources.append)
+
+        async def checkpoint():
+            # Names only count as completed once their metadata is written
+            nonlocal last_checkpoint
+            patched, failed = await patcher.flush()
+            state['files_processed'] += patched
+            for name in failed:
+                record_failure(state, name)
+            state['throughput'] = scheduler.report()
+            # Tasks keep running while the index and the checkpoint are
+            # written, so both work on a snapshot.
+            resources, patched_resources[:] = list(patched_resources), []
+            snapshot = copy.deepcopy(state)
+            await asyncio.to_thread(hash_index.upsert_many, bucket_name, resources)
+            await asyncio.to_thread(checkpoints.save, snapshot)
+            last_checkpoint = time.monotonic()
+
+        async def hash_one(resource, chunk):
+            name = resource['name']
+            try:
+                blob = detached_blob(bucket_name, resource)
+                hashed = 'file_hash' in (resource.get('metadata') or {})
+                chunker = new_chunker() if chunk else None
+                result = None if chunker is not None else server_side_hashes(blob, state['hash_mode'])
+                if result is None:
+                    hashes = await gcs.hash_object(bucket_name, resource, () if hashed else algorithms,
+                                                   HASH_CHUNK_SIZE, chunker)
+                    result = hashes, 'download'
+                if chunker is not None:
+                    await asyncio.to_thread(hash_index.store_chunks, bucket_name, resource, chunker)
+                    state['files_chunked'] += 1
+                if hashed:
+                    # Only downloaded to be chunked
+                    await asyncio.to_thread(hash_index.upsert, bucket_name, resource)
+                    state['files_skipped'] += 1
+                else:
+                    hashes, hash_source = result
+                    metadata = build_hash_metadata(blob, bucket_name, hashes, hash_source)
+                    patcher.add(name, metadata, resource.get('generation'))
+                    state['hash_sources'][hash_source] = state['hash_sources'].get(hash_source, 0) + 1
+                    metrics.log_item(f"Hashed FileName:{name} with Hash: {metadata['file_hash']} ({hash_source})")
+            except Exception as exc:
+                record_failure(state, name)
+                print(f'{name} generated an exception: {exc}')
+            state['completed_names'].append(name)
+
+        async def drain(in_flight, limit):
+            while len(in_flight) > limit:
+                _, in_flight_left = await asyncio.wait(
+                    in_flight, timeout=CHECKPOINT_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                in_flight.intersection_update(in_flight_left)
+                if time.monotonic() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                    await checkpoint()
+            metrics.QUEUE_DEPTH.labels('hash').set(len(in_flight))
+
+        try:
+            async for items, next_page_token in gcs.list_pages(bucket_name, state['page_token'],
+                                                               start_offset=state['start_offset'],
+                                                               end_offset=state['end_offset']):
+                completed = set(state['completed_names'])
+                in_flight = set()
+                for resource in items:
+                    name = resource['name']
+                    if name in completed or is_state_object(name):
+                        continue
+                    chunk = needs_chunking(bucket_name, resource, state['chunking'])
+                    # Filter out blobs that already have a hash
+                    if 'file_hash' in (resource.get('metadata') or {}) and not chunk:
+                        state['files_skipped'] += 1
+                        state['completed_names'].append(name)
+                        continue
+                    await drain(in_flight, ASYNC_CONCURRENCY - 1)
+                    in_flight.add(asyncio.ensure_future(hash_one(resource, chunk)))
+                await drain(in_flight, 0)
+
+                state['page_token'] = next_page_token
+                state['completed_names'] = []
+                state['pages_completed'] += 1
+                state['files_listed'] += len(items)
+                await checkpoint()
+                print(f"Job {job_id}: finished page {state['pages_completed']}, {state['files_listed']} files listed")
+
+            state['status'] = 'completed'
+            state['finished_at'] = now_iso()
+        except Exception as exc:
+            state['status'] = 'failed'
+            state['error'] = str(exc)
+            print(f'Job {job_id} failed: {exc}')
+        finally:
+            await checkpoint()
+    print(f"Job {job_id}: {json.dumps(state['throughput'])}")
+
+    return state
+
+
+def run_process_all_job(bucket_name, hash_mode=None, job_id=DEFAULT_JOB_ID, engine=None, chunking=None, shard=None):
+    """Run the process-all job on the requested engine; returns its final state."""
+    if (engine or BULK_ENGINE) == 'async':
+        return asyncio.run(process_all_files_async(bucket_name, hash_mode, job_id, chunking, shard))
+    return process_all_files(bucket_name, hash_mode=hash_mode, job_id=job_id, chunking=chunking, shard=shard)
+
+
+def job_is_live(state):
+    """Whether a checkpointed job is still being worked on by some instance."""
+    if state is None or state['status'] != 'running' or not state.get('updated_at'):
+        return False
+    age = (datetime.now(timezone.utc) - datetime.fromisoformat(state['updated_at'])).total_seconds()
+    return age < JOB_LEASE_SECONDS
+
+
+def start_process_all_job(bucket_name, hash_mode=None, job_id=DEFAULT_JOB_ID, engine=None, chunking=None,
+                          shard=None):
+    """Run the process-all job in a background thread.
+
+    Returns False without starting anything when the job is already running,
+    either here or on another instance that checkpointed recently.
+    """
+    key = (bucket_name, job_id)
+    with running_jobs_lock:
+        thread = running_jobs.get(key)
+        if thread is not None and thread.is_alive():
+            return False
+        if job_is_live(CheckpointStore(get_storage_client(), bucket_name).load(job_id)):
+            return False
+        thread = threading.Thread(
+            target=run_process_all_job,
+            args=(bucket_name,),
+            kwargs={'hash_mode': hash_mode, 'job_id': job_id, 'engine': engine, 'chunking': chunking,
+                    'shard': shard},
+            daemon=True
+        )
+        running_jobs[key] = thread
+        thread.start()
     return True
 
 
+def shard_boundaries(bucket_name, shards, shard_by='range'):
+    """Names cutting the bucket's keyspace into up to ``shards`` ranges.
+
+    By range, they are quantiles of a sample of the object names, taken
+    from the hash index when it covers the bucket and from a names-only
+    listing otherwise. By prefix, they are top-level prefixes ('plate7/'),
+    so no prefix is split between shards; there are then at most as many
+    shards as prefixes.
+    """
+    bucket = get_storage_client().bucket(bucket_name)
+    if shard_by == 'prefix':
+        iterator = bucket.list_blobs(delimiter='/', fields='items(name),prefixes,nextPageToken')
+        for _ in iterator.pages:
+            pass
+        return split_points(sorted(iterator.prefixes), shards)
+    if hash_index.is_indexed(bucket_name):
+        names = hash_index.iter_names(bucket_name)
+    else:
+        names = (blob.name for blob in bucket.list_blobs(fields='items(name),nextPageToken'))
+    sample, _ = sample_names(name for name in names if not is_state_object(name))
+    return split_points(sample, shards)
+
+
+def load_shard_states(bucket_name, coordinator):
+    """Checkpointed state of each shard of a sharded job, None for shards
+    that have not started since the job was (re)planned."""
+    def load(shard):
+        state = CheckpointStore(get_storage_client(), bucket_name).load(shard['job_id'])
+        if state is None or state['started_at'] < coordinator['started_at']:
+            return None
+        return state
+
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        return list(executor.map(load, coordinator['shards']))
+
+
+def shard_message(coordinator, shard):
+    """Pub/Sub message data running one shard of a sharded job."""
+    return {
+        'bucket': coordinator['bucket'],
+        'process_all': True,
+        'job_id': shard['job_id'],
+        'hash_mode': coordinator['hash_mode'],
+        'engine': coordinator['engine'],
+        'chunking': coordinator['chunking'],
+        'start_offset': shard['start_offset'],
+        'end_offset': shard['end_offset'],
+        'parent_job': coordinator['job_id']
+    }
+
+
+def run_shard_message(message):
+    """Run the shard a shard message describes, in this thread."""
+    run_process_all_job(message['bucket'], message['hash_mode'], message['job_id'], message['engine'],
+                        message['chunking'], {key: message[key] for key in SHARD_KEYS})
+
+
+local_shards = LocalShardQueue(run_shard_message, SHARD_LOCAL_WORKERS)
+
+
+def shard_publisher():
+    return PubSubPublisher(SHARD_TOPIC) if SHARD_TOPIC else local_shards
+
+
+def start_sharded_job(bucket_name, shards, hash_mode=None, job_id=DEFAULT_JOB_ID, engine=None, chunking=None,
+                      shard_by='range'):
+    """Split the process-all job into ``shards`` jobs over ranges of names
+    and fan them out as shard messages (see SHARD_TOPIC).
+
+    The coordinator state saved under ``job_id`` lists the shards, which
+    checkpoint and resume independently as ``<job_id>-shard<n>``; /jobs
+    merges their states. Starting a job whose shards have not all completed
+    re-publishes the ones that are neither completed nor live, which resume
+    from their checkpoints, instead of planning a new split. Each instance's
+    hash index only learns about the objects it hashed itself; /reindex
+    refreshes it from the bucket.
+    Returns (status, coordinator) with status 'started', 'resumed' or
+    'already_running'.
+    """
+    checkpoints = CheckpointStore(get_storage_client(), bucket_name)
+    coordinator = checkpoints.load(job_id)
+    if coordinator is not None and 'shards' in coordinator:
+        merged = merge_shard_states(coordinator, load_shard_states(bucket_name, coordinator), job_is_live)
+        if merged['status'] != 'completed':
+            idle = [shard for shard in merged['shards'] if shard['status'] != 'completed' and not shard['live']]
+            shard_publisher().publish([shard_message(coordinator, shard) for shard in idle])
+            return ('resumed' if idle else 'already_running'), coordinator
+    elif job_is_live(coordinator):
+        return 'already_running', coordinator
+
+    points = shard_boundaries(bucket_name, shards, shard_by)
+    coordinator = {
+        'job_id': job_id,
+        'bucket': bucket_name,
+        'hash_mode': hash_mode or HASH_MODE,
+        'engine': engine or BULK_ENGINE,
+        'chunking': CHUNKING if chunking is None else chunking,
+        'shard_by': shard_by,
+        'status': 'running',
+        'instance': INSTANCE_ID,
+        'shards': [{'job_id': f'{job_id}-shard{position:03d}', 'start_offset': start, 'end_offset': end}
+                   for position, (start, end) in enumerate(shard_ranges(points))],
+        'started_at': now_iso(),
+        'updated_at': None,
+        'finished_at': None,
+        'error': None
+    }
+    checkpoints.save(coordinator)
+    shard_publisher().publish([shard_message(coordinator, shard) for shard in coordinator['shards']])
+    print(f"Job {job_id}: published {len(coordinator['shards'])} shards of bucket {bucket_name}")
+    return 'started', coordinator
+
+
+def parse_shards(params):
+    """(shards, shard_by) from request parameters, or raise ValueError."""
+    try:
+        shards = int(params.get('shards', 1))
+    except (TypeError, ValueError):
+        shards = 0
+    if not 1 <= shards <= MAX_SHARDS:
+        raise ValueError(f'shards must be an integer between 1 and {MAX_SHARDS}')
+    shard_by = params.get('shard_by', 'range')
+    if shard_by not in SHARD_MODES:
+        raise ValueError(f'Unknown shard_by {shard_by!r}, expected one of {", ".join(SHARD_MODES)}')
+    return shards, shard_by
+
+
+def index_lock(bucket_name):
+    with index_locks_lock:
+        return index_locks.setdefault(bucket_name, threading.Lock())
+
+
+def rebuild_index(bucket_name, client=None):
+    client = client or get_storage_client()
+    bucket = client.bucket(bucket_name)
+    resources = (blob._properties for blob in bucket.list_blobs() if not is_state_object(blob.name))
+    count = hash_index.rebuild(bucket_name, resources)
+    print(f'Indexed {count} files in bucket {bucket_name}')
+    return count
+
+
+def reindex_bucket(bucket_name, client=None):
+    """Rebuild the bucket's entries in the hash index from a full listing,
+    after any rebuild of the bucket already running."""
+    with index_lock(bucket_name):
+        return rebuild_index(bucket_name, client)
+
+
+def refresh_index(bucket_name):
+    """Rebuild the bucket's index on a background thread, unless a rebuild
+    of it is already running."""
+    lock = index_lock(bucket_name)
+    if not lock.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            rebuild_index(bucket_name)
+        except Exception as e:
+            print(f'error: refreshing the index of {bucket_name} failed: {e}')
+        finally:
+            lock.release()
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def get_hash_index(bucket_name):
+    """Return the hash index, building it from a listing the first time a
+    bucket is queried on this instance; concurrent first requests wait for
+    a single build. An index older than HASH_INDEX_MAX_AGE is returned as
+    is and refreshed in the background."""
+    age = hash_index.age(bucket_name)
+    if age is None:
+        with index_lock(bucket_name):
+            if not hash_index.is_indexed(bucket_name):
+                rebuild_index(bucket_name)
+    elif HASH_INDEX_MAX_AGE and age > HASH_INDEX_MAX_AGE:
+        refresh_index(bucket_name)
+    return hash_index
+
+
 @app.route('/pubsub', methods=['POST'])
 def pubsub_trigger():
     envelope = request.get_json()
@@ -127,6 +864,8 @@ def pubsub_trigger():
     pubsub_message = envelope['message']
 
     if isinstance(pubsub_message, dict) and 'data' in pubsub_message:
+        # Set on GCS bucket notifications; absent on manually published messages
+        event_type = (pubsub_message.get('attributes') or {}).get('eventType')
         try:
             data = json.loads(base64.b64decode(pubsub_message['data']).decode('utf-8'))
         except Exception as e:
@@ -137,26 +876,76 @@ def pubsub_trigger():
         bucket_name = data.get('bucket', BUCKET_NAME)
         file_name = data.get('name')
         process_all = data.get('process_all', False)
+        hash_mode = data.get('hash_mode', HASH_MODE)
+        chunking = is_true(data.get('chunking', CHUNKING))
 
         if not bucket_name:
             msg = 'Pub/Sub message missing bucket name'
             print(f'error: {msg}')
             return f'Bad Request: {msg}', 400
 
+        if hash_mode not in HASH_MODES:
+            msg = f'Unknown hash_mode {hash_mode!r}, expected one of {", ".join(HASH_MODES)}'
+            print(f'error: {msg}')
+            return f'Bad Request: {msg}', 400
+
+        try:
+            shards, shard_by = parse_shards(data)
+        except ValueError as e:
+            print(f'error: {e}')
+            return f'Bad Request: {e}', 400
+
+        if file_name and is_state_object(file_name):
+            return jsonify({
+                'status': 'ignored',
+                'file_ignored': file_name
+            }), 200
+
         try:
-            if process_all:
-                results = process_all_files(bucket_name)
+            if event_type in ('OBJECT_DELETE', 'OBJECT_ARCHIVE') and file_name:
+                hash_index.delete(bucket_name, file_name, data.get('generation'))
+                return jsonify({
+                    'status': 'removed_from_index',
+                    'file_removed': file_name
+                }), 200
+            elif event_type == 'OBJECT_METADATA_UPDATE' and file_name:
+                # Includes the updates process_file makes itself; hashing is
+                # only triggered by new objects, so a metadata change (or a
+                # removed file_hash) must not start another download.
+                hash_index.upsert(bucket_name, data)
                 return jsonify({
-                    'status': 'success',
-                    'files_processed': len(results)
+                    'status': 'indexed',
+                    'file_indexed': file_name
                 }), 200
+            elif process_all:
+                # Runs in the background; a redelivered message for a job that
+                # is still running does not start a second copy. Messages
+                # with a parent_job are shards published by start_sharded_job.
+                job_id = data.get('job_id', DEFAULT_JOB_ID)
+                if shards > 1 and not data.get('parent_job'):
+                    status, _ = start_sharded_job(bucket_name, shards, hash_mode, job_id, data.get('engine'),
+                                                  chunking, shard_by)
+                else:
+                    shard = {key: data.get(key) for key in SHARD_KEYS} if data.get('parent_job') else None
+                    started = start_process_all_job(bucket_name, hash_mode, job_id, data.get('engine'), chunking,
+                                                    shard)
+                    status = 'started' if started else 'already_running'
+                return jsonify({
+                    'status': status,
+                    'job_id': job_id
+                }), 202
             elif file_name:
-                file_hash, processed_name = process_file(bucket_name, file_name)
+                # GCS notifications carry the full object resource, which
+                # saves a metadata GET before hashing.
+                properties = data if data.get('kind') == 'storage#object' else None
+                file_hash, processed_name, hash_source = process_file(bucket_name, file_name, hash_mode, properties,
+                                                                      chunking)
                 if file_hash:
                     return jsonify({
                         'status': 'success',
                         'file_processed': processed_name,
-                        'file_hash': file_hash
+                        'file_hash': file_hash,
+                        'hash_source': hash_source
                     }), 200
                 else:
                     return jsonify({
@@ -177,19 +966,86 @@ def pubsub_trigger():
     return f'Bad Request: {msg}', 400
 
 
+@app.route('/process-bucket', methods=['GET', 'POST'])
+def process_bucket():
+    params = {**request.args, **(request.get_json(silent=True) or {})}
+    bucket_name = params.get('bucket', BUCKET_NAME)
+    hash_mode = params.get('hash_mode', HASH_MODE)
+    job_id = params.get('job_id', DEFAULT_JOB_ID)
+    engine = params.get('engine', BULK_ENGINE)
+    chunking = is_true(params.get('chunking', CHUNKING))
+
+    if not bucket_name:
+        return jsonify({'error': 'Bucket name is required'}), 400
+    if hash_mode not in HASH_MODES:
+        return jsonify({'error': f'Unknown hash_mode {hash_mode!r}, expected one of {", ".join(HASH_MODES)}'}), 400
+    if engine not in BULK_ENGINES:
+        return jsonify({'error': f'Unknown engine {engine!r}, expected one of {", ".join(BULK_ENGINES)}'}), 400
+    try:
+        shards, shard_by = parse_shards(params)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        if shards > 1:
+            status, coordinator = start_sharded_job(bucket_name, shards, hash_mode, job_id, engine, chunking,
+                                                    shard_by)
+            shards = len(coordinator['shards'])
+        else:
+            status = 'started' if start_process_all_job(bucket_name, hash_mode, job_id, engine, chunking) \
+                else 'already_running'
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    return jsonify({
+        'status': status,
+        'job_id': job_id,
+        'shards': shards,
+        'status_url': f'/jobs/{job_id}?bucket={bucket_name}'
+    }), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    bucket_name = request.args.get('bucket', BUCKET_NAME)
+    if not bucket_name:
+        return jsonify({'error': 'Bucket name is required'}), 400
+
+    state = CheckpointStore(get_storage_client(), bucket_name).load(job_id)
+    if state is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    if 'shards' in state:
+        # A sharded job: its coordinator state merged with its shards' states
+        state = merge_shard_states(state, load_shard_states(bucket_name, state), job_is_live)
+        live = any(shard['live'] for shard in state['shards'])
+    else:
+        live = job_is_live(state)
+    finished_at = state['finished_at'] or now_iso()
+    elapsed = (datetime.fromisoformat(finished_at) - datetime.fromisoformat(state['started_at'])).total_seconds()
+    completed_in_page = len(state.pop('completed_names', []))
+    thread = running_jobs.get((bucket_name, job_id))
+
+    return jsonify({
+        **state,
+        'completed_in_current_page': completed_in_page,
+        'files_per_second': round(state['files_processed'] / elapsed, 2) if elapsed > 0 else None,
+        'live': live,
+        'running_on_this_instance': thread is not None and thread.is_alive()
+    }), 200
+
+
 @app.route('/get-bucket-stats', methods=['GET'])
 def get_bucket_stats():
     bucket_name = request.args.get('bucket', BUCKET_NAME)
     if not bucket_name:
         return jsonify({'error': 'Bucket name is required'}), 400
 
-    client = get_storage_client()
-    bucket = client.bucket(bucket_name)
-    blobs = list(bucket.list_blobs())
-    total_count = len(blobs)
+    stats = get_hash_index(bucket_name).stats(bucket_name)
+    total_count = stats['total_files']
 
     # Count files with and without file_hash metadata
-    files_with_hash = sum(1 for blob in blobs if blob.metadata and 'file_hash' in blob.metadata)
+    files_with_hash = stats['files_with_hash']
     files_without_hash = total_count - files_with_hash
 
     return jsonify({
@@ -199,78 +1055,98 @@ def get_bucket_stats():
     }), 200
 
 
+def parse_report_params(args, sections):
+    """Filters and paging of the duplicate report endpoints over
+    ``sections``, as keyword arguments of Report.page(); raises ValueError
+    on invalid values, including a cursor made for another query."""
+    sort = args.get('sort', 'name')
+    if sort not in SORT_ORDERS:
+        raise ValueError(f'Unknown sort {sort!r}, expected one of {", ".join(SORT_ORDERS)}')
+    try:
+        min_size = int(args.get('min_size', 0))
+        limit = int(args['limit']) if args.get('limit') else None
+    except ValueError:
+        raise ValueError('min_size and limit must be integers')
+    if min_size < 0 or (limit is not None and limit < 1):
+        raise ValueError('min_size must not be negative and limit must be positive')
+    cursor = args.get('cursor') or None
+    if cursor:
+        decode_cursor(cursor, sort, sections)
+    return {'sort': sort, 'prefix': args.get('prefix') or None, 'min_size': min_size, 'limit': limit,
+            'cursor': cursor}
+
+
+def report_response(endpoint, bucket_name, build, sections, params):
+    """Answer a duplicate report request from the report cache.
+
+    The ETag covers the bucket's listing generation and the query, so a
+    client holding the current one gets a 304 without the report being
+    looked at. Otherwise the page is streamed a group at a time, with the
+    cursor of the next page (null on the last one).
+    """
+    generation = get_hash_index(bucket_name).listing_generation(bucket_name)
+    tag = etag(endpoint, bucket_name, generation, sections, params)
+    if request.if_none_match.contains(tag):
+        metrics.REPORT_REQUESTS.labels(endpoint, 'not_modified').inc()
+        response = Response(status=304)
+    else:
+        report, cached = report_cache.get((endpoint, bucket_name), generation, build)
+        metrics.REPORT_REQUESTS.labels(endpoint, 'cached' if cached else 'built').inc()
+        page, next_cursor = report.page(sections, **params)
+        response = Response(iter_json(report.summary, page, {'next_cursor': next_cursor}),
+                            content_type='application/json')
+    response.set_etag(tag)
+    # Cached copies must be revalidated, since the next write changes the report
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def identical_files_report(bucket_name):
+    with metrics.stage('report') as span:
+        results = find_duplicates(hash_index.iter_hashed(bucket_name))
+        counts = results.pop('counts')
+        span.items = counts['total_duplicate_count']
+    return Report(results, {'counts': counts})
+
+
 @app.route('/find-identical-files', methods=['GET'])
 def find_identical_files():
+    """Duplicate groups of the three categories (all of them, or the
+    comma-separated ``category`` ones), optionally filtered by ``prefix``
+    and ``min_size``, sorted by ``sort`` (name or reclaimable) and paged
+    ``limit`` groups at a time from ``cursor``."""
     bucket_name = request.args.get('bucket', BUCKET_NAME)
     if not bucket_name:
         return jsonify({'error': 'Bucket name is required'}), 400
+    categories = request.args.get('category')
+    sections = tuple(categories.split(',')) if categories else CATEGORIES
+    unknown = [category for category in sections if category not in CATEGORIES]
+    if unknown:
+        return jsonify({'error': f'Unknown category {unknown[0]!r}, expected one of {", ".join(CATEGORIES)}'}), 400
+    try:
+        params = parse_report_params(request.args, sections)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    client = get_storage_client()
-    bucket = client.bucket(bucket_name)
-    blobs = bucket.list_blobs()
-
-    # Group files by hash, size, and name
-    file_groups = defaultdict(list)
-    for blob in blobs:
-        if blob.metadata and 'file_hash' in blob.metadata:
-            file_hash = blob.metadata['file_hash']
-            file_size = blob.metadata['size']
-            file_name = os.path.basename(blob.name)
-            file_groups[(file_hash, file_size)].append({
-                'name': blob.name,
-                'size': file_size,
-                'hash': file_hash
-            })
-
-    # Organize results
-    results = {
-        'identical_content_and_name': [],
-        'identical_content_different_name': [],
-        'identical_name_different_content': []
-    }
+    return report_response('find-identical-files', bucket_name, lambda: identical_files_report(bucket_name),
+                           sections, params)
 
-    counts = {
-        'identical_content_and_name': 0,
-        'identical_content_different_name': 0,
-        'identical_name_different_content': 0,
-        'total_duplicate_count': 0
-    }
 
-    for (file_hash, file_size), files in file_groups.items():
-        if len(files) > 1:
-            # Check for identical content (hash and size) and name
-            name_groups = defaultdict(list)
-            for file in files:
-                name_groups[os.path.basename(file['name'])].append(file)
-
-            for name, group in name_groups.items():
-                if len(group) > 1:
-                    results['identical_content_and_name'].append(group)
-                    counts['identical_content_and_name'] += len(group) - 1
-                    counts['total_duplicate_count'] += len(group) - 1
-                elif len(files) > len(group):
-                    results['identical_content_different_name'].append(files)
-                    counts['identical_content_different_name'] += len(files) - 1
-                    counts['total_duplicate_count'] += len(files) - 1
-
-    # Check for identical names with different content
-    name_groups = defaultdict(list)
-    for blob in blobs:
-        if blob.metadata and 'file_hash' in blob.metadata:
-            name_groups[os.path.basename(blob.name)].append({
-                'name': blob.name,
-                'size': blob.metadata['size'],
-                'hash': blob.metadata['file_hash']
-            })
-
-    for name, group in name_groups.items():
-        if len(group) > 1 and len(set((file['hash'], file['size']) for file in group)) > 1:
-            results['identical_name_different_content'].append(group)
-            counts['identical_name_different_content'] += len(group) - 1
-            counts['total_duplicate_count'] += len(group) - 1
-
-    # Add counts to results
-    results['counts'] = counts
+@app.route('/find-similar-files', methods=['GET'])
+def find_similar_files():
+    """Pairs of files sharing at least ``min_ratio`` of the smaller one's
+    bytes in content-defined chunks, and the bytes chunk-level dedup would
+    reclaim. Only covers files chunked by a job run with chunking."""
+    bucket_name = request.args.get('bucket', BUCKET_NAME)
+    if not bucket_name:
+        return jsonify({'error': 'Bucket name is required'}), 400
+    try:
+        min_ratio = float(request.args.get('min_ratio', 0.5))
+    except ValueError:
+        return jsonify({'error': 'min_ratio must be a number'}), 400
+
+    rows = get_hash_index(bucket_name).iter_chunks(bucket_name, new_chunker().params)
+    results = shared_chunk_pairs(rows, min_ratio, CDC_MAX_CHUNK_FANOUT)
 
     return jsonify(results), 200
 
@@ -295,89 +1171,161 @@ def get_file_metadata():
         return jsonify({'error': 'No metadata found for this file'}), 404
 
 
+def remove_all_file_hash_metadata_threads(bucket_name, num_threads=None):
+    """Returns (files_listed, files_patched, failed_names, throughput)."""
+    bucket = get_storage_client().bucket(bucket_name)
+    num_threads = num_threads or BULK_THREADS
+    scheduler = new_scheduler(num_threads)
+
+    processed_count = 0
+    # The listing already returns each object's metadata, so objects without
+    # hash keys are skipped and the rest are patched without another GET.
+    with metadata_writer(bucket_name, max_workers=num_threads, scheduler=scheduler) as writer:
+        for blob in bucket.list_blobs():
+            if is_state_object(blob.name):
+                continue
+            processed_count += 1
+            removal = hash_metadata_removal(blob.metadata)
+            if removal is not None:
+                writer.add(blob.name, removal)
+            if processed_count % 1000 == 0:
+                print(f"Processed {processed_count} files")
+        removed_count, failed = writer.flush()
+    return processed_count, removed_count, failed, scheduler.report()
+
+
+async def remove_all_file_hash_metadata_async(bucket_name):
+    """remove_all_file_hash_metadata_threads on the async engine."""
+    processed_count = 0
+    patched_resources = []
+    scheduler = new_scheduler(ASYNC_CONCURRENCY, AsyncBulkScheduler)
+    async with AsyncStorage(scheduler, ASYNC_DOWNLOAD_CONCURRENCY) as gcs:
+        patcher = AsyncBatchPatcher(gcs, bucket_name, PATCH_BATCH_SIZE, on_patched=patched_resources.append)
+        async for items, _ in gcs.list_pages(bucket_name):
+            for resource in items:
+                if is_state_object(resource['name']):
+                    continue
+                processed_count += 1
+                removal = hash_metadata_removal(resource.get('metadata'))
+                if removal is not None:
+                    patcher.add(resource['name'], removal)
+            # Batches queued so far are sent while the next page is listed
+            resources, patched_resources[:] = list(patched_resources), []
+            await asyncio.to_thread(hash_index.upsert_many, bucket_name, resources)
+            print(f"Processed {processed_count} files")
+        removed_count, failed = await patcher.flush()
+        await asyncio.to_thread(hash_index.upsert_many, bucket_name, patched_resources)
+    return processed_count, removed_count, failed, scheduler.report()
+
+
 @app.route('/remove-all-file-hash-metadata', methods=['GET'])
 def remove_all_file_hash_metadata():
     bucket_name = request.args.get('bucket', BUCKET_NAME)
-    num_threads = request.args.get('num_threads', 10)  # Default to 10 threads if not specified
+    engine = request.args.get('engine', BULK_ENGINE)
+    try:
+        num_threads = int(request.args.get('num_threads', BULK_THREADS))
+    except ValueError:
+        num_threads = 0
 
     if not bucket_name:
         return jsonify({'error': 'Bucket name is required'}), 400
-
-    client = get_storage_client()
-    bucket = client.bucket(bucket_name)
-    blobs = list(bucket.list_blobs())
-
-    processed_count = 0
-    removed_count = 0
-
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        future_to_blob = {executor.submit(remove_file_hash_metadata, bucket_name, blob.name): blob for blob in blobs}
-
-        for future in as_completed(future_to_blob):
-            blob = future_to_blob[future]
-            try:
-                result = future.result()
-                processed_count += 1
-                if result:
-                    removed_count += 1
-                if processed_count % 100 == 0:
-                    print(f"Processed {processed_count} files, removed metadata from {removed_count} files")
-            except Exception as exc:
-                print(f'{blob.name} generated an exception: {exc}')
+    if engine not in BULK_ENGINES:
+        return jsonify({'error': f'Unknown engine {engine!r}, expected one of {", ".join(BULK_ENGINES)}'}), 400
+    if num_threads < 1:
+        return jsonify({'error': 'num_threads must be a positive integer'}), 400
+
+    if engine == 'async':
+        processed_count, removed_count, failed, throughput = asyncio.run(
+            remove_all_file_hash_metadata_async(bucket_name))
+    else:
+        processed_count, removed_count, failed, throughput = remove_all_file_hash_metadata_threads(
+            bucket_name, num_threads)
 
     return jsonify({
         'status': 'success',
         'total_files_processed': processed_count,
-        'files_with_metadata_removed': removed_count
+        'files_with_metadata_removed': removed_count,
+        'files_failed': len(failed),
+        'throughput': throughput
     }), 200
 
 
 def compare_files_md5(bucket_name):
-    client = get_storage_client()
-    bucket = client.bucket(bucket_name)
-    blobs = list(bucket.list_blobs())
+    index = get_hash_index(bucket_name)
 
-    md5_groups = defaultdict(list)
-    for blob in blobs:
-        if blob.md5_hash:
-            md5_groups[blob.md5_hash].append({
-                'name': blob.name,
-                'size': blob.size,
-                'updated': blob.updated.isoformat() if blob.updated else None,
-                'content_type': blob.content_type
-            })
-
-    unique_files = []
     duplicate_groups = []
-
-    for md5_hash, files in md5_groups.items():
-        if len(files) == 1:
-            unique_files.append(files[0])
-        else:
-            duplicate_groups.append(files)
+    current_md5 = None
+    for md5_hash, name, size, updated, content_type in index.iter_md5_duplicates(bucket_name):
+        if md5_hash != current_md5:
+            duplicate_groups.append([])
+            current_md5 = md5_hash
+        duplicate_groups[-1].append({
+            'name': name,
+            'size': size,
+            'updated': updated,
+            'content_type': content_type
+        })
+
+    total_files, unique_count = index.md5_counts(bucket_name)
 
     return {
         'duplicate_groups': duplicate_groups,
-        'total_files': len(blobs),
-        'unique_count': len(unique_files),
+        'total_files': total_files,
+        'unique_count': unique_count,
         'duplicate_count': sum(len(group) for group in duplicate_groups)
     }
 
 
+def md5_report(bucket_name):
+    with metrics.stage('report') as span:
+        result = compare_files_md5(bucket_name)
+        span.items = result['duplicate_count']
+    return Report({'duplicate_groups': result.pop('duplicate_groups')}, result)
+
+
 @app.route('/compare-files-md5', methods=['GET'])
 def compare_files_md5_endpoint():
+    """Groups of files sharing a server-side md5, with the filters, sort
+    and paging of /find-identical-files."""
     bucket_name = request.args.get('bucket') or BUCKET_NAME
 
     if not bucket_name:
         return jsonify({'error': 'Bucket name is required'}), 400
+    sections = ('duplicate_groups',)
+    try:
+        params = parse_report_params(request.args, sections)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     try:
-        result = compare_files_md5(bucket_name)
-        return jsonify(result), 200
+        return report_response('compare-files-md5', bucket_name, lambda: md5_report(bucket_name), sections,
+                               params)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/reindex', methods=['GET', 'POST'])
+def reindex():
+    bucket_name = request.args.get('bucket', BUCKET_NAME)
+    if not bucket_name:
+        return jsonify({'error': 'Bucket name is required'}), 400
+
+    try:
+        indexed_count = reindex_bucket(bucket_name)
+        return jsonify({
+            'status': 'success',
+            'files_indexed': indexed_count
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    body, content_type = metrics.exposition()
+    return Response(body, content_type=content_type)
+
+
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 8080))
     app.run(debug=False, host='0.0.0.0', port=port)
@@ -0,0 +1,137 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+
+from google.cloud.storage.retry import DEFAULT_RETRY
+
+import metrics
+
+# The JSON API accepts up to 100 calls per batch request.
+MAX_BATCH_SIZE = 100
+
+
+class MetadataBatchWriter:
+    """Sends custom metadata patches through the GCS batch API.
+
+    Patches queued with add() are grouped into batch requests of up to
+    ``batch_size`` objects, sent from a small thread pool (each thread uses
+    its own client from ``client_factory``). Items that fail inside a batch
+    are retried one by one with the default retry policy, which backs off on
+    429s and 5xx responses; items that still fail are reported by flush().
+    With a ``scheduler`` (a scheduler.BulkScheduler), batches take a slot of
+    it and failed items are retried through it instead, so throttled patches
+    slow the rest of the run down.
+
+    add() must be called from a single thread. ``on_patched`` is called with
+    the updated object resource of every successful patch, from the pool.
+    """
+
+    def __init__(self, bucket_name, client_factory, batch_size=MAX_BATCH_SIZE, max_workers=4,
+                 on_patched=None, scheduler=None):
+        self.bucket_name = bucket_name
+        self.client_factory = client_factory
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.max_workers = max_workers
+        self.on_patched = on_patched
+        self.scheduler = scheduler
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._pending = []
+        self._futures = set()
+        self._patched = 0
+        self._failed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add(self, name, metadata, generation=None):
+        """Queue a patch of the object's custom metadata; None values delete keys.
+
+        With ``generation`` the patch only applies to that generation, so a
+        hash is never written onto a newer upload of the same name.
+        """
+        self._pending.append((name, metadata, generation))
+        if len(self._pending) >= self.batch_size:
+            self._submit()
+
+    def _submit(self):
+        if not self._pending:
+            return
+        # Keep a bounded number of batches queued on the pool
+        while len(self._futures) >= 2 * self.max_workers:
+            done, self._futures = wait(self._futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                self._collect(future)
+        items, self._pending = self._pending, []
+        self._futures.add(self._executor.submit(self._send, items))
+        metrics.QUEUE_DEPTH.labels('patch_batches').set(len(self._futures))
+
+    def _collect(self, future):
+        patched, failed = future.result()
+        self._patched += patched
+        self._failed.extend(failed)
+
+    def _patch_request(self, bucket, name, metadata, generation, retry=None):
+        blob = bucket.blob(name)
+        blob.metadata = metadata
+        blob.patch(if_generation_match=generation, retry=retry)
+        return blob
+
+    def _retry_patch(self, bucket, name, metadata, generation):
+        if self.scheduler is None:
+            return self._patch_request(bucket, name, metadata, generation, DEFAULT_RETRY)
+        return self.scheduler.call('patch', lambda: self._patch_request(bucket, name, metadata, generation))
+
+    def _send(self, items):
+        client = self.client_factory()
+        bucket = client.bucket(self.bucket_name)
+
+        slot = self.scheduler.slot('patch') if self.scheduler is not None else nullcontext()
+        blobs = []
+        try:
+            with metrics.stage('patch', items=len(items)), slot, client.batch():
+                for name, metadata, generation in items:
+                    blobs.append(self._patch_request(bucket, name, metadata, generation))
+        except Exception as exc:
+            # Raised for the first failed item once all responses are in;
+            # the successful ones have their properties populated already.
+            print(f'Batch of {len(items)} metadata patches had failures: {exc}')
+
+        patched = 0
+        failed = []
+        for position, (name, metadata, generation) in enumerate(items):
+            blob = blobs[position] if position < len(blobs) else None
+            # Failed items are left holding the batch's placeholder properties
+            if blob is None or type(blob._properties) is not dict or 'name' not in blob._properties:
+                try:
+                    blob = self._retry_patch(bucket, name, metadata, generation)
+                except Exception as exc:
+                    print(f'{name} metadata patch failed: {exc}')
+                    failed.append(name)
+                    continue
+            patched += 1
+            if self.on_patched is not None:
+                self.on_patched(blob._properties)
+        return patched, failed
+
+    def flush(self):
+        """Send everything queued and wait for it.
+
+        Returns (patched, failed_names) for the patches completed since the
+        previous flush.
+        """
+        self._submit()
+        done, _ = wait(self._futures)
+        self._futures = set()
+        metrics.QUEUE_DEPTH.labels('patch_batches').set(0)
+        for future in done:
+            self._collect(future)
+        patched, failed = self._patched, self._failed
+        self._patched, self._failed = 0, []
+        return patched, failed
+
+    def close(self):
+        result = self.flush()
+        self._executor.shutdown()
+        return result
@@ -0,0 +1,97 @@
+import itertools
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Print a JSON line per stage span (stage, seconds, items, bytes), which
+# Cloud Logging turns into structured entries
+TRACE_STAGES = os.environ.get('TRACE_STAGES', 'false').lower() == 'true'
+# Per-object log lines: 1 prints every one, N > 1 prints one in N as a
+# debug line, 0 prints none
+ITEM_LOG_SAMPLE = int(os.environ.get('ITEM_LOG_SAMPLE', 1))
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+STAGE_SECONDS = Histogram('gcs_hash_processor_stage_seconds', 'Time spent per call of each pipeline stage',
+                          ['stage'], buckets=STAGE_BUCKETS)
+STAGE_ITEMS = Counter('gcs_hash_processor_stage_items_total',
+                      'Objects (or batch entries) through each pipeline stage', ['stage'])
+STAGE_BYTES = Counter('gcs_hash_processor_stage_bytes_total',
+                      'Bytes through each pipeline stage; rate() gives bytes/sec', ['stage'])
+STAGE_ERRORS = Counter('gcs_hash_processor_stage_errors_total', 'Stage calls that raised', ['stage'])
+QUEUE_DEPTH = Gauge('gcs_hash_processor_queue_depth', 'Work queued or in flight', ['queue'])
+REPORT_REQUESTS = Counter('gcs_hash_processor_report_requests_total',
+                          'Duplicate report requests by how they were answered: not_modified, cached or built',
+                          ['endpoint', 'outcome'])
+CONCURRENCY_LIMIT = Gauge('gcs_hash_processor_concurrency_limit',
+                          'Requests the bulk scheduler currently allows in flight')
+
+_item_counter = itertools.count()
+
+
+class Span:
+    """What a stage call handled; set ``items`` and ``nbytes`` inside it."""
+
+    def __init__(self, items, nbytes):
+        self.items = items
+        self.nbytes = nbytes
+
+
+def _record(name, elapsed, items, nbytes):
+    STAGE_SECONDS.labels(name).observe(elapsed)
+    STAGE_ITEMS.labels(name).inc(items)
+    if nbytes:
+        STAGE_BYTES.labels(name).inc(nbytes)
+    if TRACE_STAGES:
+        print(json.dumps({'span': name, 'seconds': round(elapsed, 6), 'items': items, 'bytes': nbytes}))
+
+
+@contextmanager
+def stage(name, items=1, nbytes=0):
+    """Time a call of a pipeline stage (list, download, hash, patch).
+
+    Works around awaits as well, in which case the time includes waiting
+    for the event loop.
+    """
+    span = Span(items, nbytes)
+    started = time.perf_counter()
+    try:
+        yield span
+    except BaseException:
+        STAGE_ERRORS.labels(name).inc()
+        raise
+    finally:
+        _record(name, time.perf_counter() - started, span.items, span.nbytes)
+
+
+def timed(iterable, name, count=None):
+    """Yield from ``iterable``, timing the production of each element as a
+    call of stage ``name``; ``count(element)`` gives its number of items."""
+    iterator = iter(iterable)
+    while True:
+        started = time.perf_counter()
+        try:
+            element = next(iterator)
+        except StopIteration:
+            return
+        except Exception:
+            STAGE_ERRORS.labels(name).inc()
+            raise
+        _record(name, time.perf_counter() - started, count(element) if count else 1, 0)
+        yield element
+
+
+def log_item(message):
+    """Print a per-object line, subject to ITEM_LOG_SAMPLE."""
+    if ITEM_LOG_SAMPLE == 1:
+        print(message)
+    elif ITEM_LOG_SAMPLE > 1 and next(_item_counter) % ITEM_LOG_SAMPLE == 0:
+        print(f'debug: {message}')
+
+
+def exposition():
+    """Body and content type of the /metrics response."""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,194 @@
+import base64
+import binascii
+import hashlib
+import json
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+
+SORT_ORDERS = ('name', 'reclaimable')
+
+
+def _size(file):
+    """Size of a file entry as an int; entries give it as an int, a numeric
+    string or 'unknown'/None."""
+    size = file.get('size')
+    if isinstance(size, int):
+        return size
+    return int(size) if isinstance(size, str) and size.isdigit() else None
+
+
+def reclaimable_bytes(group):
+    """Bytes freed by keeping one copy of each distinct content in ``group``."""
+    copies = {}
+    for file in group:
+        size = _size(file)
+        if size is not None:
+            key = (file.get('hash'), size)
+            copies[key] = copies.get(key, 0) + 1
+    return sum(size * (count - 1) for (_, size), count in copies.items())
+
+
+class Report:
+    """A duplicate report split into lists of groups, ready to be filtered
+    and paged. ``sections`` maps each list's key in the response to its
+    groups; ``summary`` holds the rest of the response (counts, totals),
+    which always describes the whole bucket.
+
+    Groups are ordered by the name of their first file, which is unique
+    within a section since a file belongs to one group per section, and
+    by reclaimable bytes, largest first. The orders are computed once per
+    report and shared by every request answered from it.
+    """
+
+    def __init__(self, sections, summary):
+        self.sections = sections
+        self.summary = summary
+        self._orders = {}
+        self._lock = threading.Lock()
+
+    def _order(self, section, sort):
+        """(keys, positions) of the section's groups sorted by ``sort``."""
+        with self._lock:
+            if (section, sort) not in self._orders:
+                groups = self.sections[section]
+                if sort == 'reclaimable':
+                    keys = [(-reclaimable_bytes(group), group[0]['name']) for group in groups]
+                else:
+                    keys = [(group[0]['name'],) for group in groups]
+                positions = sorted(range(len(groups)), key=keys.__getitem__)
+                self._orders[section, sort] = ([keys[position] for position in positions], positions)
+            return self._orders[section, sort]
+
+    def page(self, sections, sort='name', prefix=None, min_size=0, limit=None, cursor=None):
+        """Groups of ``sections`` matching the filters, in ``sort`` order,
+        starting after ``cursor`` and up to ``limit`` of them overall.
+
+        A group matches ``prefix`` when one of its files is under it (the
+        whole group is returned, copies elsewhere included) and ``min_size``
+        when its largest file has at least that many bytes. Returns
+        ({section: groups}, next_cursor); next_cursor is None on the last
+        page. Cursors hold the sort key of the last group returned, so
+        paging goes on where it left off even if the report was rebuilt,
+        and only continue the ``sort`` and ``sections`` they were made for.
+        """
+        start_section, start_key = decode_cursor(cursor, sort, sections) if cursor else (0, None)
+        pages = {section: [] for section in sections}
+        remaining = limit
+        last = None
+        for index, section in enumerate(sections):
+            if index < start_section:
+                continue
+            keys, positions = self._order(section, sort)
+            first = bisect_right(keys, start_key) if index == start_section and start_key is not None else 0
+            groups = self.sections[section]
+            for offset in range(first, len(positions)):
+                group = groups[positions[offset]]
+                if prefix and not any(file['name'].startswith(prefix) for file in group):
+                    continue
+                if min_size and max((_size(file) or 0) for file in group) < min_size:
+                    continue
+                if remaining == 0:
+                    return pages, encode_cursor(sort, sections, *last)
+                pages[section].append(group)
+                last = (index, keys[offset])
+                if remaining is not None:
+                    remaining -= 1
+        return pages, None
+
+
+def encode_cursor(sort, sections, section_index, key):
+    data = json.dumps([sort, list(sections), section_index, key], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def _is_sort_key(key, sort):
+    if sort == 'reclaimable':
+        return len(key) == 2 and isinstance(key[0], int) and isinstance(key[1], str)
+    return len(key) == 1 and isinstance(key[0], str)
+
+
+def decode_cursor(cursor, sort, sections):
+    """(section_index, key) of a cursor made by encode_cursor for the same
+    ``sort`` and ``sections``; raises ValueError for a malformed cursor or
+    one made for another query."""
+    try:
+        cursor_sort, cursor_sections, section_index, key = json.loads(
+            base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        key = tuple(key)
+    except (binascii.Error, TypeError, ValueError) as e:
+        raise ValueError(f'Invalid cursor: {cursor!r}') from e
+    if cursor_sort != sort or cursor_sections != list(sections):
+        raise ValueError('The cursor belongs to a query with another sort or category')
+    if not isinstance(section_index, int) or not 0 <= section_index < len(sections) or not _is_sort_key(key, sort):
+        raise ValueError(f'Invalid cursor: {cursor!r}')
+    return section_index, key
+
+
+def etag(*parts):
+    """Strong ETag for a response determined by ``parts``."""
+    return hashlib.sha256(json.dumps(parts, separators=(',', ':')).encode()).hexdigest()[:32]
+
+
+def iter_json(head, sections, tail):
+    """Encode {**head, **sections, **tail} as JSON a group at a time, so a
+    large page is never held as a single string."""
+    encoder = json.JSONEncoder(separators=(',', ':'))
+    yield '{'
+    separator = ''
+    for key, value in head.items():
+        yield f'{separator}{encoder.encode(key)}:{encoder.encode(value)}'
+        separator = ','
+    for key, groups in sections.items():
+        yield f'{separator}{encoder.encode(key)}:['
+        for position, group in enumerate(groups):
+            yield (',' if position else '') + encoder.encode(group)
+        yield ']'
+        separator = ','
+    for key, value in tail.items():
+        yield f'{separator}{encoder.encode(key)}:{encoder.encode(value)}'
+        separator = ','
+    yield '}'
+
+
+class ReportCache:
+    """Reports of the last ``max_entries`` (endpoint, bucket) pairs, each
+    valid for the listing generation it was built at.
+
+    Requests that miss wait for a single build per key rather than each
+    rebuilding the report from the index.
+    """
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._builds = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key, generation):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == generation:
+            self._entries.move_to_end(key)
+            return entry[1]
+        return None
+
+    def get(self, key, generation, build):
+        """Return (report, hit): the cached report for ``generation`` or
+        a new one from ``build()``."""
+        with self._lock:
+            report = self._lookup(key, generation)
+            if report is not None:
+                return report, True
+            build_lock = self._builds.setdefault(key, threading.Lock())
+        with build_lock:
+            with self._lock:
+                report = self._lookup(key, generation)
+                if report is not None:
+                    return report, True
+            report = build()
+            with self._lock:
+                self._entries[key] = (generation, report)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return report, False
@@ -0,0 +1,297 @@
+import asyncio
+import random
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+import metrics
+
+# Statuses worth another attempt; everything else fails the request right away
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+# Weight of the newest sample in the smoothed latency of each request kind
+LATENCY_SMOOTHING = 0.2
+# The latency baseline of a kind creeps up by this factor per success, so a
+# lasting change in request cost becomes the new normal instead of being
+# read as congestion forever
+BASELINE_DRIFT = 1.001
+
+
+def status_of(exc):
+    """HTTP status of a failed request: 0 for connection errors and timeouts,
+    None when the exception does not come from a request at all."""
+    for attribute in ('status', 'code'):
+        status = getattr(exc, attribute, None)
+        if isinstance(status, int):
+            return status
+    if isinstance(exc, (ConnectionError, TimeoutError, asyncio.TimeoutError)):
+        return 0
+    # requests and google-auth transport errors
+    if type(exc).__name__ in ('ConnectionError', 'Timeout', 'ReadTimeout', 'ConnectTimeout', 'TransportError'):
+        return 0
+    return None
+
+
+def is_retryable(status):
+    return status == 0 or status in RETRYABLE_STATUSES
+
+
+def backoff(attempt, cap=32):
+    """Full-jitter exponential backoff before retry number ``attempt``."""
+    return random.uniform(0, min(cap, 0.5 * 2 ** attempt))
+
+
+class RateLimiter:
+    """Token bucket holding the request rate to ``rate`` per second.
+
+    The bucket starts empty and holds at most a twentieth of a second of
+    tokens, so no one-second window sees much more than ``rate`` requests.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.burst = max(1.0, rate / 20)
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token; returns the seconds to wait before sending."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return -self._tokens / self.rate if self._tokens < 0 else 0
+
+
+class AIMDController:
+    """Additive-increase/multiplicative-decrease limit on requests in flight.
+
+    Every successful request raises the limit by 1/limit, about one more
+    request per round trip. A retryable error (429, 5xx, a timeout) or a
+    smoothed latency more than ``latency_tolerance`` times the baseline of
+    its kind cuts the limit by ``decrease``, at most once per smoothed
+    latency: the requests already in flight were sent at the old limit, and
+    their errors must not cut it again. Kinds are keyed by request type and
+    the power of two of their size, so a small tail range is not compared
+    with a full chunk. A ``latency_tolerance`` of 0 only reacts to errors.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=256, latency_tolerance=3.0, decrease=0.7):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.latency_tolerance = latency_tolerance
+        self.decrease = decrease
+        self.lowest = self.highest = self.limit
+        self.decreases = 0
+        self._latency = {}
+        self._baseline = {}
+        self._last_decrease = 0.0
+        self._cooldown = 0.0
+
+    def on_success(self, kind, latency):
+        smoothed = self._latency.get(kind, latency)
+        smoothed += LATENCY_SMOOTHING * (latency - smoothed)
+        self._latency[kind] = smoothed
+        baseline = min(self._baseline.get(kind, smoothed) * BASELINE_DRIFT, smoothed)
+        self._baseline[kind] = baseline
+        self._cooldown = max(smoothed, self._cooldown * (1 - LATENCY_SMOOTHING))
+        if self.latency_tolerance and smoothed > self.latency_tolerance * baseline:
+            self.on_congestion()
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.highest = max(self.highest, self.limit)
+
+    def on_congestion(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self._cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        self.lowest = min(self.lowest, self.limit)
+        self.decreases += 1
+
+
+class _Scheduler:
+    """State and bookkeeping shared by the thread and asyncio schedulers."""
+
+    def __init__(self, initial=8, minimum=1, maximum=256, max_rps=0, latency_tolerance=3.0, max_attempts=5):
+        self.controller = AIMDController(initial, minimum, maximum, latency_tolerance)
+        self.max_rps = max_rps
+        self.max_attempts = max_attempts
+        self._rate = RateLimiter(max_rps) if max_rps else None
+        self._in_flight = 0
+        self._started = time.monotonic()
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+        self.failed = 0
+        self.nbytes = 0
+
+    @property
+    def maximum(self):
+        return self.controller.maximum
+
+    def _admissible(self):
+        return self._in_flight < max(1, int(self.controller.limit))
+
+    def _delay(self):
+        return self._rate.reserve() if self._rate is not None else 0
+
+    def _record(self, kind, size, latency, exc):
+        """Feed a finished request to the controller; call with the lock held."""
+        self.requests += 1
+        if exc is None:
+            self.nbytes += size
+            self.controller.on_success((kind, size.bit_length()), latency)
+        else:
+            status = status_of(exc)
+            if is_retryable(status):
+                if status in (429, 503):
+                    self.throttled += 1
+                self.controller.on_congestion()
+        metrics.CONCURRENCY_LIMIT.set(self.controller.limit)
+
+    def _should_retry(self, exc, attempt):
+        status = status_of(exc)
+        if attempt >= self.max_attempts or not is_retryable(status):
+            if status is not None:
+                self.failed += 1
+            return False
+        self.retries += 1
+        return True
+
+    def report(self):
+        """Throughput of the run so far, for job states and responses."""
+        elapsed = time.monotonic() - self._started
+        controller = self.controller
+        return {
+            'elapsed_seconds': round(elapsed, 2),
+            'requests': self.requests,
+            'retries': self.retries,
+            'throttled': self.throttled,
+            'failed': self.failed,
+            'bytes': self.nbytes,
+            'requests_per_second': round(self.requests / elapsed, 2) if elapsed > 0 else None,
+            'bytes_per_second': round(self.nbytes / elapsed) if elapsed > 0 else None,
+            'max_rps': self.max_rps or None,
+            'concurrency': {
+                'limit': round(controller.limit, 1),
+                'lowest': round(controller.lowest, 1),
+                'highest': round(controller.highest, 1),
+                'maximum': controller.maximum,
+                'decreases': controller.decreases
+            }
+        }
+
+
+class BulkScheduler(_Scheduler):
+    """Adaptive concurrency, a request rate cap and retries for the requests
+    of one bulk run, shared by all of its threads.
+
+    slot() wraps a single request attempt: it waits for room under the AIMD
+    limit and for a token of the ``max_rps`` cap (0 for none), then feeds the
+    outcome back to the controller. call() retries retryable failures with
+    jittered backoff, up to ``max_attempts`` attempts, so it should wrap
+    calls made with the client's own retries turned off (``retry=None``).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self, kind, size=0):
+        """Run one request attempt of type ``kind``, moving ``size`` bytes."""
+        with self._condition:
+            while not self._admissible():
+                self._condition.wait()
+            self._in_flight += 1
+        error = None
+        started = time.monotonic()
+        try:
+            delay = self._delay()
+            if delay:
+                time.sleep(delay)
+            started = time.monotonic()
+            yield
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            with self._condition:
+                self._in_flight -= 1
+                self._record(kind, size, time.monotonic() - started, error)
+                self._condition.notify_all()
+
+    def call(self, kind, fn, size=0):
+        """Return fn(), retrying it as one request of type ``kind``."""
+        attempt = 1
+        while True:
+            try:
+                with self.slot(kind, size):
+                    return fn()
+            except Exception as exc:
+                with self._condition:
+                    retry = self._should_retry(exc, attempt)
+                if not retry:
+                    raise
+            time.sleep(backoff(attempt))
+            attempt += 1
+
+    def congested(self, throttled=0):
+        """Report congestion seen outside a slot, such as throttled entries
+        of a batch request that itself succeeded."""
+        with self._condition:
+            self.throttled += throttled
+            self.controller.on_congestion()
+            metrics.CONCURRENCY_LIMIT.set(self.controller.limit)
+
+
+class AsyncBulkScheduler(_Scheduler):
+    """BulkScheduler for coroutines of one event loop."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._condition = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self, kind, size=0):
+        async with self._condition:
+            await self._condition.wait_for(self._admissible)
+            self._in_flight += 1
+        error = None
+        started = time.monotonic()
+        try:
+            delay = self._delay()
+            if delay:
+                await asyncio.sleep(delay)
+            started = time.monotonic()
+            yield
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            async with self._condition:
+                self._in_flight -= 1
+                self._record(kind, size, time.monotonic() - started, error)
+                self._condition.notify_all()
+
+    async def call(self, kind, fn, size=0):
+        """Return await fn(), retrying it as one request of type ``kind``."""
+        attempt = 1
+        while True:
+            try:
+                async with self.slot(kind, size):
+                    return await fn()
+            except Exception as exc:
+                if not self._should_retry(exc, attempt):
+                    raise
+            await asyncio.sleep(backoff(attempt))
+            attempt += 1
+
+    def congested(self, throttled=0):
+        self.throttled += throttled
+        self.controller.on_congestion()
+        metrics.CONCURRENCY_LIMIT.set(self.controller.limit)
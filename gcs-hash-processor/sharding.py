@@ -0,0 +1,174 @@
+import base64
+import json
+import os
+import queue
+import threading
+
+import google.auth
+import google.auth.transport.requests
+import requests
+
+# Names kept while sampling a listing for range boundaries; the sample
+# holds between this many and twice as many evenly spaced names
+SAMPLE_SIZE = 4096
+# Shard messages published per Pub/Sub publish call (the API allows 1000)
+PUBLISH_BATCH_SIZE = 100
+SHARD_MODES = ('range', 'prefix')
+
+# Counters of a job state that add up across shards
+COUNTERS = ('pages_completed', 'files_listed', 'files_processed', 'files_skipped', 'files_failed', 'files_chunked')
+# Throughput figures of the shards' runs that add up while they run side by side
+THROUGHPUT_SUMS = ('requests', 'retries', 'throttled', 'failed', 'bytes', 'requests_per_second', 'bytes_per_second')
+
+
+def sample_names(names, size=SAMPLE_SIZE):
+    """Evenly spaced sample of a sorted stream of names, in bounded memory.
+
+    Keeps every ``stride``-th name and, whenever more than ``2 * size`` are
+    kept, drops every other one and doubles the stride. Returns
+    (sample, total_names).
+    """
+    sample = []
+    stride = 1
+    total = 0
+    for position, name in enumerate(names):
+        total += 1
+        if position % stride:
+            continue
+        sample.append(name)
+        if len(sample) > 2 * size:
+            sample = sample[::2]
+            stride *= 2
+    return sample, total
+
+
+def split_points(keys, count):
+    """Up to ``count - 1`` boundaries cutting the sorted ``keys`` into
+    ``count`` runs of about the same length."""
+    points = []
+    for shard in range(1, count):
+        key = keys[len(keys) * shard // count] if keys else None
+        if key and (not points or key > points[-1]):
+            points.append(key)
+    return points
+
+
+def shard_ranges(points):
+    """(start_offset, end_offset) pairs covering the whole keyspace, cut at
+    ``points``: start offsets are inclusive, end offsets exclusive and None
+    leaves a side open, as in the GCS listing's startOffset/endOffset."""
+    bounds = [None, *points, None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def merge_shard_states(coordinator, shard_states, is_live):
+    """Job state of a sharded job, from the coordinator state and the
+    checkpointed state of each shard (None for shards not started yet).
+
+    Counters, hash sources and throughput are summed over the shards. The
+    job is completed once every shard is, and failed when a shard failed
+    and none is still being worked on.
+    """
+    merged = {key: value for key, value in coordinator.items() if key != 'shards'}
+    merged.update({counter: 0 for counter in COUNTERS})
+    merged.update(hash_sources={}, failed_names=[], throughput=None)
+    shards = []
+    for shard, state in zip(coordinator['shards'], shard_states):
+        summary = dict(shard)
+        if state is None:
+            summary.update(status='pending', live=False)
+            shards.append(summary)
+            continue
+        summary.update(status=state['status'], live=is_live(state), files_processed=state['files_processed'],
+                       instance=state['instance'], error=state['error'])
+        shards.append(summary)
+        for counter in COUNTERS:
+            merged[counter] += state.get(counter, 0)
+        for source, count in state['hash_sources'].items():
+            merged['hash_sources'][source] = merged['hash_sources'].get(source, 0) + count
+        merged['failed_names'].extend(state['failed_names'][:100 - len(merged['failed_names'])])
+        if summary['live'] and state.get('throughput'):
+            throughput = merged['throughput'] or {key: 0 for key in THROUGHPUT_SUMS}
+            for key in THROUGHPUT_SUMS:
+                throughput[key] += state['throughput'].get(key) or 0
+            merged['throughput'] = throughput
+
+    statuses = [shard['status'] for shard in shards]
+    if all(status == 'completed' for status in statuses):
+        merged['status'] = 'completed'
+        merged['finished_at'] = max(state['finished_at'] for state in shard_states)
+    elif 'failed' in statuses and not any(shard['live'] for shard in shards):
+        merged['status'] = 'failed'
+    else:
+        merged['status'] = 'running'
+    merged['shards'] = shards
+    merged['shard_counts'] = {status: statuses.count(status) for status in set(statuses)}
+    return merged
+
+
+class PubSubPublisher:
+    """Publishes shard messages to a Pub/Sub topic through the REST API.
+
+    ``topic`` is 'projects/<project>/topics/<topic>' or a bare topic name in
+    the default project. Honours PUBSUB_EMULATOR_HOST, in which case no
+    credentials are used. The messages look like the ones /pubsub receives
+    from its push subscription, so each shard lands on whichever instance
+    Pub/Sub delivers it to.
+    """
+
+    def __init__(self, topic):
+        emulator = os.environ.get('PUBSUB_EMULATOR_HOST')
+        if emulator:
+            self.session = requests.Session()
+            self.base_url = emulator if '://' in emulator else f'http://{emulator}'
+            project = os.environ.get('GOOGLE_CLOUD_PROJECT')
+        else:
+            credentials, project = google.auth.default(scopes=['https://www.googleapis.com/auth/pubsub'])
+            self.session = google.auth.transport.requests.AuthorizedSession(credentials)
+            self.base_url = 'https://pubsub.googleapis.com'
+        self.topic = topic if topic.startswith('projects/') else f'projects/{project}/topics/{topic}'
+
+    def publish(self, messages):
+        for start in range(0, len(messages), PUBLISH_BATCH_SIZE):
+            batch = [{'data': base64.b64encode(json.dumps(message).encode()).decode(),
+                      'attributes': {'shard_of': message['parent_job']}}
+                     for message in messages[start:start + PUBLISH_BATCH_SIZE]]
+            response = self.session.post(f'{self.base_url}/v1/{self.topic}:publish', json={'messages': batch},
+                                         timeout=60)
+            response.raise_for_status()
+
+
+class LocalShardQueue:
+    """Runs shard messages on this instance, ``workers`` at a time, for
+    tests and deployments without a shard topic. ``handler`` is called with
+    each message and runs its shard to completion."""
+
+    def __init__(self, handler, workers=2):
+        self.handler = handler
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def publish(self, messages):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        for message in messages:
+            self._queue.put(message)
+
+    def _work(self):
+        while True:
+            message = self._queue.get()
+            try:
+                self.handler(message)
+            except Exception as exc:
+                print(f"Shard {message['job_id']} failed: {exc}")
+            finally:
+                self._queue.task_done()
+
+    def join(self):
+        """Wait until every published shard has run."""
+        self._queue.join()
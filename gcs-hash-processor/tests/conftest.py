@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# The service's modules live at the top of its directory, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('HASH_INDEX_PATH', os.path.join(tempfile.mkdtemp(), 'index.sqlite3'))
+os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'test')
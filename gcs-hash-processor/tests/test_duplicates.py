@@ -0,0 +1,47 @@
+from duplicates import find_duplicates
+
+HASH_A = 'a' * 32
+HASH_B = 'b' * 32
+
+
+def names(groups):
+    return sorted(sorted(file['name'] for file in group) for group in groups)
+
+
+def test_categories():
+    results = find_duplicates([
+        ('p1/x.tif', 10, HASH_A),
+        ('p2/x.tif', 10, HASH_A),
+        ('p3/y.tif', 10, HASH_A),
+        ('p4/z.tif', 10, HASH_B),
+        ('p5/z.tif', 20, HASH_A),
+    ])
+    assert names(results['identical_content_and_name']) == [['p1/x.tif', 'p2/x.tif']]
+    assert names(results['identical_content_different_name']) == [['p1/x.tif', 'p2/x.tif', 'p3/y.tif']]
+    assert names(results['identical_name_different_content']) == [['p4/z.tif', 'p5/z.tif']]
+    assert results['counts']['total_duplicate_count'] == 3
+
+
+def test_basenames_are_compared_exactly():
+    # Many distinct basenames of the same content: each is its own name group
+    rows = [(f'plate{i % 3}/image{i}.tif', 10, HASH_A) for i in range(2000)]
+    results = find_duplicates(rows)
+    assert results['identical_content_and_name'] == []
+    assert results['identical_name_different_content'] == []
+    assert results['counts']['identical_content_different_name'] == 1999
+
+
+def test_colliding_basename_keys_are_told_apart(monkeypatch):
+    # Every basename gets the same 64-bit key
+    monkeypatch.setattr('builtins.hash', lambda value: 42)
+    results = find_duplicates([
+        ('p1/x.tif', 10, HASH_A),
+        ('p2/x.tif', 10, HASH_A),
+        ('p3/y.tif', 10, HASH_A),
+        ('p4/z.tif', 10, HASH_B),
+        ('p5/z.tif', 20, HASH_A),
+    ])
+    assert names(results['identical_content_and_name']) == [['p1/x.tif', 'p2/x.tif']]
+    assert names(results['identical_content_different_name']) == [['p1/x.tif', 'p2/x.tif', 'p3/y.tif']]
+    assert names(results['identical_name_different_content']) == [['p4/z.tif', 'p5/z.tif']]
+    assert results['counts']['total_duplicate_count'] == 3
@@ -0,0 +1,63 @@
+import base64
+import json
+import time
+
+import main
+
+BUCKET = 'rebuild-bucket'
+
+
+def resource(name, file_hash, generation):
+    return {'name': name, 'generation': str(generation), 'size': '100', 'md5Hash': f'md5-{file_hash}',
+            'metadata': {'file_hash': file_hash}}
+
+
+class FakeBlob:
+    def __init__(self, properties):
+        self.name = properties['name']
+        self._properties = properties
+
+
+class FakeBucket:
+    def __init__(self, resources, during_listing):
+        self.resources = resources
+        self.during_listing = during_listing
+
+    def list_blobs(self):
+        for position, properties in enumerate(self.resources):
+            yield FakeBlob(properties)
+            if position == 0:
+                self.during_listing()
+
+
+class FakeClient:
+    def __init__(self, bucket):
+        self._bucket = bucket
+
+    def bucket(self, name):
+        return self._bucket
+
+
+def notify(client, event_type, data):
+    message = {'data': base64.b64encode(json.dumps(data).encode()).decode(), 'attributes': {'eventType': event_type}}
+    return client.post('/pubsub', json={'message': message})
+
+
+def test_rebuild_keeps_objects_notified_during_the_listing():
+    client = main.app.test_client()
+    # Indexed before the rebuild and deleted since without a notification
+    main.hash_index.upsert(BUCKET, resource('gone.tif', 'aa', 1))
+    now = int(time.time() * 1_000_000)
+    listed = [resource('a.tif', 'ab', 1), resource('b.tif', 'ab', 2)]
+
+    def upload_during_listing():
+        # Created after the listing passed its name; only the notification has it
+        response = notify(client, 'OBJECT_METADATA_UPDATE', {'bucket': BUCKET, **resource('0-late.tif', 'ab', now)})
+        assert response.status_code == 200
+
+    main.reindex_bucket(BUCKET, FakeClient(FakeBucket(listed, upload_during_listing)))
+
+    assert list(main.hash_index.iter_names(BUCKET)) == ['0-late.tif', 'a.tif', 'b.tif']
+    report = client.get(f'/find-identical-files?bucket={BUCKET}&category=identical_content_different_name')
+    groups = report.get_json()['identical_content_different_name']
+    assert [sorted(file['name'] for file in group) for group in groups] == [['0-late.tif', 'a.tif', 'b.tif']]
@@ -0,0 +1,51 @@
+import pytest
+
+import main
+from report_cache import Report, decode_cursor, encode_cursor
+
+BUCKET = 'test-bucket'
+
+
+@pytest.fixture
+def client():
+    # Eight pairs of objects with the same content under different names
+    resources = [{'name': f'plate{i % 2}/copy{copy}-{i}.tif', 'generation': 1, 'size': str(100 * (i + 1)),
+                  'md5Hash': f'md5-{i}', 'metadata': {'file_hash': f'{i:032x}'}}
+                 for i in range(8) for copy in range(2)]
+    main.hash_index.rebuild(BUCKET, resources)
+    return main.app.test_client()
+
+
+def test_pages_cover_the_full_report(client):
+    full = client.get(f'/find-identical-files?bucket={BUCKET}&category=identical_content_different_name').get_json()
+    groups, cursor = [], None
+    while True:
+        query = f'/find-identical-files?bucket={BUCKET}&category=identical_content_different_name&limit=3'
+        page = client.get(query + (f'&cursor={cursor}' if cursor else '')).get_json()
+        groups += page['identical_content_different_name']
+        cursor = page['next_cursor']
+        if not cursor:
+            break
+    assert len(groups) == len(full['identical_content_different_name']) == 8
+
+
+def test_cursor_of_another_sort_is_rejected(client):
+    page = client.get(f'/compare-files-md5?bucket={BUCKET}&sort=reclaimable&limit=2').get_json()
+    cursor = page['next_cursor']
+    assert cursor
+
+    response = client.get(f'/compare-files-md5?bucket={BUCKET}&sort=name&limit=2&cursor={cursor}')
+    assert response.status_code == 400
+    response = client.get(f'/find-identical-files?bucket={BUCKET}&sort=reclaimable&limit=2&cursor={cursor}')
+    assert response.status_code == 400
+    response = client.get(f'/compare-files-md5?bucket={BUCKET}&sort=reclaimable&limit=2&cursor={cursor}')
+    assert response.status_code == 200
+
+
+def test_cursor_with_a_key_of_the_wrong_shape_is_rejected():
+    cursor = encode_cursor('name', ('a',), 0, [-5, 'x'])
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, 'name', ('a',))
+    report = Report({'a': [[{'name': 'x', 'size': 1}]]}, {})
+    with pytest.raises(ValueError):
+        report.page(('a',), sort='name', cursor=cursor)
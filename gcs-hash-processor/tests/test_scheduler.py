@@ -0,0 +1,119 @@
+import asyncio
+
+import pytest
+
+import scheduler
+from scheduler import AIMDController, AsyncBulkScheduler, BulkScheduler
+
+
+class HttpError(Exception):
+    def __init__(self, status):
+        super().__init__(f'HTTP {status}')
+        self.status = status
+
+
+class FlakyTask:
+    """Raises the given statuses in turn, then returns 'ok'."""
+
+    def __init__(self, *statuses):
+        self.statuses = list(statuses)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.statuses:
+            raise HttpError(self.statuses.pop(0))
+        return 'ok'
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(scheduler, 'backoff', lambda attempt: 0)
+
+
+def test_congestion_cuts_the_limit_multiplicatively():
+    controller = AIMDController(initial=16, latency_tolerance=0, decrease=0.5)
+    controller.on_congestion()
+    assert controller.limit == 8
+    controller.on_congestion()
+    assert controller.limit == 4
+    for _ in range(10):
+        controller.on_congestion()
+    assert controller.limit == controller.minimum == 1
+    assert controller.lowest == 1
+
+
+def test_successes_recover_the_limit_additively():
+    controller = AIMDController(initial=4, maximum=6, latency_tolerance=0)
+    for _ in range(4):
+        before = controller.limit
+        controller.on_success('get', 0.0)
+        assert controller.limit == pytest.approx(before + 1 / before)
+    # About one more request in flight per limit successes
+    assert 4.8 < controller.limit < 5
+    for _ in range(100):
+        controller.on_success('get', 0.0)
+    assert controller.limit == controller.highest == 6
+
+
+def test_errors_of_requests_in_flight_cut_the_limit_once():
+    controller = AIMDController(initial=16, latency_tolerance=0, decrease=0.5)
+    controller.on_success('get', 10.0)
+    controller.on_congestion()
+    controller.on_congestion()
+    assert controller.limit == (16 + 1 / 16) * 0.5
+    assert controller.decreases == 1
+
+
+def test_a_slowing_kind_counts_as_congestion():
+    controller = AIMDController(initial=16, latency_tolerance=2.0, decrease=0.5)
+    for _ in range(5):
+        controller.on_success('get', 0.0)
+    limit = controller.limit
+    for _ in range(20):
+        controller.on_success('get', 1.0)
+    assert controller.limit < limit
+    assert controller.decreases >= 1
+
+
+@pytest.mark.parametrize('status', [429, 503])
+def test_throttled_requests_are_retried_and_cut_the_limit(status):
+    bulk = BulkScheduler(initial=16, latency_tolerance=0)
+    task = FlakyTask(status)
+    assert bulk.call('get', task) == 'ok'
+    assert task.calls == 2
+    assert bulk.controller.limit == pytest.approx(16 * bulk.controller.decrease + 1 / (16 * bulk.controller.decrease))
+    report = bulk.report()
+    assert (report['requests'], report['retries'], report['throttled'], report['failed']) == (2, 1, 1, 0)
+
+
+def test_retries_stop_at_max_attempts():
+    bulk = BulkScheduler(initial=16, latency_tolerance=0, max_attempts=3)
+    task = FlakyTask(503, 429, 503, 429)
+    with pytest.raises(HttpError):
+        bulk.call('get', task)
+    assert task.calls == 3
+    report = bulk.report()
+    assert (report['retries'], report['throttled'], report['failed']) == (2, 3, 1)
+
+
+def test_other_errors_are_not_retried():
+    bulk = BulkScheduler(initial=16, latency_tolerance=0)
+    task = FlakyTask(404)
+    with pytest.raises(HttpError):
+        bulk.call('get', task)
+    assert task.calls == 1
+    assert bulk.controller.limit == 16
+
+
+def test_async_scheduler_retries_throttled_requests():
+    bulk = AsyncBulkScheduler(initial=16, latency_tolerance=0, max_attempts=2)
+    task = FlakyTask(429, 429)
+
+    async def fn():
+        return task()
+
+    with pytest.raises(HttpError):
+        asyncio.run(bulk.call('get', fn))
+    assert task.calls == 2
+    assert bulk.controller.limit < 16
@@ -0,0 +1,134 @@
+"""Peak memory of comparing two large TIFFs whole and band by band.
+
+A fake GCS server (benchmarks/fake_gcs.py at the repository root) serves a
+pair of synthetic TIFFs per layout: uncompressed strips, zlib tiles and a
+multi-page stack. For each layout, each path runs in a fresh process that
+reports its peak RSS, its wall time and the SSIM it computed. The two
+paths are decoding both images whole and calling calculate_ssim (what
+happens below LAZY_DECODE_BYTES), and compare_tif_lazy.
+
+    python benchmarks/bench_lazy_tiff.py --size 8192 --band-pixels 1048576
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(HERE)), 'benchmarks'))
+
+BUCKET = 'bench-bucket'
+LAYOUTS = {
+    'strips': ({}, 2),
+    'tiles-zlib': ({'tile': (256, 256), 'compression': 'zlib'}, 2),
+    'pages': ({}, 3),
+}
+
+
+def synthetic_pair(layout, size):
+    """Two similar uint16 images of ``size`` x ``size`` pixels in total,
+    encoded as TIFFs with the given layout."""
+    import numpy as np
+    import tifffile
+
+    kwargs, ndim = LAYOUTS[layout]
+    shape = (size, size) if ndim == 2 else (16, size // 4, size // 4)
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 60000, shape, dtype=np.uint16)
+    noisy = base + rng.integers(0, 2000, shape, dtype=np.uint16)
+    encoded = []
+    for array in (base, noisy):
+        buffer = io.BytesIO()
+        tifffile.imwrite(buffer, array, **kwargs)
+        encoded.append(buffer.getvalue())
+    return encoded
+
+
+def serve(size, queue):
+    from fake_gcs import FakeGCSServer
+
+    server = FakeGCSServer()
+    for layout in LAYOUTS:
+        for i, data in enumerate(synthetic_pair(layout, size)):
+            server.add_object(BUCKET, f'{layout}/image{i}.tif', data)
+    queue.put(server.url)
+    server.serve_forever()
+
+
+def peak_rss_mib():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run(path, layout, url, band_pixels, queue):
+    os.environ['STORAGE_EMULATOR_HOST'] = url
+    os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'bench')
+    os.environ['LAZY_BAND_PIXELS'] = str(band_pixels)
+    import logging
+    import main
+
+    logging.disable(logging.WARNING)
+    bucket = main.storage_client.bucket(BUCKET)
+    blob1, blob2 = (bucket.get_blob(f'{layout}/image{i}.tif') for i in range(2))
+    baseline = peak_rss_mib()
+    started = time.perf_counter()
+    if path == 'whole':
+        value = main.calculate_ssim(main.download_tif_from_bucket(blob1), main.download_tif_from_bucket(blob2))
+    else:
+        value = main.compare_tif_lazy(blob1, blob2, {})['ssim']
+    queue.put({
+        'layout': layout,
+        'path': path,
+        'object_mib': round(blob1.size / 1024 ** 2, 1),
+        'seconds': round(time.perf_counter() - started, 2),
+        'baseline_rss_mib': round(baseline),
+        'peak_rss_mib': round(peak_rss_mib()),
+        'ssim': float(value),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=4096, help='side of the 2-D images in pixels')
+    parser.add_argument('--band-pixels', type=int, default=4 * 1024 ** 2, help='LAZY_BAND_PIXELS')
+    parser.add_argument('--layouts', default=','.join(LAYOUTS))
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    server = context.Process(target=serve, args=(args.size, queue), daemon=True)
+    server.start()
+    url = queue.get()
+
+    results = []
+    try:
+        for layout in args.layouts.split(','):
+            for path in ('whole', 'lazy'):
+                worker = context.Process(target=run, args=(path, layout, url, args.band_pixels, queue))
+                worker.start()
+                results.append(queue.get())
+                worker.join()
+                if not args.json:
+                    r = results[-1]
+                    print(f"{r['layout']:>11}  {r['path']:>5}  {r['object_mib']:>7} MiB objects  "
+                          f"{r['seconds']:>6}s  peak RSS {r['peak_rss_mib']:>6} MiB "
+                          f"(baseline {r['baseline_rss_mib']} MiB)  ssim {r['ssim']:.12f}")
+    finally:
+        server.terminate()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    # Both paths must agree up to floating-point rounding
+    for whole, lazy in zip(results[::2], results[1::2]):
+        if abs(whole['ssim'] - lazy['ssim']) > 1e-9:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Scaling of full-resolution SSIM over 1..N worker processes.
+
+Compares every pair of a synthetic image set (see bench_prefilter.py) with
+compare_serial and with compare_parallel at each worker count, and checks
+that every parallel run returns exactly the serial results.
+
+    python benchmarks/bench_parallel.py --images 40 --size 512 --workers 1,2,4,8
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=40)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--workers', default=','.join(str(2 ** i) for i in range(8) if 2 ** i <= os.cpu_count()))
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    from bench_prefilter import synthetic_images
+    from image_cache import ImageCache
+    from parallel import compare_parallel, compare_serial
+
+    arrays = synthetic_images(max(args.images // 6, 1), 4, args.size)
+    names = sorted(arrays)[:args.images]
+    blobs = [SimpleNamespace(name=name) for name in names]
+    pairs = [(blob1, blob2, None) for blob1, blob2 in itertools.combinations(blobs, 2)]
+
+    results = []
+    serial = None
+    with ImageCache(arrays.__getitem__, 1 << 40, tempfile.gettempdir()) as images:
+        for workers in (int(w) for w in args.workers.split(',')):
+            started = time.perf_counter()
+            if workers == 1:
+                comparisons = [c for _, _, c in compare_serial(pairs, images)]
+                serial = comparisons
+            else:
+                comparisons = [c for _, _, c in compare_parallel(pairs, images, workers)]
+            elapsed = time.perf_counter() - started
+            results.append({
+                'workers': workers,
+                'pairs': len(pairs),
+                'seconds': round(elapsed, 2),
+                'pairs_per_sec': round(len(pairs) / elapsed, 1),
+                'speedup': round(results[0]['seconds'] / elapsed, 2) if results else 1.0,
+                'matches_serial': serial is not None and comparisons == serial,
+            })
+            if not args.json:
+                r = results[-1]
+                print(f"{r['workers']:>3} workers  {r['pairs']} pairs  {r['seconds']:>7}s  "
+                      f"{r['pairs_per_sec']:>7} pairs/s  x{r['speedup']}  identical={r['matches_serial']}")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    if not all(r['matches_serial'] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
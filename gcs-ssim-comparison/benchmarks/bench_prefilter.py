@@ -0,0 +1,118 @@
+"""Check the thumbnail prefilter against exhaustive full-resolution SSIM.
+
+Builds a synthetic set of microscopy-like images: smooth random fields,
+variants of them with noise, intensity shifts and small translations, and
+unrelated fields. Every pair is scored with calculate_ssim and run through
+ThumbnailPrefilter. Recall is the fraction of pairs at or above the
+threshold that survive the prefilter, which must be 1.0. The script exits
+with status 1 otherwise.
+
+    python benchmarks/bench_prefilter.py --bases 8 --variants 4 --size 512
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main creates a storage client at import; no request is ever made here
+os.environ.setdefault('STORAGE_EMULATOR_HOST', 'http://127.0.0.1:9')
+os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'bench')
+
+
+def smooth_field(rng, size, scale=16):
+    """Random field with structure at roughly ``scale`` pixels, as uint16."""
+    coarse = rng.random((size // scale + 2, size // scale + 2))
+    field = np.kron(coarse, np.ones((scale, scale)))[:size, :size]
+    # Cheap blur: average of shifted copies
+    field = sum(np.roll(np.roll(field, dx, 0), dy, 1) for dx in range(-4, 5, 2) for dy in range(-4, 5, 2))
+    field = (field - field.min()) / (field.max() - field.min())
+    return (field * 40000 + 5000).astype(np.uint16)
+
+
+def synthetic_images(bases, variants, size, seed=0):
+    rng = np.random.default_rng(seed)
+    images = {}
+    for b in range(bases):
+        base = smooth_field(rng, size)
+        images[f'base{b}'] = base
+        for v in range(variants):
+            kind = v % 4
+            if kind == 0:
+                variant = base + rng.normal(0, 300 * (v + 1), base.shape)
+            elif kind == 1:
+                variant = base * 0.95 + 500
+            elif kind == 2:
+                variant = np.roll(base, v, axis=1)
+            else:
+                variant = base + rng.normal(0, 3000, base.shape)
+            images[f'base{b}_v{v}'] = np.clip(variant, 0, 65535).astype(np.uint16)
+        images[f'unrelated{b}'] = smooth_field(rng, size)
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bases', type=int, default=8)
+    parser.add_argument('--variants', type=int, default=4)
+    parser.add_argument('--size', type=int, default=512)
+    parser.add_argument('--threshold', type=float, default=0.9)
+    parser.add_argument('--margins', default='0.1,0.2,0.3')
+    parser.add_argument('--thumbnail-size', type=int, default=64)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    import logging
+    logging.disable(logging.WARNING)
+    from main import calculate_ssim
+    from prefilter import ThumbnailPrefilter
+
+    images = synthetic_images(args.bases, args.variants, args.size)
+    pairs = list(itertools.combinations(sorted(images), 2))
+
+    started = time.perf_counter()
+    exhaustive = {pair: calculate_ssim(images[pair[0]], images[pair[1]]) for pair in pairs}
+    exhaustive_seconds = time.perf_counter() - started
+    matches = {pair for pair, score in exhaustive.items() if score >= args.threshold}
+
+    results = []
+    for margin in (float(m) for m in args.margins.split(',')):
+        stage = ThumbnailPrefilter(images, calculate_ssim, args.threshold, margin, args.thumbnail_size)
+        started = time.perf_counter()
+        # As in candidate_pairs: pairs without a thumbnail score always pass
+        scores = {pair: stage.score(*pair) for pair in pairs}
+        survivors = {pair for pair, score in scores.items() if score is None or score >= stage.bound}
+        prefilter_seconds = time.perf_counter() - started
+        # Full SSIM only runs on the survivors
+        started = time.perf_counter()
+        for pair in survivors:
+            calculate_ssim(images[pair[0]], images[pair[1]])
+        full_seconds = time.perf_counter() - started
+        results.append({
+            'margin': margin,
+            'pairs': len(pairs),
+            'matches': len(matches),
+            'pruned': len(pairs) - len(survivors),
+            'recall': len(matches & survivors) / len(matches) if matches else 1.0,
+            'exhaustive_seconds': round(exhaustive_seconds, 2),
+            'two_stage_seconds': round(prefilter_seconds + full_seconds, 2),
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for r in results:
+            print(f"margin {r['margin']:<4} pruned {r['pruned']}/{r['pairs']} pairs  recall {r['recall']:.3f} "
+                  f"({r['matches']} matches)  exhaustive {r['exhaustive_seconds']}s  "
+                  f"two-stage {r['two_stage_seconds']}s")
+
+    if any(r['recall'] < 1.0 for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""Microbenchmark of calculate_ssim_batch against per-pair calculate_ssim.
+
+Scores one image against a stack of candidates both ways, checks that the
+values are identical and reports the time per pair.
+
+    python benchmarks/bench_ssim_batch.py --shapes 512x512,2048x2048 --batch-sizes 1,4,8,16
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def best_of(repeat, fn):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shapes', default='256x256,1024x1024,3x512x512')
+    parser.add_argument('--batch-sizes', default='1,4,8,16')
+    parser.add_argument('--dtype', default='uint16')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    from similarity import calculate_ssim, calculate_ssim_batch
+
+    rng = np.random.default_rng(0)
+    results = []
+    for shape in (tuple(int(n) for n in s.split('x')) for s in args.shapes.split(',')):
+        info = np.iinfo(args.dtype)
+        img1 = rng.integers(0, info.max, shape, dtype=args.dtype)
+        for batch_size in (int(b) for b in args.batch_sizes.split(',')):
+            # Candidates near img1 so the scores are not all ~0
+            imgs2 = [np.clip(img1 + rng.normal(0, 2000, shape), 0, info.max).astype(args.dtype)
+                     for _ in range(batch_size)]
+            pair_seconds, expected = best_of(args.repeat, lambda: [calculate_ssim(img1, img2) for img2 in imgs2])
+            batch_seconds, values = best_of(args.repeat, lambda: calculate_ssim_batch(img1, imgs2))
+            results.append({
+                'shape': 'x'.join(map(str, shape)),
+                'batch_size': batch_size,
+                'per_pair_ms': round(1000 * pair_seconds / batch_size, 2),
+                'batched_ms': round(1000 * batch_seconds / batch_size, 2),
+                'speedup': round(pair_seconds / batch_seconds, 2),
+                'identical': values == expected,
+            })
+            if not args.json:
+                r = results[-1]
+                print(f"{r['shape']:>12}  batch {r['batch_size']:>3}  per-pair {r['per_pair_ms']:>8} ms  "
+                      f"batched {r['batched_ms']:>8} ms/pair  x{r['speedup']}  identical={r['identical']}")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    if not all(r['identical'] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
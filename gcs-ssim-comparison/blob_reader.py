@@ -0,0 +1,90 @@
+import io
+
+import metrics
+
+
+class BlobReader(io.RawIOBase):
+    """Seekable read-only file over a GCS object, backed by ranged downloads.
+
+    Reads are rounded up to ``block_size`` and the most recent blocks are
+    kept, so parsers that hop around a file (tifffile walking IFDs) only
+    fetch the parts they look at instead of the whole object.
+    """
+
+    def __init__(self, blob, block_size=64 * 1024, max_blocks=64):
+        if blob.size is None:
+            blob.reload()
+        self.blob = blob
+        self.size = blob.size
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.bytes_downloaded = 0
+        self.requests = 0
+        self._position = 0
+        self._blocks = {}
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError(f"invalid whence {whence}")
+        return self._position
+
+    def _download(self, start, end):
+        with metrics.stage('download') as span:
+            # Checksums cover the whole object, so they cannot validate a range
+            data = self.blob.download_as_bytes(start=start, end=end, checksum=None)
+            span.nbytes = len(data)
+        self.requests += 1
+        self.bytes_downloaded += len(data)
+        return data
+
+    def _block(self, index):
+        block = self._blocks.get(index)
+        if block is None:
+            start = index * self.block_size
+            end = min(start + self.block_size, self.size) - 1
+            block = self._download(start, end)
+            if len(self._blocks) >= self.max_blocks:
+                self._blocks.pop(next(iter(self._blocks)))
+            self._blocks[index] = block
+        return block
+
+    def read_range(self, start, length):
+        """Return up to ``length`` bytes from ``start`` without moving the position."""
+        end = min(start + length, self.size)
+        if start >= end:
+            return b''
+        first, last = start // self.block_size, (end - 1) // self.block_size
+        if last - first >= 2:
+            # Large reads go straight to the object instead of through the blocks
+            return self._download(start, end - 1)
+        data = b''.join(self._block(index) for index in range(first, last + 1))
+        offset = start - first * self.block_size
+        return data[offset:offset + end - start]
+
+    def readinto(self, buffer):
+        # Filled a block at a time, so a large read (tifffile reading a
+        # contiguous image into its array) never holds the range as bytes too
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view) and self._position < self.size:
+            step = min(len(view) - filled, self.block_size - self._position % self.block_size)
+            data = self.read_range(self._position, step)
+            view[filled:filled + len(data)] = data
+            filled += len(data)
+            self._position += len(data)
+        return filled
@@ -11,5 +11,11 @@ curl -X POST \
   -d '{
      "bucket_name": "bacteria-collection-data-test",
      "similarity_threshold": 0.9,
-     "report_filename": "similarity_report.json"
+     "mode": "incremental",
+     "report_filename": "similarity_report.ndjson"
   }'
+
+# The job runs in the background; poll it with
+#   curl "$URI/jobs/<job_id>?bucket=bacteria-collection-data-test"
+# and stop it with
+#   curl -X POST "$URI/jobs/<job_id>/cancel?bucket=bacteria-collection-data-test"
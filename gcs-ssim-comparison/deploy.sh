@@ -8,4 +8,20 @@ gcloud run deploy $SERVICE \
   --memory 4Gi \
   --concurrency 80 \
   --timeout 3600 \
+  --no-cpu-throttling \
   --allow-unauthenticated
+
+# SSIM_WORKERS > 1 shares decoded images through IMAGE_CACHE_SPILL_DIR, which
+# must be disk-backed (/tmp is memory on Cloud Run), e.g. a Filestore share
+#gcloud run services update $SERVICE \
+#  --add-volume name=spill,type=nfs,location=<filestore-ip>:/<share> \
+#  --add-volume-mount volume=spill,mount-path=/mnt/spill \
+#  --set-env-vars SSIM_WORKERS=4,IMAGE_CACHE_SPILL_DIR=/mnt/spill \
+#  --region us-central1
+
+# The thumbnail prefilter (on by default) skips pairs whose thumbnail SSIM is
+# more than PREFILTER_MARGIN below the threshold, which can miss a match. For
+# an exhaustive comparison turn it off, or pass "prefilter": false to /analyze:
+#gcloud run services update $SERVICE \
+#  --set-env-vars PREFILTER=false \
+#  --region us-central1
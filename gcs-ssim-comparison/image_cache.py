@@ -0,0 +1,107 @@
+import logging
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ImageCache:
+    """LRU cache of decoded images bounded by a memory budget.
+
+    ``loader(key)`` is called on a miss and must return a numpy array.
+    Arrays are kept in memory until their total size exceeds
+    ``memory_budget`` bytes, then the least recently used ones are evicted.
+    With a ``spill_dir`` evicted arrays are written there as .npy files and
+    served back as read-only memory maps, so an image is downloaded and
+    decoded at most once even when the images do not fit in memory.
+    """
+
+    def __init__(self, loader, memory_budget, spill_dir=None):
+        self.loader = loader
+        self.memory_budget = memory_budget
+        self.spill_dir = tempfile.mkdtemp(prefix='ssim-cache-', dir=spill_dir) if spill_dir else None
+        self._arrays = OrderedDict()
+        self._spilled = {}
+        self.memory_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.spill_hits = 0
+        self.evictions = 0
+        self.spilled_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get(self, key):
+        array = self._arrays.get(key)
+        if array is not None:
+            self._arrays.move_to_end(key)
+            self.hits += 1
+            return array
+
+        path = self._spilled.get(key)
+        if path is not None:
+            self.spill_hits += 1
+            return np.load(path, mmap_mode='r')
+
+        self.misses += 1
+        array = self.loader(key)
+        self._put(key, array)
+        return array
+
+    def path(self, key):
+        """Return the .npy file holding the image, writing it if needed, so
+        other processes can memory-map it instead of receiving a copy."""
+        if self.spill_dir is None:
+            raise ValueError("ImageCache.path() needs a spill_dir")
+        if key not in self._spilled:
+            array = self.get(key)
+            if key not in self._spilled:
+                self._spill(key, array)
+        return self._spilled[key]
+
+    def _put(self, key, array):
+        if array.nbytes > self.memory_budget:
+            # Would evict everything else and still not fit
+            self._spill(key, array)
+            return
+        self._arrays[key] = array
+        self.memory_bytes += array.nbytes
+        while self.memory_bytes > self.memory_budget:
+            evicted_key, evicted = self._arrays.popitem(last=False)
+            self.memory_bytes -= evicted.nbytes
+            self.evictions += 1
+            self._spill(evicted_key, evicted)
+
+    def _spill(self, key, array):
+        if self.spill_dir is None or key in self._spilled:
+            return
+        path = os.path.join(self.spill_dir, f'{len(self._spilled)}.npy')
+        np.save(path, array)
+        self._spilled[key] = path
+        self.spilled_bytes += array.nbytes
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "spill_hits": self.spill_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "memory_bytes": self.memory_bytes,
+            "memory_budget": self.memory_budget,
+            "spilled_files": len(self._spilled),
+            "spilled_bytes": self.spilled_bytes,
+        }
+
+    def close(self):
+        self._arrays.clear()
+        self.memory_bytes = 0
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            logging.info(f"Removed image cache spill directory {self.spill_dir}")
+        self._spilled = {}
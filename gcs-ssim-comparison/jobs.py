@@ -0,0 +1,139 @@
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+
+from pair_store import STATE_PREFIX
+
+# Statuses of a job that will not change unless the job is resumed
+FINISHED_STATUSES = ('completed', 'failed', 'cancelled')
+
+
+def now_iso():
+    return datetime.now(timezone.utc).isoformat()
+
+
+class JobCancelled(Exception):
+    """Raised inside a running job once its cancellation was requested."""
+
+
+class JobStore:
+    """Persists /analyze job states as small JSON objects in the analyzed
+    bucket, next to the report and the pair store, so a job outlives the
+    instance that ran it.
+
+    Cancellation is requested through a separate marker object, so the
+    instance running the job never overwrites a request made elsewhere.
+    """
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def _blob(self, job_id, suffix='.json'):
+        return self.bucket.blob(f'{STATE_PREFIX}jobs/{job_id}{suffix}')
+
+    def load(self, job_id):
+        blob = self._blob(job_id)
+        if not blob.exists():
+            return None
+        return json.loads(blob.download_as_bytes())
+
+    def save(self, state):
+        state['updated_at'] = now_iso()
+        self._blob(state['job_id']).upload_from_string(json.dumps(state), content_type='application/json')
+
+    def request_cancel(self, job_id):
+        self._blob(job_id, '.cancel').upload_from_string(now_iso())
+
+    def cancel_requested(self, job_id):
+        return self._blob(job_id, '.cancel').exists()
+
+    def clear_cancel(self, job_id):
+        blob = self._blob(job_id, '.cancel')
+        if blob.exists():
+            blob.delete()
+
+
+class JobQueue:
+    """In-process queue of jobs drained by a pool of worker threads.
+
+    ``run(job, cancelled)`` does the work of one job; ``cancelled`` is a
+    threading.Event set by cancel(), which the job is expected to poll.
+    Jobs are keyed by ``key`` (bucket, job_id); a key is queued or running
+    at most once per instance. While a job waits in the queue,
+    ``heartbeat(job)`` is called every ``interval`` seconds, so other
+    instances can tell it from an abandoned one.
+    """
+
+    def __init__(self, run, workers=1, heartbeat=None, interval=30):
+        self.run = run
+        self.heartbeat = heartbeat
+        self.interval = interval
+        self._queue = queue.Queue()
+        self._active = {}
+        self._waiting = {}
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._work, name=f'job-worker-{n}', daemon=True)
+                         for n in range(workers)]
+        if heartbeat is not None:
+            self._threads.append(threading.Thread(target=self._beat, name='job-heartbeat', daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, job):
+        """Queue a job; returns False if the key is already queued or running."""
+        with self._lock:
+            if key in self._active:
+                return False
+            self._active[key] = threading.Event()
+            self._waiting[key] = job
+        self._queue.put((key, job))
+        return True
+
+    def is_active(self, key):
+        with self._lock:
+            return key in self._active
+
+    def cancel(self, key):
+        """Signal a queued or running job; returns whether it was found."""
+        with self._lock:
+            cancelled = self._active.get(key)
+        if cancelled is None:
+            return False
+        cancelled.set()
+        return True
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _beat(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                waiting = list(self._waiting.items())
+            for key, job in waiting:
+                try:
+                    self.heartbeat(job)
+                except Exception as e:
+                    logging.warning(f"Heartbeat of queued job {key} failed: {str(e)}")
+
+    def _work(self):
+        while True:
+            key, job = self._queue.get()
+            with self._lock:
+                cancelled = self._active[key]
+                del self._waiting[key]
+            try:
+                self.run(job, cancelled)
+            except Exception as e:
+                logging.error(f"Job {key} failed: {str(e)}")
+            finally:
+                with self._lock:
+                    del self._active[key]
+                self._queue.task_done()
+
+    def join(self):
+        """Wait until every queued job has run."""
+        self._queue.join()
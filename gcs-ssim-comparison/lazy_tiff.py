@@ -0,0 +1,121 @@
+import io
+import logging
+import math
+
+import numpy as np
+import tifffile
+
+from blob_reader import BlobReader
+
+
+class LazyTiff:
+    """Reads a TIFF in GCS one band at a time instead of decoding it whole.
+
+    A band is a range along the first axis of the array tif.asarray()
+    returns: rows of a single-page image, pages of a multi-page stack. Only
+    the strips, tiles or pages that overlap a band are fetched, with ranged
+    reads through a BlobReader, and uncompressed strips are sliced down to
+    the requested rows, so memory is bounded by the band plus one segment
+    or page rather than by the file.
+
+    Layouts that cannot be split that way (planar samples, volumetric tiles,
+    series that are not one page per index) are decoded whole on the first
+    read.
+    """
+
+    def __init__(self, blob, block_size=1024 * 1024, max_blocks=8):
+        self.name = blob.name
+        self.reader = BlobReader(blob, block_size, max_blocks)
+        self.tif = tifffile.TiffFile(io.BufferedReader(self.reader))
+        series = self.tif.series[0]
+        self.shape = tuple(series.shape)
+        self.dtype = np.dtype(series.dtype)
+        pages = self.tif.pages
+        page = pages[0]
+        if len(self.shape) > 1 and len(pages) == self.shape[0] and tuple(page.shape) == self.shape[1:]:
+            self.layout = 'pages'
+        elif (tuple(page.shape) == self.shape and page.imagedepth == 1
+              and (page.planarconfig == 1 or page.samplesperpixel == 1)):
+            self.layout = 'segments'
+        else:
+            logging.warning(f"Cannot read {self.name} by band (series {self.shape}, page {page.shape}); "
+                            f"it will be decoded whole")
+            self.layout = 'whole'
+        self._page = page
+        self._whole = None
+        self._previous = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def read(self, start, stop):
+        """Return the band [start, stop) of the first axis.
+
+        Consecutive bands of the banded SSIM overlap by a window; the part
+        already read for the previous band is reused rather than fetched and
+        decoded again.
+        """
+        previous = self._previous
+        if previous is not None and previous[0] <= start < previous[1] < stop:
+            band = np.concatenate([previous[2][start - previous[0]:], self._read(previous[1], stop)])
+        else:
+            band = self._read(start, stop)
+        self._previous = (start, stop, band)
+        return band
+
+    def _read(self, start, stop):
+        if self.layout == 'pages':
+            band = np.empty((stop - start,) + self.shape[1:], self.dtype)
+            for index in range(start, stop):
+                band[index - start] = self.tif.pages[index].asarray()
+            return band
+        if self.layout == 'segments':
+            return self._read_segments(start, stop)
+        if self._whole is None:
+            self._whole = self.tif.asarray()
+        return self._whole[start:stop]
+
+    def _read_segments(self, start, stop):
+        page = self._page
+        band = np.empty((stop - start,) + self.shape[1:], self.dtype)
+        segment_rows = page.tilelength if page.is_tiled else min(page.rowsperstrip, page.imagelength)
+        across = math.ceil(page.imagewidth / page.tilewidth) if page.is_tiled else 1
+        width = self.shape[1]
+        # Uncompressed strips are plain rows, so only the rows needed are read
+        row_bytes = self.dtype.itemsize * math.prod(self.shape[1:])
+        raw = (not page.is_tiled and page.compression == 1 and page.predictor == 1
+               and page.fillorder == 1 and page.bitspersample == 8 * self.dtype.itemsize)
+        file_dtype = self.dtype.newbyteorder(self.tif.byteorder)
+
+        for segment_row in range(start // segment_rows, (stop - 1) // segment_rows + 1):
+            first_row = segment_row * segment_rows
+            for column in range(across):
+                index = segment_row * across + column
+                offset, bytecount = page.dataoffsets[index], page.databytecounts[index]
+                if raw:
+                    low, high = max(start, first_row), min(stop, first_row + segment_rows)
+                    data = self.reader.read_range(offset + (low - first_row) * row_bytes, (high - low) * row_bytes)
+                    band[low - start:high - start] = np.frombuffer(data, file_dtype).reshape(
+                        (high - low,) + self.shape[1:])
+                    continue
+                data = self.reader.read_range(offset, bytecount) if bytecount else None
+                segment, (_, _, y, x, _), _ = page.decode(data, index, jpegtables=page.jpegtables)
+                if segment is None:
+                    segment = np.zeros((1, segment_rows, page.tilewidth or width, page.samplesperpixel),
+                                       self.dtype)
+                # (depth, length, width, samples) with a depth of 1
+                segment = segment[0]
+                if len(self.shape) == 2:
+                    segment = segment[..., 0]
+                low, high = max(start, y), min(stop, y + segment.shape[0])
+                columns = min(segment.shape[1], width - x)
+                band[low - start:high - start, x:x + columns] = segment[low - y:high - y, :columns]
+        return band
+
+    def close(self):
+        self.tif.close()
+        self._whole = None
+        self._previous = None
@@ -1,31 +1,104 @@
 import os
 import io
-import json
-from datetime import datetime
+import hashlib
+import itertools
+import math
+import contextlib
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import numpy as np
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from google.cloud import storage
-from skimage.metrics import structural_similarity as ssim
 import tifffile
 import logging
+from image_cache import ImageCache
+from blob_reader import BlobReader
+from lazy_tiff import LazyTiff
+from prefilter import ThumbnailPrefilter
+from similarity import banded_value_range, calculate_ssim, calculate_ssim_banded
+from parallel import compare_parallel, compare_serial
+from report_writer import ReportWriter
+from pair_store import PairStore
+from jobs import FINISHED_STATUSES, JobCancelled, JobQueue, JobStore, now_iso
+import metrics
 
 app = Flask(__name__)
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Initialize Google Cloud Storage client
 storage_client = storage.Client()
 
+# Memory budget for decoded images kept between comparisons of one report
+IMAGE_CACHE_BYTES = int(os.environ.get('IMAGE_CACHE_BYTES', 1024 ** 3))
+# Local directory for images evicted from the cache, and through which
+# SSIM worker processes share the decoded images. Unset disables spilling,
+# and then only SSIM_WORKERS=1 is allowed. It must be disk-backed: /tmp on
+# Cloud Run is memory, so spilling there would hold every image twice.
+# Mount a volume (e.g. a Filestore NFS share) and point this at it.
+IMAGE_CACHE_SPILL_DIR = os.environ.get('IMAGE_CACHE_SPILL_DIR') or None
+# Images are decoded from ranged reads of this size rather than from a
+# full in-memory copy of the object
+DECODE_BLOCK_BYTES = int(os.environ.get('DECODE_BLOCK_BYTES', 8 * 1024 ** 2))
+# Images whose decoded size exceeds this are never decoded whole: their
+# pairs skip the prefilter and are compared band by band (see LazyTiff).
+# Comparing whole images peaks at about 35 times the decoded size, so the
+# default keeps that within a 4Gi instance; scale it with the memory limit.
+LAZY_DECODE_BYTES = int(os.environ.get('LAZY_DECODE_BYTES', 64 * 1024 ** 2))
+# Pixels per band of the banded SSIM. Peak memory is roughly 15 float64
+# copies of a band, plus one strip, tile or page of each image.
+LAZY_BAND_PIXELS = int(os.environ.get('LAZY_BAND_PIXELS', 4 * 1024 ** 2))
+# Parallel ranged reads used to fetch TIFF headers before any image is decoded
+HEADER_READ_THREADS = int(os.environ.get('HEADER_READ_THREADS', 16))
+# Thumbnail prefilter: pairs whose thumbnail SSIM is below the threshold
+# minus PREFILTER_MARGIN skip the full-resolution SSIM. It is lossy: a
+# match whose thumbnail scores more than the margin below its full SSIM is
+# missed (tests/test_prefilter.py and benchmarks/bench_prefilter.py check
+# recall). Set PREFILTER=false, or "prefilter": false per request, for an
+# exhaustive comparison.
+PREFILTER = os.environ.get('PREFILTER', 'true').lower() == 'true'
+PREFILTER_MARGIN = float(os.environ.get('PREFILTER_MARGIN', 0.2))
+PREFILTER_SIZE = int(os.environ.get('PREFILTER_SIZE', 64))
+# Worker processes for full-resolution SSIM; 1 compares in the request thread
+SSIM_WORKERS = int(os.environ.get('SSIM_WORKERS', 1))
+# Candidates compared against the same image in one vectorized SSIM call,
+# at most as many as fit in SSIM_BATCH_BYTES of float maps (per worker);
+# images too large for two candidates are compared pair by pair
+SSIM_BATCH_SIZE = int(os.environ.get('SSIM_BATCH_SIZE', 8))
+SSIM_BATCH_BYTES = int(os.environ.get('SSIM_BATCH_BYTES', 512 * 1024 ** 2))
+# The report is checkpointed to the bucket at the first row boundary after
+# this many comparisons or buffered records
+REPORT_CHECKPOINT_PAIRS = int(os.environ.get('REPORT_CHECKPOINT_PAIRS', 5000))
+REPORT_PART_RECORDS = int(os.environ.get('REPORT_PART_RECORDS', 10000))
+# Incremental runs upload the pair store at a report checkpoint when the
+# last upload is older than this, besides once at the end
+PAIR_STORE_SNAPSHOT_SECONDS = int(os.environ.get('PAIR_STORE_SNAPSHOT_SECONDS', 600))
+ANALYZE_MODES = ('full', 'incremental')
+# /analyze jobs run in the background on this many worker threads
+ANALYZE_JOB_WORKERS = int(os.environ.get('ANALYZE_JOB_WORKERS', 1))
+# Seconds between job state saves, of running and queued jobs alike; also
+# the heartbeat that tells a live job from one whose instance went away
+JOB_HEARTBEAT_SECONDS = int(os.environ.get('JOB_HEARTBEAT_SECONDS', 30))
+JOB_LEASE_SECONDS = 4 * JOB_HEARTBEAT_SECONDS
+INSTANCE_ID = uuid.uuid4().hex
+
 def list_tif_files(bucket_name):
     """List all TIF files in the specified bucket."""
     logging.info(f"Listing TIF files in bucket: {bucket_name}")
     bucket = storage_client.bucket(bucket_name)
-    tif_files = [blob for blob in bucket.list_blobs() if blob.name.lower().endswith('.tif')]
+    with metrics.stage('list') as span:
+        blobs = list(bucket.list_blobs())
+        span.items = len(blobs)
+    tif_files = [blob for blob in blobs if blob.name.lower().endswith('.tif')]
     logging.info(f"Found {len(tif_files)} TIF files in the bucket")
     return tif_files
 
 def get_file_metadata(blob):
     """Extract metadata from a blob."""
-    logging.info(f"Extracting metadata for file: {blob.name}")
+    metrics.log_item(f"Extracting metadata for file: {blob.name}")
     metadata = {
         "full_path": blob.name,
         "size": blob.size,
@@ -39,132 +112,575 @@ def get_file_metadata(blob):
     return metadata
 
 def download_tif_from_bucket(blob):
-    """Download a TIF file from a GCS bucket and return it as a numpy array."""
-    logging.info(f"Downloading TIF file: {blob.name}")
-    buffer = io.BytesIO()
-    blob.download_to_file(buffer)
-    buffer.seek(0)
+    """Download a TIF file from a GCS bucket and return it as a numpy array.
 
-    with tifffile.TiffFile(buffer) as tif:
+    The object is read in DECODE_BLOCK_BYTES ranges as tifffile asks for
+    them, and large reads are copied into the array a range at a time, so
+    the encoded bytes are never held whole next to the array.
+    """
+    metrics.log_item(f"Downloading TIF file: {blob.name}")
+    reader = BlobReader(blob, DECODE_BLOCK_BYTES, max_blocks=2)
+    # Includes the ranged reads, which are timed on their own as 'download'
+    with metrics.stage('decode') as span, tifffile.TiffFile(io.BufferedReader(reader)) as tif:
         array = tif.asarray()
-    logging.info(f"Downloaded {blob.name}. Shape: {array.shape}, dtype: {array.dtype}")
+        span.nbytes = array.nbytes
+    metrics.log_item(f"Downloaded {blob.name}. Shape: {array.shape}, dtype: {array.dtype}")
     return array
 
-def calculate_ssim(img1, img2):
-    """Calculate SSIM between two images, handling small images."""
-    min_dim = min(img1.shape[0], img1.shape[1], img2.shape[0], img2.shape[1])
+def read_tif_signature(blob):
+    """Return the (shape, dtype) tif.asarray() would produce, read from the
+    TIFF header and IFDs with ranged requests instead of decoding pixels."""
+    reader = BlobReader(blob)
+    with metrics.stage('header') as span, tifffile.TiffFile(io.BufferedReader(reader)) as tif:
+        series = tif.series[0]
+        signature = (tuple(series.shape), str(series.dtype))
+        span.nbytes = reader.bytes_downloaded
+    metrics.log_item(f"Read header of {blob.name}: shape {signature[0]}, dtype {signature[1]} "
+                 f"({reader.bytes_downloaded} bytes in {reader.requests} requests)")
+    return signature
+
+def group_by_signature(tif_blobs, images, known=None):
+    """Group blobs by image shape and dtype; only images within a group can
+    be compared. Blobs whose header cannot be parsed are decoded instead,
+    and blobs whose name is in ``known`` get the signature mapped to it
+    without being read.
 
-    if min_dim < 7:
-        logging.warning(f"Image too small for default SSIM. Using win_size={min_dim}")
-        win_size = min_dim if min_dim % 2 != 0 else min_dim - 1
-    else:
-        win_size = 7  # default win_size
+    Returns (groups, unreadable), where unreadable maps the names of blobs
+    that could not be decoded either to the error.
+    """
+    known = known or {}
 
-    logging.info(f"Calculating SSIM with win_size={win_size}")
-    return ssim(img1, img2, data_range=img1.max() - img1.min(), multichannel=True, win_size=win_size)
+    def header_signature(blob):
+        if blob.name in known:
+            return known[blob.name]
+        try:
+            return read_tif_signature(blob)
+        except Exception as e:
+            logging.warning(f"Could not read TIFF header of {blob.name}, decoding it instead: {str(e)}")
+            return None
 
-def compare_tif_images(img1, img2, name1, name2):
-    """Compare two TIF images using SSIM."""
-    logging.info(f"Comparing images: {name1} vs {name2}")
-    if img1.shape != img2.shape:
-        logging.warning(f"Images have different dimensions. {name1}: {img1.shape}, {name2}: {img2.shape}")
-        return {"error": "Images have different dimensions."}
+    with ThreadPoolExecutor(max_workers=HEADER_READ_THREADS) as executor:
+        signatures = list(executor.map(header_signature, tif_blobs))
 
+    groups = defaultdict(list)
+    unreadable = {}
+    for blob, signature in zip(tif_blobs, signatures):
+        if signature is None:
+            # The image cache is not thread-safe, so decode in this thread
+            try:
+                array = images.get(blob.name)
+                signature = (tuple(array.shape), str(array.dtype))
+            except Exception as e:
+                logging.error(f"Could not decode {blob.name}: {str(e)}")
+                unreadable[blob.name] = str(e)
+                continue
+        groups[signature].append(blob)
+    return groups, unreadable
+
+def signature_nbytes(signature):
+    shape, dtype = signature
+    return math.prod(shape) * np.dtype(dtype).itemsize
+
+def compare_tif_lazy(blob1, blob2, value_ranges):
+    """compare_tif_images for images too large to decode whole, read band by
+    band with LazyTiff. ``value_ranges`` caches the data range of image 1,
+    which takes a pass over it, by name."""
+    metrics.log_item(f"Comparing images band by band: {blob1.name} vs {blob2.name}")
     try:
-        ssim_value = calculate_ssim(img1, img2)
-        logging.info(f"SSIM value for {name1} vs {name2}: {ssim_value}")
+        with metrics.stage('ssim_banded'), LazyTiff(blob1) as tiff1, LazyTiff(blob2) as tiff2:
+            if tiff1.shape != tiff2.shape:
+                return {"error": "Images have different dimensions."}
+            band_length = max(1, LAZY_BAND_PIXELS // max(1, math.prod(tiff1.shape[1:])))
+            if blob1.name not in value_ranges:
+                value_ranges[blob1.name] = banded_value_range(tiff1.read, tiff1.shape[0], band_length)
+            ssim_value = calculate_ssim_banded(tiff1.read, tiff2.read, tiff1.shape, band_length,
+                                               value_ranges[blob1.name])
+        metrics.log_item(f"SSIM value for {blob1.name} vs {blob2.name}: {ssim_value}")
         return {"ssim": ssim_value}
     except Exception as e:
-        logging.error(f"Error in SSIM calculation for {name1} vs {name2}: {str(e)}")
+        logging.error(f"Error in SSIM calculation for {blob1.name} vs {blob2.name}: {str(e)}")
         return {"error": f"SSIM calculation failed: {str(e)}"}
 
-def generate_similarity_report(bucket_name, similarity_threshold=0.9):
-    """Generate a similarity report for all TIF files in the bucket."""
-    logging.info(f"Generating similarity report for bucket: {bucket_name}")
+def compare_large_pairs(pairs, large_names):
+    """Compare the (blob1, blob2, known) pairs of images in ``large_names``
+    with compare_tif_lazy, in order, and pass every other pair through."""
+    value_ranges = {}
+    for blob1, blob2, known in pairs:
+        if known is None and blob1.name in large_names:
+            known = compare_tif_lazy(blob1, blob2, value_ranges)
+        yield blob1, blob2, known
+
+def candidate_pairs(groups, prefilter_stage, start_row=0, stored=None):
+    """Yield (blob1, blob2, known) for the pairs within each group, in
+    upper-triangle order, skipping the first ``start_row`` rows.
+
+    ``known`` is None for pairs that need the full-resolution SSIM. Pairs
+    the prefilter prunes get {"prefilter_ssim": score}, and pairs found by
+    ``stored(blob1, blob2)`` (PairStore results) get the stored comparison,
+    marked with "stored": True, as long as it still holds for this run's
+    threshold and margin.
+    """
+    rows = ((i, blob1, group_blobs) for group_blobs in groups.values() for i, blob1 in enumerate(group_blobs[:-1]))
+    for i, blob1, group_blobs in itertools.islice(rows, start_row, None):
+        metrics.log_item(f"Processing file {i+1}/{len(group_blobs)} of its group: {blob1.name}")
+        for blob2 in group_blobs[i+1:]:
+            known = stored(blob1, blob2) if stored is not None else None
+            if known is not None:
+                if "prefilter_ssim" not in known or (prefilter_stage is not None
+                                                     and known["prefilter_ssim"] < prefilter_stage.bound):
+                    yield blob1, blob2, {**known, "stored": True}
+                else:
+                    # Pruned under a lower threshold or margin than this run's
+                    yield blob1, blob2, None
+                continue
+            try:
+                if prefilter_stage is not None:
+                    with metrics.stage('prefilter'):
+                        score = prefilter_stage.score(blob1.name, blob2.name)
+                    if score is not None and score < prefilter_stage.bound:
+                        metrics.log_item(f"Thumbnail SSIM of {blob1.name} vs {blob2.name} is far below threshold. Skipping.")
+                        yield blob1, blob2, {"prefilter_ssim": score}
+                        continue
+            except Exception as e:
+                # Leave it to the comparison to report the failure
+                logging.warning(f"Prefilter failed for {blob1.name} vs {blob2.name}: {str(e)}")
+            yield blob1, blob2, None
+
+def listing_fingerprint(tif_blobs):
+    """Identifies the exact set of object versions a report covers."""
+    digest = hashlib.sha256()
+    for blob in sorted(tif_blobs, key=lambda blob: blob.name):
+        digest.update(f"{blob.name}\0{blob.generation}\n".encode())
+    return digest.hexdigest()
+
+def generate_similarity_report(bucket_name, writer, similarity_threshold=0.9, prefilter=PREFILTER,
+                               prefilter_margin=PREFILTER_MARGIN, workers=SSIM_WORKERS, mode='full',
+                               progress=None):
+    """Generate a similarity report for all TIF files in the bucket.
+
+    Pairs go through up to three stages: shape/dtype grouping, the thumbnail
+    prefilter (when enabled) and full-resolution SSIM, which runs on
+    ``workers`` processes when more than one is requested; they share the
+    decoded images through IMAGE_CACHE_SPILL_DIR, which must then be set.
+
+    In ``incremental`` mode the results of both stages are also looked up in
+    and added to the bucket's PairStore, so only pairs involving an image
+    that is new or was overwritten since the previous incremental run are
+    scored; the report still covers every pair, merging stored and new
+    results.
+
+    Records are streamed to ``writer`` (a ReportWriter) instead of being
+    kept in memory: one per file, one per pair that meets the threshold or
+    failed, and a summary with the pair counts of each stage. Pairs are
+    produced row by row (all partners of one image, then the next), and the
+    writer checkpoints at row boundaries every REPORT_CHECKPOINT_PAIRS
+    comparisons or REPORT_PART_RECORDS records, so an interrupted report
+    resumes at the first unfinished row. Returns the summary.
+
+    ``progress(stage, pairs_done=None, pairs_total=None)`` is called when
+    the run enters a stage and after every candidate pair; an exception it
+    raises aborts the run.
+    """
+    if workers > 1 and not IMAGE_CACHE_SPILL_DIR:
+        # Worker processes memory-map the images from the spill directory
+        raise ValueError("workers > 1 needs IMAGE_CACHE_SPILL_DIR")
+    logging.info(f"Generating {mode} similarity report for bucket: {bucket_name}")
     logging.info(f"Similarity threshold: {similarity_threshold}")
+    progress = progress or (lambda stage, pairs_done=None, pairs_total=None: None)
 
+    progress("listing")
     tif_blobs = list_tif_files(bucket_name)
-    report = {
-        "metadata": {},
-        "comparisons": {}
-    }
+    state = writer.open(listing_fingerprint(tif_blobs))
+    counters = {"compared": 0, "reused": 0, "pruned_by_prefilter": 0, "matches": 0, "errors": 0,
+                **state["counters"]}
+    start_row = state["rows_completed"]
 
-    logging.info("Gathering metadata for all files")
-    for blob in tif_blobs:
-        report["metadata"][blob.name] = get_file_metadata(blob)
+    if not state["parts"]:
+        logging.info("Gathering metadata for all files")
+        for blob in tif_blobs:
+            writer.write({"type": "file", **get_file_metadata(blob)})
 
-    total_comparisons = len(tif_blobs) * (len(tif_blobs) - 1) // 2
-    logging.info(f"Total comparisons to be made: {total_comparisons}")
-    completed_comparisons = 0
+    total_pairs = len(tif_blobs) * (len(tif_blobs) - 1) // 2
 
-    for i, blob1 in enumerate(tif_blobs):
-        logging.info(f"Processing file {i+1}/{len(tif_blobs)}: {blob1.name}")
-        img1 = download_tif_from_bucket(blob1)
-        for blob2 in tif_blobs[i+1:]:
-            completed_comparisons += 1
-            logging.info(f"Comparison {completed_comparisons}/{total_comparisons}: {blob1.name} vs {blob2.name}")
+    # Each image is downloaded and decoded once instead of once per pair
+    blobs_by_name = {blob.name: blob for blob in tif_blobs}
+    with contextlib.ExitStack() as stack:
+        images = stack.enter_context(ImageCache(lambda name: download_tif_from_bucket(blobs_by_name[name]),
+                                                IMAGE_CACHE_BYTES, IMAGE_CACHE_SPILL_DIR))
+        store, image_ids, known_signatures = None, {}, {}
+        if mode == 'incremental':
+            store = stack.enter_context(PairStore(
+                storage_client.bucket(bucket_name),
+                os.path.join(tempfile.gettempdir(), f"ssim-pairs-{uuid.uuid4().hex}.sqlite3")).load())
+            image_ids = {blob.name: store.image_id(blob.name, blob.generation) for blob in tif_blobs}
+            for name, image_id in image_ids.items():
+                signature = store.signature(image_id)
+                if signature is not None:
+                    known_signatures[name] = signature
+            logging.info(f"{len(tif_blobs) - len(known_signatures)} of {len(tif_blobs)} files "
+                         f"are new or changed since the last incremental run")
 
-            try:
-                img2 = download_tif_from_bucket(blob2)
-                comparison = compare_tif_images(img1, img2, blob1.name, blob2.name)
-
-                if "ssim" in comparison and comparison["ssim"] >= similarity_threshold:
-                    logging.info(f"SSIM value {comparison['ssim']} meets threshold. Adding to report.")
-                    report["comparisons"][f"{blob1.name} vs {blob2.name}"] = comparison
-                elif "error" in comparison:
-                    logging.warning(f"Error in comparison: {comparison['error']}")
-                    report["comparisons"][f"{blob1.name} vs {blob2.name}"] = comparison
-                else:
-                    logging.info(f"SSIM value {comparison.get('ssim')} below threshold. Skipping.")
-            except Exception as e:
-                logging.error(f"Error comparing {blob1.name} and {blob2.name}: {str(e)}")
-                report["comparisons"][f"{blob1.name} vs {blob2.name}"] = {"error": str(e)}
+        def stored(blob1, blob2):
+            return store.get(image_ids[blob1.name], image_ids[blob2.name])
+
+        # Images of different shape or dtype can never match, so pairs across
+        # groups are reported in bulk instead of being downloaded and compared.
+        progress("grouping")
+        groups, unreadable = group_by_signature(tif_blobs, images, known_signatures)
+        if store is not None:
+            for signature, blobs in groups.items():
+                for blob in blobs:
+                    if blob.name not in known_signatures:
+                        store.set_signature(image_ids[blob.name], signature)
+        readable_count = len(tif_blobs) - len(unreadable)
+        readable_pairs = readable_count * (readable_count - 1) // 2
+        total_comparisons = sum(len(blobs) * (len(blobs) - 1) // 2 for blobs in groups.values())
+        large_names = {blob.name for signature, blobs in groups.items()
+                       if signature_nbytes(signature) > LAZY_DECODE_BYTES for blob in blobs}
+        if large_names:
+            logging.info(f"{len(large_names)} files exceed {LAZY_DECODE_BYTES} bytes decoded "
+                         f"and will be compared band by band")
+        prefilter_stage = ThumbnailPrefilter(images, calculate_ssim, similarity_threshold, prefilter_margin,
+                                             PREFILTER_SIZE, exclude=large_names) if prefilter else None
+        logging.info(f"Found {len(groups)} shape/dtype groups and {len(unreadable)} unreadable files; "
+                     f"{total_pairs - total_comparisons} of {total_pairs} pairs cannot match. "
+                     f"Total comparisons to be made: {total_comparisons}")
+
+        # Rows of the pair matrix in the order candidate_pairs walks them
+        rows = [blob1.name for group_blobs in groups.values() for blob1 in group_blobs[:-1]]
+        row_index = {name: index for index, name in enumerate(rows)}
+        if start_row:
+            logging.info(f"Skipping {start_row} of {len(rows)} rows completed by a previous run")
+
+        # Counters as of the start of the current row, which is what a
+        # checkpoint may record
+        current_row = start_row
+        row_counters = dict(counters)
+        compared_since_checkpoint = 0
+        store_saved_at = time.monotonic()
+
+        def checkpoint(row):
+            nonlocal compared_since_checkpoint, store_saved_at
+            if store is not None:
+                store.flush()
+                if time.monotonic() - store_saved_at >= PAIR_STORE_SNAPSHOT_SECONDS:
+                    store.save()
+                    store_saved_at = time.monotonic()
+            writer.checkpoint(row, dict(row_counters))
+            compared_since_checkpoint = 0
+
+        def pairs_done():
+            return counters["compared"] + counters["reused"] + counters["pruned_by_prefilter"]
+
+        progress("comparing", pairs_done(), total_comparisons)
+        pairs = candidate_pairs(groups, prefilter_stage, start_row, stored if store is not None else None)
+        pairs = compare_large_pairs(pairs, large_names)
+        if workers > 1:
+            results = compare_parallel(pairs, images, workers, SSIM_BATCH_SIZE, batch_bytes=SSIM_BATCH_BYTES)
+        else:
+            results = compare_serial(pairs, images, SSIM_BATCH_SIZE, batch_bytes=SSIM_BATCH_BYTES)
+
+        for blob1, blob2, comparison in results:
+            row = row_index[blob1.name]
+            if row != current_row:
+                # Every row before this one is finished
+                row_counters.update(counters)
+                current_row = row
+                if (compared_since_checkpoint >= REPORT_CHECKPOINT_PAIRS
+                        or writer.buffered >= REPORT_PART_RECORDS):
+                    checkpoint(row)
+
+            progress("comparing", pairs_done(), total_comparisons)
+            from_store = comparison.pop("stored", False)
+            if store is not None and not from_store:
+                store.put(image_ids[blob1.name], image_ids[blob2.name], comparison)
+            if "prefilter_ssim" in comparison:
+                counters["pruned_by_prefilter"] += 1
+                continue
+            if from_store:
+                counters["reused"] += 1
+                logging.debug(f"Reusing stored result for {blob1.name} vs {blob2.name}")
+            else:
+                counters["compared"] += 1
+                compared_since_checkpoint += 1
+                metrics.log_item(f"Comparison {counters['compared']}/{total_comparisons}: {blob1.name} vs {blob2.name}")
+
+            record = {"type": "comparison", "pair": f"{blob1.name} vs {blob2.name}",
+                      "file1": blob1.name, "file2": blob2.name, **comparison}
+            if "ssim" in comparison and comparison["ssim"] >= similarity_threshold:
+                metrics.log_item(f"SSIM value {comparison['ssim']} meets threshold. Adding to report.")
+                counters["matches"] += 1
+                writer.write(record)
+            elif "error" in comparison:
+                logging.warning(f"Error in comparison: {comparison['error']}")
+                counters["errors"] += 1
+                writer.write(record)
+            else:
+                metrics.log_item(f"SSIM value {comparison.get('ssim')} below threshold. Skipping.")
+
+        row_counters.update(counters)
+        checkpoint(len(rows))
+        if store is not None:
+            # Deleted objects and overwritten generations are never asked for again
+            store.retain(image_ids.values())
+            store.save()
+
+        summary = {
+            "bucket": bucket_name,
+            "mode": mode,
+            "similarity_threshold": similarity_threshold,
+            "shape_groups": [
+                {"shape": list(shape), "dtype": dtype, "files": [blob.name for blob in blobs]}
+                for (shape, dtype), blobs in groups.items()
+            ],
+            "unreadable_files": unreadable,
+            "pairs": {
+                "total": total_pairs,
+                "unreadable": total_pairs - readable_pairs,
+                "pruned_by_shape": readable_pairs - total_comparisons,
+                "pruned_by_prefilter": counters["pruned_by_prefilter"],
+                "compared": counters["compared"],
+                "reused": counters["reused"],
+                "matches": counters["matches"],
+                "errors": counters["errors"]
+            },
+            "resumed_from_row": start_row,
+            "cache": images.stats()
+        }
+        if store is not None:
+            summary["new_or_changed_files"] = len(tif_blobs) - len(known_signatures)
+        logging.info(f"Image cache: {summary['cache']}")
 
     logging.info("Similarity report generation complete")
-    return report
+    return summary
 
-def save_report_to_bucket(bucket_name, report, report_filename):
-    """Save the JSON report to the bucket."""
-    logging.info(f"Saving report to bucket: {bucket_name}, filename: {report_filename}")
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(report_filename)
-    report_json = json.dumps(report, indent=2)
-    blob.upload_from_string(report_json, content_type="application/json")
-    report_url = f"gs://{bucket_name}/{report_filename}"
-    logging.info(f"Report saved successfully. URL: {report_url}")
-    return report_url
+def new_analyze_job(job_id, bucket_name, params):
+    return {
+        "job_id": job_id,
+        "bucket": bucket_name,
+        "params": params,
+        "status": "queued",
+        "instance": INSTANCE_ID,
+        "stage": None,
+        "pairs_done": 0,
+        "pairs_total": None,
+        "pairs_per_second": None,
+        "eta_seconds": None,
+        "report_url": f"gs://{bucket_name}/{params['report_filename']}",
+        "pairs": None,
+        "created_at": now_iso(),
+        "started_at": None,
+        "updated_at": None,
+        "finished_at": None,
+        "error": None
+    }
+
+def job_is_live(state):
+    """Whether a job is queued or running on an instance that saved its
+    state within the lease."""
+    if state is None or state["status"] in FINISHED_STATUSES or not state.get("updated_at"):
+        return False
+    age = (datetime.now(timezone.utc) - datetime.fromisoformat(state["updated_at"])).total_seconds()
+    return age < JOB_LEASE_SECONDS
+
+def run_analyze_job(state, cancelled):
+    """Run a queued /analyze job, saving its progress to the job store every
+    JOB_HEARTBEAT_SECONDS and at each stage.
+
+    The job stops at the next pair once ``cancelled`` is set or a
+    cancellation was requested through the job store. A stopped or failed
+    job keeps its checkpointed report parts, so submitting its job_id again
+    resumes it.
+    """
+    bucket_name, params = state["bucket"], state["params"]
+    job_store = JobStore(storage_client.bucket(bucket_name))
+    # The stored state is authoritative: the job may have been cancelled, or
+    # resubmitted to another instance, while it waited in this one's queue
+    stored = job_store.load(state["job_id"])
+    if stored is not None:
+        if stored["instance"] != INSTANCE_ID:
+            logging.info(f"Job {state['job_id']} was taken over by instance {stored['instance']}; skipping it")
+            return
+        state = stored
+    if cancelled.is_set() or state["status"] != "queued" or job_store.cancel_requested(state["job_id"]):
+        if state["status"] not in FINISHED_STATUSES:
+            state.update(status="cancelled", finished_at=now_iso())
+            job_store.save(state)
+        logging.info(f"Job {state['job_id']} was cancelled before it started")
+        return
+    state.update(status="running", instance=INSTANCE_ID, started_at=now_iso(), error=None)
+    last_saved = time.monotonic()
+    job_store.save(state)
+
+    rate_start = None
+
+    def progress(stage, pairs_done=None, pairs_total=None):
+        nonlocal last_saved, rate_start
+        if cancelled.is_set():
+            raise JobCancelled()
+        now = time.monotonic()
+        stage_changed = stage != state["stage"]
+        state["stage"] = stage
+        if pairs_done is not None:
+            # Throughput of this run only; pairs a resumed run skipped are
+            # already in the first pairs_done
+            if rate_start is None:
+                rate_start = (now, pairs_done)
+            state["pairs_done"], state["pairs_total"] = pairs_done, pairs_total
+            elapsed = now - rate_start[0]
+            rate = (pairs_done - rate_start[1]) / elapsed if elapsed > 0 else 0
+            state["pairs_per_second"] = round(rate, 2) if rate else None
+            state["eta_seconds"] = round((pairs_total - pairs_done) / rate) if rate else None
+        if stage_changed or now - last_saved >= JOB_HEARTBEAT_SECONDS:
+            if job_store.cancel_requested(state["job_id"]):
+                cancelled.set()
+                raise JobCancelled()
+            job_store.save(state)
+            last_saved = now
+
+    try:
+        writer = ReportWriter(storage_client.bucket(bucket_name), params["report_filename"])
+        summary = generate_similarity_report(bucket_name, writer, params["similarity_threshold"],
+                                             params["prefilter"], params["prefilter_margin"],
+                                             params["workers"], params["mode"], progress)
+        progress("finishing")
+        writer.finish(summary)
+        state.update(status="completed", pairs=summary["pairs"], eta_seconds=0,
+                     pairs_done=state["pairs_total"] or 0)
+        logging.info(f"Job {state['job_id']} completed")
+    except JobCancelled:
+        state["status"] = "cancelled"
+        logging.info(f"Job {state['job_id']} cancelled")
+    except Exception as e:
+        logging.error(f"Error in analysis job {state['job_id']}: {str(e)}")
+        state.update(status="failed", error=str(e))
+    state["finished_at"] = now_iso()
+    job_store.save(state)
+
+def heartbeat_queued_job(state):
+    """Renew the lease of a job waiting in this instance's queue, unless it
+    was cancelled or taken over in the meantime."""
+    job_store = JobStore(storage_client.bucket(state["bucket"]))
+    stored = job_store.load(state["job_id"])
+    if stored is not None and stored["instance"] == INSTANCE_ID and stored["status"] == "queued":
+        job_store.save(stored)
+
+analyze_jobs = JobQueue(run_analyze_job, ANALYZE_JOB_WORKERS, heartbeat_queued_job, JOB_HEARTBEAT_SECONDS)
+metrics.QUEUE_DEPTH.labels('analyze_jobs').set_function(analyze_jobs.depth)
 
 @app.route('/analyze', methods=['POST'])
 def analyze_bucket():
+    """Queue a similarity report job and return its id right away.
+
+    Passing the job_id of a failed, cancelled or abandoned job resumes it
+    with its original parameters.
+    """
     logging.info("Received analyze request")
     data = request.json
     bucket_name = data.get('bucket_name')
-    similarity_threshold = data.get('similarity_threshold', 0.9)
-    report_filename = data.get('report_filename', f"similarity_report_{datetime.now().isoformat()}.json")
+    job_id = data.get('job_id') or uuid.uuid4().hex
+    params = {
+        "similarity_threshold": data.get('similarity_threshold', 0.9),
+        "prefilter": data.get('prefilter', PREFILTER),
+        "prefilter_margin": data.get('prefilter_margin', PREFILTER_MARGIN),
+        "workers": data.get('workers', SSIM_WORKERS),
+        # 'incremental' reuses the results stored by previous incremental runs
+        "mode": data.get('mode', 'full'),
+        # Passing the report_filename of an interrupted run resumes it
+        "report_filename": data.get('report_filename', f"similarity_report_{datetime.now().isoformat()}.ndjson")
+    }
 
-    logging.info(f"Request parameters: bucket_name={bucket_name}, similarity_threshold={similarity_threshold}, report_filename={report_filename}")
+    logging.info(f"Request parameters: bucket_name={bucket_name}, job_id={job_id}, {params}")
 
     if not bucket_name:
         logging.error("Missing required parameter: bucket_name")
         return jsonify({"error": "bucket_name is required"}), 400
+    if params["mode"] not in ANALYZE_MODES:
+        return jsonify({"error": f"mode must be one of {', '.join(ANALYZE_MODES)}"}), 400
+    try:
+        params["similarity_threshold"] = float(params["similarity_threshold"])
+        params["prefilter_margin"] = float(params["prefilter_margin"])
+        params["workers"] = int(params["workers"])
+    except (TypeError, ValueError):
+        return jsonify({"error": "similarity_threshold and prefilter_margin must be numbers, workers an integer"}), 400
+    if params["workers"] < 1:
+        return jsonify({"error": "workers must be a positive integer"}), 400
+    if params["workers"] > 1 and not IMAGE_CACHE_SPILL_DIR:
+        return jsonify({"error": "workers > 1 needs IMAGE_CACHE_SPILL_DIR set to a disk-backed directory"}), 400
 
     try:
-        logging.info("Starting similarity report generation")
-        report = generate_similarity_report(bucket_name, similarity_threshold)
-        logging.info("Similarity report generated successfully")
-
-        logging.info("Saving report to bucket")
-        report_url = save_report_to_bucket(bucket_name, report, report_filename)
-        logging.info("Report saved successfully")
-
-        return jsonify({
-            "message": "Analysis complete",
-            "report_url": report_url
-        }), 200
+        job_store = JobStore(storage_client.bucket(bucket_name))
+        state = job_store.load(job_id) if 'job_id' in data else None
+        if state is not None:
+            if job_is_live(state) or analyze_jobs.is_active((bucket_name, job_id)):
+                return jsonify({"status": "already_running", "job_id": job_id,
+                                "status_url": f"/jobs/{job_id}?bucket={bucket_name}"}), 202
+            if state["status"] == "completed":
+                return jsonify({"error": f"Job {job_id} already completed", "report_url": state["report_url"]}), 409
+            logging.info(f"Resuming {state['status']} job {job_id}")
+            job_store.clear_cancel(job_id)
+            state.update(status="queued", instance=INSTANCE_ID, finished_at=None, error=None)
+        else:
+            state = new_analyze_job(job_id, bucket_name, params)
+        job_store.save(state)
+        analyze_jobs.submit((bucket_name, job_id), state)
     except Exception as e:
-        logging.error(f"Error in analysis: {str(e)}")
+        logging.error(f"Error queueing analysis: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+    return jsonify({
+        "status": state["status"],
+        "job_id": job_id,
+        "status_url": f"/jobs/{job_id}?bucket={bucket_name}",
+        "report_url": state["report_url"]
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    bucket_name = request.args.get('bucket')
+    if not bucket_name:
+        return jsonify({"error": "bucket is required"}), 400
+
+    state = JobStore(storage_client.bucket(bucket_name)).load(job_id)
+    if state is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify({
+        **state,
+        "live": job_is_live(state),
+        "running_on_this_instance": analyze_jobs.is_active((bucket_name, job_id))
+    }), 200
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Stop a job at its next pair. Its report parts are kept, so it can be
+    resumed later through /analyze."""
+    bucket_name = request.args.get('bucket') or (request.get_json(silent=True) or {}).get('bucket')
+    if not bucket_name:
+        return jsonify({"error": "bucket is required"}), 400
+
+    job_store = JobStore(storage_client.bucket(bucket_name))
+    state = job_store.load(job_id)
+    if state is None:
+        return jsonify({"error": "Job not found"}), 404
+    if state["status"] in FINISHED_STATUSES:
+        return jsonify({"error": f"Job {job_id} already {state['status']}"}), 409
+
+    # Written in every case, so an instance that still has the job queued
+    # does not start it
+    job_store.request_cancel(job_id)
+    if analyze_jobs.cancel((bucket_name, job_id)) or job_is_live(state):
+        # The instance running it sees the request at its next heartbeat
+        return jsonify({"status": "cancelling", "job_id": job_id}), 202
+    # Nobody is working on it any more
+    state.update(status="cancelled", finished_at=now_iso())
+    job_store.save(state)
+    return jsonify({"status": "cancelled", "job_id": job_id}), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    body, content_type = metrics.exposition()
+    return Response(body, content_type=content_type)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     logging.info("Health check requested")
@@ -0,0 +1,94 @@
+import itertools
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Log a JSON line per stage span (stage, seconds, items, bytes), which
+# Cloud Logging turns into structured entries
+TRACE_STAGES = os.environ.get('TRACE_STAGES', 'false').lower() == 'true'
+# Per-file and per-pair log lines: 1 logs every one at INFO, N > 1 logs one
+# in N at DEBUG (shown with LOG_LEVEL=DEBUG), 0 logs none
+ITEM_LOG_SAMPLE = int(os.environ.get('ITEM_LOG_SAMPLE', 1))
+
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800)
+
+STAGE_SECONDS = Histogram('gcs_ssim_comparison_stage_seconds', 'Time spent per call of each pipeline stage',
+                          ['stage'], buckets=STAGE_BUCKETS)
+STAGE_ITEMS = Counter('gcs_ssim_comparison_stage_items_total',
+                      'Files or pairs through each pipeline stage', ['stage'])
+STAGE_BYTES = Counter('gcs_ssim_comparison_stage_bytes_total',
+                      'Bytes through each pipeline stage; rate() gives bytes/sec', ['stage'])
+STAGE_ERRORS = Counter('gcs_ssim_comparison_stage_errors_total', 'Stage calls that raised', ['stage'])
+QUEUE_DEPTH = Gauge('gcs_ssim_comparison_queue_depth', 'Work queued or in flight', ['queue'])
+
+_item_counter = itertools.count()
+_captured = None
+
+
+class Span:
+    """What a stage call handled; set ``items`` and ``nbytes`` inside it."""
+
+    def __init__(self, items, nbytes):
+        self.items = items
+        self.nbytes = nbytes
+
+
+def _record(name, elapsed, items, nbytes, failed=False, trace=True):
+    STAGE_SECONDS.labels(name).observe(elapsed)
+    STAGE_ITEMS.labels(name).inc(items)
+    if nbytes:
+        STAGE_BYTES.labels(name).inc(nbytes)
+    if failed:
+        STAGE_ERRORS.labels(name).inc()
+    if _captured is not None:
+        _captured.append((name, elapsed, items, nbytes, failed))
+    if TRACE_STAGES and trace:
+        logging.info(json.dumps({'span': name, 'seconds': round(elapsed, 6), 'items': items, 'bytes': nbytes}))
+
+
+@contextmanager
+def stage(name, items=1, nbytes=0):
+    """Time a call of a pipeline stage (list, header, download, decode,
+    prefilter, ssim, upload)."""
+    span = Span(items, nbytes)
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield span
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        _record(name, time.perf_counter() - started, span.items, span.nbytes, failed)
+
+
+def capture():
+    """Start collecting this process's stage observations in the returned
+    list, for a worker process to hand back to the parent's replay()."""
+    global _captured
+    _captured = []
+    return _captured
+
+
+def replay(observations):
+    """Record observations captured in a worker process, which has its own
+    registry that /metrics does not see."""
+    for name, elapsed, items, nbytes, failed in observations:
+        _record(name, elapsed, items, nbytes, failed, trace=False)
+
+
+def log_item(message):
+    """Log a per-file or per-pair line, subject to ITEM_LOG_SAMPLE."""
+    if ITEM_LOG_SAMPLE == 1:
+        logging.info(message)
+    elif ITEM_LOG_SAMPLE > 1 and next(_item_counter) % ITEM_LOG_SAMPLE == 0:
+        logging.debug(message)
+
+
+def exposition():
+    """Body and content type of the /metrics response."""
+    return generate_latest(), CONTENT_TYPE_LATEST
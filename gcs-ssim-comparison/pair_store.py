@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+import sqlite3
+
+# State objects live under this prefix of the analyzed bucket, like the
+# hash processor's .gcs-hash-processor/ job checkpoints
+STATE_PREFIX = '.gcs-ssim-comparison/'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id         INTEGER PRIMARY KEY,
+    name       TEXT    NOT NULL,
+    generation INTEGER NOT NULL,
+    shape      TEXT,
+    dtype      TEXT,
+    UNIQUE (name, generation)
+);
+CREATE TABLE IF NOT EXISTS pairs (
+    image1         INTEGER NOT NULL,
+    image2         INTEGER NOT NULL,
+    ssim           REAL,
+    prefilter_ssim REAL,
+    PRIMARY KEY (image1, image2)
+) WITHOUT ROWID;
+"""
+
+
+class PairStore:
+    """SQLite store of comparison results keyed by object versions.
+
+    Every image is identified by its (name, generation), so a result stays
+    valid exactly as long as neither object is overwritten. A pair holds
+    either its full-resolution ``ssim`` or the ``prefilter_ssim`` of the
+    thumbnails that pruned it; failed comparisons are not stored, so they
+    are retried by the next run. The raw scores
+    are kept whatever the threshold, so a later run with another threshold
+    or margin can reuse them. The image header signature (shape, dtype) is
+    kept as well, so unchanged images are not even read.
+
+    The database is a local file, snapshotted to ``pairs.sqlite3`` under
+    STATE_PREFIX in the bucket by save() and restored by load(), since the
+    local disk of a Cloud Run instance does not outlive it.
+    """
+
+    def __init__(self, bucket, path):
+        self.bucket = bucket
+        self.path = path
+        self.blob = bucket.blob(f'{STATE_PREFIX}pairs.sqlite3')
+        self.connection = None
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def load(self):
+        """Restore the snapshot from the bucket, or start an empty store."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if self.blob.exists():
+            self.blob.download_to_filename(self.path)
+            logging.info(f"Loaded pair store gs://{self.bucket.name}/{self.blob.name} "
+                         f"({os.path.getsize(self.path)} bytes)")
+        else:
+            logging.info(f"No pair store in gs://{self.bucket.name}; starting an empty one")
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(SCHEMA)
+        return self
+
+    def image_id(self, name, generation):
+        """Id of an object version, registering it when it is new."""
+        row = self.connection.execute('SELECT id FROM images WHERE name = ? AND generation = ?',
+                                      (name, int(generation))).fetchone()
+        if row:
+            return row[0]
+        return self.connection.execute('INSERT INTO images (name, generation) VALUES (?, ?)',
+                                       (name, int(generation))).lastrowid
+
+    def signature(self, image_id):
+        """The (shape, dtype) recorded for an image, or None."""
+        row = self.connection.execute('SELECT shape, dtype FROM images WHERE id = ?', (image_id,)).fetchone()
+        if not row or row[0] is None:
+            return None
+        return tuple(json.loads(row[0])), row[1]
+
+    def set_signature(self, image_id, signature):
+        self.connection.execute('UPDATE images SET shape = ?, dtype = ? WHERE id = ?',
+                                (json.dumps(list(signature[0])), signature[1], image_id))
+
+    def get(self, image1, image2):
+        """The stored comparison of a pair, or None.
+
+        Returns {"ssim": ...} for compared pairs and {"prefilter_ssim": ...}
+        for pairs the prefilter pruned.
+        """
+        row = self.connection.execute(
+            'SELECT ssim, prefilter_ssim FROM pairs WHERE image1 = ? AND image2 = ?',
+            (min(image1, image2), max(image1, image2))).fetchone()
+        if not row:
+            return None
+        ssim_value, prefilter_ssim = row
+        if ssim_value is not None:
+            return {"ssim": ssim_value}
+        return {"prefilter_ssim": prefilter_ssim}
+
+    def put(self, image1, image2, comparison):
+        """Queue a result; it is written by the next flush(). Comparisons
+        that failed are ignored."""
+        if "error" in comparison:
+            return
+        self._pending.append((min(image1, image2), max(image1, image2), comparison.get("ssim"),
+                              comparison.get("prefilter_ssim")))
+
+    def flush(self):
+        if self._pending:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO pairs (image1, image2, ssim, prefilter_ssim) VALUES (?, ?, ?, ?)',
+                self._pending)
+            self._pending = []
+        self.connection.commit()
+
+    def retain(self, image_ids):
+        """Drop every image not in ``image_ids`` and the pairs involving it,
+        which removes deleted objects and superseded generations."""
+        self.connection.execute('CREATE TEMP TABLE IF NOT EXISTS current (id INTEGER PRIMARY KEY)')
+        self.connection.execute('DELETE FROM current')
+        self.connection.executemany('INSERT INTO current (id) VALUES (?)', ((i,) for i in image_ids))
+        stale = self.connection.execute('DELETE FROM images WHERE id NOT IN (SELECT id FROM current)').rowcount
+        if stale:
+            self.connection.execute('DELETE FROM pairs WHERE image1 NOT IN (SELECT id FROM current) '
+                                    'OR image2 NOT IN (SELECT id FROM current)')
+            logging.info(f"Dropped {stale} stale images from the pair store")
+        self.connection.execute('DROP TABLE current')
+
+    def save(self):
+        """Commit and upload the snapshot to the bucket."""
+        self.flush()
+        if self._should_vacuum():
+            self.connection.execute('VACUUM')
+        self.blob.upload_from_filename(self.path, content_type='application/vnd.sqlite3')
+        logging.info(f"Saved pair store to gs://{self.bucket.name}/{self.blob.name} "
+                     f"({os.path.getsize(self.path)} bytes)")
+
+    def _should_vacuum(self):
+        free, total = (self.connection.execute(f'PRAGMA {pragma}').fetchone()[0]
+                       for pragma in ('freelist_count', 'page_count'))
+        return total and free > total // 4
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
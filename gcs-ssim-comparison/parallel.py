@@ -0,0 +1,152 @@
+import itertools
+import logging
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import metrics
+from similarity import batch_capacity, compare_tif_batch
+
+# Memory maps each worker keeps open
+WORKER_OPEN_IMAGES = 64
+# Default memory budget of one vectorized SSIM call
+BATCH_BYTES = 512 * 1024 ** 2
+
+_worker_images = OrderedDict()
+
+
+def _init_worker(log_level):
+    logging.basicConfig(level=log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def _open_image(path):
+    array = _worker_images.get(path)
+    if array is None:
+        array = np.load(path, mmap_mode='r')
+        _worker_images[path] = array
+        if len(_worker_images) > WORKER_OPEN_IMAGES:
+            _worker_images.popitem(last=False)
+    else:
+        _worker_images.move_to_end(path)
+    return array
+
+
+def compare_runs(tasks, load, batch_size, batch_bytes=BATCH_BYTES):
+    """Compare (key1, name1, key2, name2) tasks, loading images with load(key).
+
+    Consecutive tasks that share their first image are compared one-vs-many
+    in batches of up to ``batch_size``, fewer when the batch would need more
+    than ``batch_bytes`` (see batch_capacity); images too large for any batch
+    are compared pair by pair. Returns the comparisons in order.
+    """
+    results = []
+    for _, run in itertools.groupby(tasks, key=lambda task: task[0]):
+        run = list(run)
+        key1, name1 = run[0][:2]
+        try:
+            img1 = load(key1)
+        except Exception as e:
+            results.extend({"error": str(e)} for _ in run)
+            continue
+        size = min(batch_size, batch_capacity(img1, batch_bytes))
+        for start in range(0, len(run), size):
+            batch = run[start:start + size]
+            comparisons = [None] * len(batch)
+            loaded = []
+            for position, (_, _, key2, name2) in enumerate(batch):
+                try:
+                    loaded.append((position, name2, load(key2)))
+                except Exception as e:
+                    comparisons[position] = {"error": str(e)}
+            with metrics.stage('ssim', items=len(loaded),
+                               nbytes=img1.nbytes + sum(img2.nbytes for _, _, img2 in loaded)):
+                batch_results = compare_tif_batch(img1, [img2 for _, _, img2 in loaded], name1,
+                                                  [name2 for _, name2, _ in loaded])
+            for (position, _, _), comparison in zip(loaded, batch_results):
+                comparisons[position] = comparison
+            results.extend(comparisons)
+    return results
+
+
+def _compare_chunk(tasks, batch_size, batch_bytes):
+    """Compare (name1, path1, name2, path2) tasks from memory-mapped images.
+
+    Returns the comparisons and the stage observations made on the way.
+    """
+    observations = metrics.capture()
+    results = compare_runs([(path1, name1, path2, name2) for name1, path1, name2, path2 in tasks],
+                           _open_image, batch_size, batch_bytes)
+    return results, observations
+
+
+def _chunks(pairs, chunk_size):
+    chunk = []
+    for pair in pairs:
+        chunk.append(pair)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def compare_serial(pairs, images, batch_size=8, chunk_size=32, batch_bytes=BATCH_BYTES):
+    """Yield (blob1, blob2, comparison) for each (blob1, blob2, known) pair,
+    in order. Pairs whose ``known`` comparison is not None are passed
+    through without being compared."""
+    for chunk in _chunks(pairs, chunk_size):
+        tasks = [(blob1.name, blob1.name, blob2.name, blob2.name)
+                 for blob1, blob2, known in chunk if known is None]
+        results = iter(compare_runs(tasks, images.get, batch_size, batch_bytes))
+        for blob1, blob2, known in chunk:
+            yield blob1, blob2, next(results) if known is None else known
+
+
+def compare_parallel(pairs, images, workers, batch_size=8, chunk_size=32, batch_bytes=BATCH_BYTES):
+    """compare_serial on a pool of ``workers`` processes.
+
+    The parent decodes each image once and hands workers the path of its
+    .npy file in ``images`` (an ImageCache with a spill_dir), which they
+    memory-map, so pixels are shared through the page cache instead of being
+    pickled per pair. Results are yielded in the order of ``pairs``, which
+    keeps the report identical to the serial one. At most 4 chunks per
+    worker are queued at a time.
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             initargs=(logging.getLogger().level,)) as executor:
+        queued = deque()
+
+        def submit(chunk):
+            tasks, settled = [], {}
+            for position, (blob1, blob2, known) in enumerate(chunk):
+                if known is not None:
+                    settled[position] = known
+                    continue
+                try:
+                    tasks.append((blob1.name, images.path(blob1.name), blob2.name, images.path(blob2.name)))
+                except Exception as e:
+                    settled[position] = {"error": str(e)}
+            future = executor.submit(_compare_chunk, tasks, batch_size, batch_bytes) if tasks else None
+            queued.append((chunk, settled, future))
+            metrics.QUEUE_DEPTH.labels('ssim_chunks').set(len(queued))
+
+        def collect():
+            chunk, settled, future = queued.popleft()
+            metrics.QUEUE_DEPTH.labels('ssim_chunks').set(len(queued))
+            results = ()
+            if future is not None:
+                results, observations = future.result()
+                metrics.replay(observations)
+            results = iter(results)
+            for position, (blob1, blob2, _) in enumerate(chunk):
+                yield blob1, blob2, settled[position] if position in settled else next(results)
+
+        for chunk in _chunks(pairs, chunk_size):
+            submit(chunk)
+            if len(queued) >= 4 * workers:
+                yield from collect()
+        while queued:
+            yield from collect()
@@ -0,0 +1,64 @@
+import math
+
+import numpy as np
+
+
+def thumbnail(array, size):
+    """Block-average every axis longer than ``size`` down to at most ``size``.
+
+    Returns None when no axis is longer than ``size``, since comparing the
+    thumbnail would then cost as much as comparing the image.
+    """
+    factors = [math.ceil(length / size) for length in array.shape]
+    if all(factor == 1 for factor in factors):
+        return None
+    # Crop each axis to a multiple of its factor, then average the blocks
+    cropped = array[tuple(slice(0, length - length % factor) for length, factor in zip(array.shape, factors))]
+    blocked_shape = []
+    for length, factor in zip(cropped.shape, factors):
+        blocked_shape += [length // factor, factor]
+    blocks = cropped.astype(np.float64).reshape(blocked_shape)
+    return blocks.mean(axis=tuple(range(1, 2 * array.ndim, 2)))
+
+
+class ThumbnailPrefilter:
+    """First stage of the comparison: SSIM between downsampled thumbnails.
+
+    Each image's thumbnail is computed once, the first time the image takes
+    part in a pair. A pair is pruned when its thumbnail SSIM is below
+    ``threshold - margin``; the margin absorbs the difference between SSIM
+    at thumbnail and at full resolution. ``similarity(img1, img2,
+    data_range)`` is the SSIM function used at full resolution, and the
+    thumbnails use the data range of the full-resolution image so both
+    stages score on the same scale. Images named in ``exclude`` are never
+    loaded; their pairs always pass.
+    """
+
+    def __init__(self, images, similarity, threshold, margin=0.2, size=64, exclude=()):
+        self.images = images
+        self.similarity = similarity
+        self.threshold = threshold
+        self.margin = margin
+        self.size = size
+        self._signatures = {name: None for name in exclude}
+
+    def signature(self, name):
+        if name not in self._signatures:
+            array = self.images.get(name)
+            data_range = array.max() - array.min()
+            thumb = thumbnail(array, self.size)
+            self._signatures[name] = None if thumb is None else (thumb, data_range)
+        return self._signatures[name]
+
+    @property
+    def bound(self):
+        """Thumbnail SSIM below which a pair is pruned."""
+        return self.threshold - self.margin
+
+    def score(self, name1, name2):
+        """Thumbnail SSIM of the pair, or None when an image is too small to
+        have a thumbnail."""
+        signature1, signature2 = self.signature(name1), self.signature(name2)
+        if signature1 is None or signature2 is None:
+            return None
+        return self.similarity(signature1[0], signature2[0], data_range=signature1[1])
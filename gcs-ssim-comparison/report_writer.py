@@ -0,0 +1,109 @@
+import json
+import logging
+
+import metrics
+
+# GCS composes at most 32 source objects per request
+MAX_COMPOSE_SOURCES = 32
+
+
+class ReportWriter:
+    """Writes a similarity report to GCS as newline-delimited JSON.
+
+    Records are buffered and uploaded as part objects under
+    ``<report_filename>.parts/`` at each checkpoint, together with a
+    manifest holding the parts written so far, the number of completed rows
+    of the pair matrix and the counters of the run. Only the buffer since
+    the last checkpoint is ever held in memory, and a run that dies keeps
+    every part it checkpointed: a rerun with the same report_filename over
+    the same listing (same ``fingerprint``) resumes after the last
+    completed row. finish() appends the summary, composes the parts into
+    ``report_filename`` and removes them.
+    """
+
+    def __init__(self, bucket, report_filename):
+        self.bucket = bucket
+        self.report_filename = report_filename
+        self.parts_prefix = f"{report_filename}.parts/"
+        self.manifest_blob = bucket.blob(f"{self.parts_prefix}manifest.json")
+        self.state = None
+        self._buffer = []
+
+    @property
+    def url(self):
+        return f"gs://{self.bucket.name}/{self.report_filename}"
+
+    def open(self, fingerprint):
+        """Load the manifest of an interrupted run over the same listing, or
+        start a new report. Returns the state (rows_completed, counters)."""
+        if self.manifest_blob.exists():
+            state = json.loads(self.manifest_blob.download_as_bytes())
+            if state["fingerprint"] == fingerprint:
+                logging.info(f"Resuming report {self.report_filename} after row {state['rows_completed']} "
+                             f"({len(state['parts'])} parts written)")
+                self.state = state
+                return state
+            logging.warning(f"Listing changed since report {self.report_filename} was started; starting over")
+            self._delete_parts(state["parts"])
+        self.state = {"fingerprint": fingerprint, "rows_completed": 0, "parts": [], "counters": {}}
+        return self.state
+
+    def write(self, record):
+        self._buffer.append(json.dumps(record, default=float))
+
+    @property
+    def buffered(self):
+        return len(self._buffer)
+
+    def checkpoint(self, rows_completed, counters):
+        """Upload the buffered records as a part and save the manifest.
+
+        ``rows_completed`` and ``counters`` must describe exactly the records
+        written so far, since a resumed run continues from them.
+        """
+        if self._buffer:
+            name = f"{self.parts_prefix}part-{len(self.state['parts']):06d}.ndjson"
+            data = "\n".join(self._buffer) + "\n"
+            with metrics.stage('upload', items=len(self._buffer), nbytes=len(data)):
+                self.bucket.blob(name).upload_from_string(data, content_type="application/x-ndjson")
+            self.state["parts"].append(name)
+            self._buffer = []
+        self.state["rows_completed"] = rows_completed
+        self.state["counters"] = counters
+        self.manifest_blob.upload_from_string(json.dumps(self.state), content_type="application/json")
+        logging.info(f"Checkpointed report {self.report_filename}: {rows_completed} rows, "
+                     f"{len(self.state['parts'])} parts")
+
+    def finish(self, summary):
+        """Write the summary record and compose all parts into the report."""
+        self.write({"type": "summary", **summary})
+        self.checkpoint(self.state["rows_completed"], self.state["counters"])
+
+        sources = [self.bucket.blob(name) for name in self.state["parts"]]
+        intermediates = []
+        level = 0
+        while len(sources) > MAX_COMPOSE_SOURCES:
+            composed = []
+            for start in range(0, len(sources), MAX_COMPOSE_SOURCES):
+                target = self.bucket.blob(f"{self.parts_prefix}compose-{level}-{start // MAX_COMPOSE_SOURCES}")
+                target.content_type = "application/x-ndjson"
+                target.compose(sources[start:start + MAX_COMPOSE_SOURCES])
+                composed.append(target)
+            intermediates += [blob.name for blob in composed]
+            sources = composed
+            level += 1
+        report_blob = self.bucket.blob(self.report_filename)
+        report_blob.content_type = "application/x-ndjson"
+        report_blob.compose(sources)
+
+        self._delete_parts(self.state["parts"] + intermediates)
+        self.manifest_blob.delete()
+        logging.info(f"Report saved successfully. URL: {self.url}")
+        return self.url
+
+    def _delete_parts(self, names):
+        for name in names:
+            try:
+                self.bucket.blob(name).delete()
+            except Exception as e:
+                logging.warning(f"Could not delete report part {name}: {str(e)}")
@@ -0,0 +1,197 @@
+import logging
+
+import numpy as np
+from scipy.ndimage import uniform_filter
+from skimage.metrics import structural_similarity as ssim
+
+import metrics
+
+# Constants structural_similarity uses by default
+K1 = 0.01
+K2 = 0.03
+# Peak memory of calculate_ssim_batch, in float copies of one image: about
+# 7 for img1's statistics plus 9 per candidate (measured on 1024x1024
+# uint16 images), rounded up
+SSIM_FIXED_MAPS = 8
+SSIM_MAPS_PER_CANDIDATE = 10
+
+def ssim_win_size(shape1, shape2):
+    """Window size for SSIM, shrunk to fit images smaller than 7 pixels."""
+    min_dim = min(shape1[0], shape1[1], shape2[0], shape2[1])
+
+    if min_dim < 7:
+        logging.warning(f"Image too small for default SSIM. Using win_size={min_dim}")
+        win_size = min_dim if min_dim % 2 != 0 else min_dim - 1
+    else:
+        win_size = 7  # default win_size
+    return win_size
+
+def calculate_ssim(img1, img2, data_range=None):
+    """Calculate SSIM between two images, handling small images.
+
+    data_range defaults to the value range of img1.
+    """
+    win_size = ssim_win_size(img1.shape, img2.shape)
+
+    metrics.log_item(f"Calculating SSIM with win_size={win_size}")
+    if data_range is None:
+        data_range = img1.max() - img1.min()
+    # Recent scikit-image releases ignore `multichannel`, so SSIM is taken
+    # over all axes of the array; calculate_ssim_batch relies on that.
+    return ssim(img1, img2, data_range=data_range, multichannel=True, win_size=win_size)
+
+def _float_type(dtype):
+    # What structural_similarity computes in for a given input dtype
+    return np.float32 if dtype in (np.float16, np.float32) else np.float64
+
+def _ssim_maps(img1, imgs2, win_size, data_range):
+    """Uncropped SSIM maps of img1 against each of imgs2, computed step by
+    step as structural_similarity does, with img1's statistics filtered once."""
+    if win_size < 3:
+        # A window of one pixel has no variance to normalize (NP - 1 == 0)
+        raise ValueError(f"win_size={win_size} is too small for SSIM")
+    float_type = _float_type(img1.dtype)
+    ndim = img1.ndim
+    size = (win_size,) * ndim
+
+    x = img1.astype(float_type, copy=False)
+    ys = np.stack(imgs2).astype(float_type, copy=False)
+    # The stack axis gets a window of 1, which the filter skips
+    stack_size = (1,) + size
+
+    NP = win_size ** ndim
+    cov_norm = NP / (NP - 1)
+
+    ux = uniform_filter(x, size=size)
+    uxx = uniform_filter(x * x, size=size)
+    vx = cov_norm * (uxx - ux * ux)
+    del uxx
+    uy = uniform_filter(ys, size=stack_size)
+    uyy = uniform_filter(ys * ys, size=stack_size)
+    uxy = uniform_filter(x * ys, size=stack_size)
+    del ys
+    vy = cov_norm * (uyy - uy * uy)
+    del uyy
+    vxy = cov_norm * (uxy - ux * uy)
+    del uxy
+
+    R = data_range
+    C1 = (K1 * R) ** 2
+    C2 = (K2 * R) ** 2
+
+    A1, A2, B1, B2 = (
+        2 * ux * uy + C1,
+        2 * vxy + C2,
+        ux ** 2 + uy ** 2 + C1,
+        vx + vy + C2,
+    )
+    D = B1 * B2
+    return (A1 * A2) / D
+
+def batch_capacity(img1, budget):
+    """Candidates of img1's shape calculate_ssim_batch can take at once
+    within ``budget`` bytes; 1 means comparing pair by pair."""
+    image_bytes = img1.size * np.dtype(_float_type(img1.dtype)).itemsize
+    return max(1, int((budget / max(image_bytes, 1) - SSIM_FIXED_MAPS) // SSIM_MAPS_PER_CANDIDATE))
+
+def calculate_ssim_batch(img1, imgs2, data_range=None):
+    """calculate_ssim of img1 against every image in imgs2, all of img1's
+    shape and dtype, in one vectorized pass.
+
+    img1's local means and variances are computed once instead of once per
+    pair, and the candidates' statistics are filtered as one stack. The
+    arithmetic follows structural_similarity step by step, so every value
+    is identical to what calculate_ssim returns for the same pair.
+    Raises ValueError for inputs calculate_ssim would reject.
+    """
+    win_size = ssim_win_size(img1.shape, img1.shape)
+    if any(img2.shape != img1.shape or img2.dtype != img1.dtype for img2 in imgs2):
+        raise ValueError("calculate_ssim_batch needs candidates of img1's shape and dtype")
+    if min(img1.shape) < win_size or win_size % 2 != 1:
+        raise ValueError("win_size does not fit the images")
+
+    metrics.log_item(f"Calculating SSIM of one image against {len(imgs2)} with win_size={win_size}")
+    if data_range is None:
+        data_range = img1.max() - img1.min()
+    S = _ssim_maps(img1, imgs2, win_size, data_range)
+
+    pad = (win_size - 1) // 2
+    crop = tuple(slice(pad, length - pad) for length in img1.shape)
+    # Averaged one image at a time, as the per-pair mean would be
+    return [S[k][crop].mean(dtype=np.float64) for k in range(len(imgs2))]
+
+def banded_value_range(read, length, band_length):
+    """max - min of an image read ``band_length`` entries of its first axis
+    at a time with read(start, stop)."""
+    low, high = None, None
+    for start in range(0, length, band_length):
+        band = read(start, min(start + band_length, length))
+        low = band.min() if low is None else min(low, band.min())
+        high = band.max() if high is None else max(high, band.max())
+    return high - low
+
+def calculate_ssim_banded(read1, read2, shape, band_length, data_range):
+    """calculate_ssim of two images of ``shape`` that are never held whole.
+
+    read1(start, stop) and read2(start, stop) return the range [start,
+    stop) of the first axis of each image. SSIM is computed band by band,
+    each band read with a margin of half a window on either side so its
+    local statistics are those of the whole image, and the cropped maps
+    are averaged together. Memory is bounded by ``band_length`` entries of
+    the first axis instead of the image. The value matches calculate_ssim
+    up to floating-point rounding, since the filters and the mean
+    accumulate in a different order. ``data_range`` is that of image 1
+    (see banded_value_range).
+    """
+    win_size = ssim_win_size(shape, shape)
+    if min(shape) < win_size or win_size % 2 != 1:
+        raise ValueError("win_size does not fit the images")
+    metrics.log_item(f"Calculating banded SSIM of {shape} images with win_size={win_size}, "
+                     f"{band_length} per band")
+
+    pad = (win_size - 1) // 2
+    length = shape[0]
+    crop_rest = tuple(slice(pad, n - pad) for n in shape[1:])
+    total, count = 0.0, 0
+    for start in range(pad, length - pad, band_length):
+        stop = min(start + band_length, length - pad)
+        img1, img2 = read1(start - pad, stop + pad), read2(start - pad, stop + pad)
+        S = _ssim_maps(img1, [img2], win_size, data_range)[0]
+        del img1, img2
+        cropped = S[(slice(pad, pad + stop - start),) + crop_rest]
+        total += cropped.sum(dtype=np.float64)
+        count += cropped.size
+    return total / count
+
+def compare_tif_images(img1, img2, name1, name2):
+    """Compare two TIF images using SSIM."""
+    metrics.log_item(f"Comparing images: {name1} vs {name2}")
+    if img1.shape != img2.shape:
+        logging.warning(f"Images have different dimensions. {name1}: {img1.shape}, {name2}: {img2.shape}")
+        return {"error": "Images have different dimensions."}
+
+    try:
+        ssim_value = calculate_ssim(img1, img2)
+        metrics.log_item(f"SSIM value for {name1} vs {name2}: {ssim_value}")
+        return {"ssim": ssim_value}
+    except Exception as e:
+        logging.error(f"Error in SSIM calculation for {name1} vs {name2}: {str(e)}")
+        return {"error": f"SSIM calculation failed: {str(e)}"}
+
+def compare_tif_batch(img1, imgs2, name1, names2):
+    """compare_tif_images of img1 against each of imgs2, batching the SSIM.
+
+    Falls back to comparing pair by pair when the candidates cannot be
+    stacked (different shapes or dtypes) or the batch kernel rejects them.
+    """
+    if len(imgs2) > 1:
+        try:
+            values = calculate_ssim_batch(img1, imgs2)
+        except ValueError:
+            pass
+        else:
+            for name2, ssim_value in zip(names2, values):
+                metrics.log_item(f"Comparing images: {name1} vs {name2}")
+                metrics.log_item(f"SSIM value for {name1} vs {name2}: {ssim_value}")
+            return [{"ssim": ssim_value} for ssim_value in values]
+    return [compare_tif_images(img1, img2, name1, name2) for img2, name2 in zip(imgs2, names2)]
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The service's modules live at the top of its directory, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# main creates its storage client at import; tests replace it with fakes
+os.environ.setdefault('STORAGE_EMULATOR_HOST', 'http://127.0.0.1:9')
+os.environ.setdefault('GOOGLE_CLOUD_PROJECT', 'test')
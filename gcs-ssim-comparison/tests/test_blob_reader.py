@@ -0,0 +1,46 @@
+import io
+
+import numpy as np
+import tifffile
+
+from blob_reader import BlobReader
+
+
+class FakeBlob:
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.ranges = []
+
+    def download_as_bytes(self, start, end, checksum=None):
+        self.ranges.append((start, end))
+        return self.data[start:end + 1]
+
+
+def test_large_reads_are_downloaded_a_block_at_a_time():
+    blob = FakeBlob(bytes(range(256)) * 100)
+    reader = BlobReader(blob, block_size=1000, max_blocks=2)
+    reader.seek(250)
+    buffer = bytearray(10000)
+    assert reader.readinto(buffer) == 10000
+    assert bytes(buffer) == blob.data[250:10250]
+    assert all(end - start < 1000 for start, end in blob.ranges)
+    assert reader.tell() == 10250
+
+
+def test_reads_stop_at_the_end_of_the_object():
+    blob = FakeBlob(b'x' * 2500)
+    reader = BlobReader(blob, block_size=1000)
+    reader.seek(2000)
+    assert reader.readinto(bytearray(1000)) == 500
+    assert reader.readinto(bytearray(1000)) == 0
+
+
+def test_contiguous_tiff_decodes_through_block_sized_reads():
+    image = np.arange(256 * 256, dtype=np.uint16).reshape(256, 256)
+    buffer = io.BytesIO()
+    tifffile.imwrite(buffer, image, contiguous=True)
+    blob = FakeBlob(buffer.getvalue())
+    with tifffile.TiffFile(io.BufferedReader(BlobReader(blob, block_size=4096, max_blocks=2))) as tif:
+        assert np.array_equal(tif.asarray(), image)
+    assert all(end - start < 4096 for start, end in blob.ranges)
@@ -0,0 +1,148 @@
+import threading
+import time
+
+import pytest
+
+import main
+from jobs import JobQueue
+
+BUCKET = 'test-bucket'
+
+
+class FakeBlob:
+    def __init__(self, objects, name):
+        self.objects = objects
+        self.name = name
+
+    def exists(self):
+        return self.name in self.objects
+
+    def download_as_bytes(self):
+        return self.objects[self.name]
+
+    def upload_from_string(self, data, content_type=None):
+        self.objects[self.name] = data.encode() if isinstance(data, str) else data
+
+    def delete(self):
+        del self.objects[self.name]
+
+
+class FakeBucket:
+    def __init__(self):
+        self.objects = {}
+
+    def blob(self, name):
+        return FakeBlob(self.objects, name)
+
+
+class FakeClient:
+    def __init__(self):
+        self.buckets = {}
+
+    def bucket(self, name):
+        return self.buckets.setdefault(name, FakeBucket())
+
+
+class FakeWriter:
+    def __init__(self, bucket, filename):
+        pass
+
+    def finish(self, summary):
+        pass
+
+
+@pytest.fixture
+def service(monkeypatch):
+    """The Flask client, with reports that run until released (or cancelled)
+    one pair at a time."""
+    release = threading.Event()
+    started = threading.Event()
+
+    def generate(bucket_name, writer, threshold, prefilter, margin, workers, mode, progress):
+        started.set()
+        done = 0
+        while not release.is_set():
+            progress("comparing", done, 1000)
+            time.sleep(0.01)
+        return {"pairs": done}
+
+    monkeypatch.setattr(main, 'storage_client', FakeClient())
+    monkeypatch.setattr(main, 'ReportWriter', FakeWriter)
+    monkeypatch.setattr(main, 'generate_similarity_report', generate)
+    yield main.app.test_client(), started, release
+    release.set()
+    main.analyze_jobs.join()
+
+
+def status(client, job_id):
+    return client.get(f'/jobs/{job_id}?bucket={BUCKET}').get_json()
+
+
+def wait_until_finished(client, job_id):
+    main.analyze_jobs.join()
+    return status(client, job_id)
+
+
+def test_submit_and_poll(service):
+    client, started, release = service
+    response = client.post('/analyze', json={'bucket_name': BUCKET})
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+    assert started.wait(5)
+    state = status(client, job_id)
+    assert state['status'] == 'running' and state['live']
+    release.set()
+    assert wait_until_finished(client, job_id)['status'] == 'completed'
+
+
+def test_cancel_while_running(service):
+    client, started, release = service
+    job_id = client.post('/analyze', json={'bucket_name': BUCKET}).get_json()['job_id']
+    assert started.wait(5)
+    response = client.post(f'/jobs/{job_id}/cancel?bucket={BUCKET}')
+    assert response.status_code == 202
+    assert wait_until_finished(client, job_id)['status'] == 'cancelled'
+
+
+def test_cancel_while_queued(service):
+    client, started, release = service
+    running = client.post('/analyze', json={'bucket_name': BUCKET}).get_json()['job_id']
+    assert started.wait(5)
+    queued = client.post('/analyze', json={'bucket_name': BUCKET}).get_json()['job_id']
+    assert status(client, queued)['status'] == 'queued'
+    assert client.post(f'/jobs/{queued}/cancel?bucket={BUCKET}').status_code == 202
+    release.set()
+    assert wait_until_finished(client, running)['status'] == 'completed'
+    state = status(client, queued)
+    assert state['status'] == 'cancelled' and state['started_at'] is None
+
+
+def test_queued_job_cancelled_elsewhere_is_not_started(service):
+    client, started, release = service
+    running = client.post('/analyze', json={'bucket_name': BUCKET}).get_json()['job_id']
+    assert started.wait(5)
+    queued = client.post('/analyze', json={'bucket_name': BUCKET}).get_json()['job_id']
+    # As another instance does when this one's lease looks expired: the
+    # job is not in its queue, so only the stored state and marker change
+    job_store = main.JobStore(main.storage_client.bucket(BUCKET))
+    state = job_store.load(queued)
+    job_store.request_cancel(queued)
+    state.update(status='cancelled', finished_at=main.now_iso())
+    job_store.save(state)
+    release.set()
+    main.analyze_jobs.join()
+    assert status(client, queued)['started_at'] is None
+
+
+def test_queued_jobs_are_heartbeated():
+    beats = []
+    started, gate = threading.Event(), threading.Event()
+    jobs = JobQueue(lambda job, cancelled: started.set() or gate.wait(5), heartbeat=beats.append, interval=0.01)
+    jobs.submit('running', 'running')
+    assert started.wait(5)
+    jobs.submit('queued', 'queued')
+    beats.clear()
+    time.sleep(0.1)
+    gate.set()
+    jobs.join()
+    assert 'queued' in beats and 'running' not in beats
@@ -0,0 +1,41 @@
+import itertools
+from types import SimpleNamespace
+
+import numpy as np
+
+from image_cache import ImageCache
+from parallel import compare_parallel, compare_serial
+
+
+def load(name):
+    if name == 'missing.tif':
+        raise FileNotFoundError(f'No such object: {name}')
+    rng = np.random.default_rng(sum(map(ord, name)))
+    # Too small for any SSIM window: every comparison with it is an error
+    shape = (2, 40) if name == 'tiny.tif' else (48, 48)
+    return rng.integers(0, 4000, shape, dtype=np.uint16)
+
+
+def pairs():
+    names = ['a.tif', 'b.tif', 'c.tif', 'd.tif', 'e.tif', 'tiny.tif', 'missing.tif']
+    blobs = [SimpleNamespace(name=name) for name in names]
+    for position, (blob1, blob2) in enumerate(itertools.combinations(blobs, 2)):
+        # Some comparisons are already known, as in incremental runs
+        yield blob1, blob2, {"ssim": 1.0, "known": True} if position % 7 == 3 else None
+
+
+def results(compare, tmp_path, **kwargs):
+    with ImageCache(load, 1024 ** 2, spill_dir=tmp_path) as images:
+        return [(blob1.name, blob2.name, comparison)
+                for blob1, blob2, comparison in compare(pairs(), images, batch_size=2, chunk_size=3, **kwargs)]
+
+
+def test_process_pool_matches_serial(tmp_path):
+    serial = results(compare_serial, tmp_path)
+    parallel = results(compare_parallel, tmp_path, workers=2)
+    assert parallel == serial
+    comparisons = [comparison for _, _, comparison in serial]
+    assert any('error' in comparison and 'No such object' in comparison['error'] for comparison in comparisons)
+    assert any('error' in comparison and 'No such object' not in comparison['error'] for comparison in comparisons)
+    assert any(comparison.get('known') for comparison in comparisons)
+    assert any('ssim' in comparison and not comparison.get('known') for comparison in comparisons)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from main import PREFILTER_MARGIN, PREFILTER_SIZE
+from prefilter import ThumbnailPrefilter
+from similarity import calculate_ssim
+
+THRESHOLD = 0.9
+
+
+def smooth_field(rng, size, scale=16):
+    """Random uint16 field with structure at roughly ``scale`` pixels, like
+    the microscopy images the service compares."""
+    coarse = rng.random((size // scale + 2, size // scale + 2))
+    field = np.kron(coarse, np.ones((scale, scale)))[:size, :size]
+    field = sum(np.roll(np.roll(field, dx, 0), dy, 1) for dx in range(-4, 5, 2) for dy in range(-4, 5, 2))
+    field = (field - field.min()) / (field.max() - field.min())
+    return field * 40000 + 5000
+
+
+def degraded_variants(rng, base, other):
+    """Copies of ``base`` degraded in steps fine enough for several to land
+    just above and below THRESHOLD."""
+    size = base.shape[0]
+    ramp = np.linspace(0, 1, size)[None, :]
+    for sigma in np.linspace(600, 1200, 7):
+        yield base + rng.normal(0, sigma, base.shape)
+    for weight in np.linspace(0.1, 0.3, 11):
+        yield base * (1 - weight) + other * weight
+    for shift in (1, 2):
+        yield np.roll(base, shift, axis=1)
+    for fraction in np.linspace(0.01, 0.06, 6):
+        speckled = base.copy()
+        mask = rng.random(base.shape) < fraction
+        speckled[mask] = rng.uniform(0, 65535, mask.sum())
+        yield speckled
+    for strength in np.linspace(0.2, 1.0, 5):
+        yield base * (1 - strength * ramp / 2) + other * strength * ramp / 4
+
+
+@pytest.fixture(scope='module')
+def near_threshold_pairs():
+    rng = np.random.default_rng(0)
+    images, pairs = {}, []
+    for b in range(4):
+        base, other = smooth_field(rng, 256), smooth_field(rng, 256)
+        images[f'base{b}'] = base.astype(np.uint16)
+        for v, variant in enumerate(degraded_variants(rng, base, other)):
+            name = f'base{b}_v{v}'
+            images[name] = np.clip(variant, 0, 65535).astype(np.uint16)
+            full = calculate_ssim(images[f'base{b}'], images[name])
+            if THRESHOLD - 0.05 <= full <= THRESHOLD + 0.05:
+                pairs.append((f'base{b}', name, full))
+    return images, pairs
+
+
+def test_default_margin_keeps_every_near_threshold_match(near_threshold_pairs):
+    images, pairs = near_threshold_pairs
+    stage = ThumbnailPrefilter(images, calculate_ssim, THRESHOLD, PREFILTER_MARGIN, PREFILTER_SIZE)
+    matches = [(name1, name2) for name1, name2, full in pairs if full >= THRESHOLD]
+    assert len(matches) >= 20
+    pruned = [pair for pair in matches if stage.score(*pair) < stage.bound]
+    assert pruned == []
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from parallel import compare_runs
+from similarity import (SSIM_FIXED_MAPS, SSIM_MAPS_PER_CANDIDATE, batch_capacity, calculate_ssim_batch,
+                        compare_tif_batch)
+
+
+def tiny_images(count, shape=(2, 40)):
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 255, shape, dtype=np.uint8) for _ in range(count)]
+
+
+def batch_maps(candidates):
+    return SSIM_FIXED_MAPS + SSIM_MAPS_PER_CANDIDATE * candidates
+
+
+def test_batch_kernel_rejects_one_pixel_window():
+    img1, *imgs2 = tiny_images(3)
+    with pytest.raises(ValueError):
+        calculate_ssim_batch(img1, imgs2)
+
+
+def test_tiny_images_are_recorded_as_errors_per_pair():
+    img1, *imgs2 = tiny_images(4)
+    results = compare_tif_batch(img1, imgs2, 'a.tif', ['b.tif', 'c.tif', 'd.tif'])
+    assert len(results) == 3
+    assert all('error' in result for result in results)
+
+
+def test_compare_runs_survives_tiny_images():
+    images = dict(enumerate(tiny_images(4)))
+    tasks = [(1, 'a.tif', k, f'{k}.tif') for k in (2, 3, 4) if k in images] + [(0, 'z.tif', 1, '1.tif')]
+    results = compare_runs(tasks, images.__getitem__, batch_size=8)
+    assert len(results) == len(tasks)
+    assert all('error' in result for result in results)
+
+
+def test_large_images_are_split_to_fit_the_batch_budget(monkeypatch):
+    import parallel
+    rng = np.random.default_rng(1)
+    images = {k: rng.integers(0, 65535, (64, 64), dtype=np.uint16) for k in range(7)}
+    tasks = [(0, 'a.tif', k, f'{k}.tif') for k in range(1, 7)]
+    unbounded = compare_runs(tasks, images.__getitem__, batch_size=8)
+
+    sizes = []
+    batch = parallel.compare_tif_batch
+    monkeypatch.setattr(parallel, 'compare_tif_batch',
+                        lambda img1, imgs2, *args: sizes.append(len(imgs2)) or batch(img1, imgs2, *args))
+    budget = batch_maps(2) * 64 * 64 * 8
+    assert batch_capacity(images[0], budget) == 2
+    assert compare_runs(tasks, images.__getitem__, batch_size=8, batch_bytes=budget) == unbounded
+    assert sizes == [2, 2, 2]
+
+
+def test_images_over_the_budget_are_compared_pair_by_pair():
+    image = np.zeros((64, 64), dtype=np.uint16)
+    assert batch_capacity(image, 64 * 64 * 8) == 1
+    assert batch_capacity(image.astype(np.float32), batch_maps(3) * 64 * 64 * 4) == 3